@@ -1,6 +1,10 @@
 import logging
 
+from .aio import df_to_azure_async as df_to_azure_async
+from .compaction import compact_parquet as compact_parquet
 from .export import df_to_azure as df_to_azure
+from .export import df_to_azure_many as df_to_azure_many
+from .manifest import read_manifest as read_manifest
 
 __version__ = "1.0.2"
 
@@ -1,8 +1,10 @@
+import hashlib
 import logging
 import os
 from re import sub
 from typing import Union
 
+from azure.core.exceptions import ResourceNotFoundError
 from azure.identity import ClientSecretCredential
 from azure.mgmt.datafactory import DataFactoryManagementClient
 from azure.mgmt.datafactory.models import (
@@ -19,6 +21,7 @@ from azure.mgmt.datafactory.models import (
     Factory,
     LinkedServiceReference,
     LinkedServiceResource,
+    ParameterSpecification,
     ParquetFormat,
     PipelineResource,
     SecureString,
@@ -30,9 +33,25 @@ from azure.storage.blob import BlobServiceClient
 from pandas import DataFrame
 
 from df_to_azure.exceptions import EnvVariableNotSetError
+from df_to_azure.provisioning import ProvisioningCache
+from df_to_azure.runs import PipelineRunHandle
 from df_to_azure.settings import TableParameters
 from df_to_azure.utils import print_item
 
+# Names of the datasets and pipelines which are shared by all tables when using the generic pipeline
+GENERIC_BLOB_DATASET_NAME = "BLOB_dftoazure_generic"
+GENERIC_SQL_DATASET_NAME = "SQL_dftoazure_generic"
+GENERIC_PIPELINE_NAME = "dftoazure generic to SQL"
+GENERIC_UPSERT_PIPELINE_NAME = "dftoazure generic upsert to SQL"
+# Annotation of the generic upsert pipeline with the hash of the definitions of the generic resources
+GENERIC_HASH_ANNOTATION = "dftoazure_hash:"
+# Factories and definition hashes for which the generic pipeline has been deployed in this process
+_GENERIC_PIPELINES_DEPLOYED = set()
+
+
+def expression(value: str) -> dict:
+    return {"value": value, "type": "Expression"}
+
 
 class ADF(TableParameters):
     def __init__(
@@ -44,10 +63,14 @@ class ADF(TableParameters):
         id_field: Union[str, list] = None,
         pipeline_name: str = None,
         create: bool = False,
+        provisioning_cache: Union[bool, ProvisioningCache] = False,
+        credentials: ClientSecretCredential = None,
+        adf_client: DataFactoryManagementClient = None,
     ):
         super().__init__(df, tablename, schema, method, id_field)
-        self.credentials = self.create_credentials()
-        self.adf_client = self.adf_client()
+        # a batch of tables shares one credential and client, so the token is requested once
+        self.credentials = credentials or self.create_credentials()
+        self.adf_client = adf_client or self.adf_client()
         self.pipeline_name = pipeline_name
         self.ls_blob_account_name = os.environ.get("ls_blob_account_name")
         self.rg_name = os.environ.get("rg_name")
@@ -58,6 +81,9 @@ class ADF(TableParameters):
         )
         self.ls_blob_name = f'accountname={os.environ.get("ls_blob_account_name")}'
         self.create = create
+        self.provisioning_cache = ProvisioningCache() if provisioning_cache is True else provisioning_cache or None
+        # resources deployed for the run by provisioning key, to deploy them again when one went missing
+        self.deployments = {}
 
     @staticmethod
     def check_env_variables():
@@ -124,12 +150,17 @@ class ADF(TableParameters):
             df = self.adf_client.factories.get(self.rg_name, self.df_name)
             logging.info(f"Datafactory {os.environ.get('df_name')} created!")
 
-    def blob_service_client(self):
-        connect_str = (
+    @property
+    def blob_connection_string(self) -> str:
+        return (
             f"DefaultEndpointsProtocol=https;AccountName={self.ls_blob_account_name}"
             f";AccountKey={os.environ.get('ls_blob_account_key')}"
         )
-        blob_service_client = BlobServiceClient.from_connection_string(connect_str, timeout=600)
+
+    def blob_service_client(self, **kwargs):
+        blob_service_client = BlobServiceClient.from_connection_string(
+            self.blob_connection_string, timeout=600, **kwargs
+        )
 
         return blob_service_client
 
@@ -139,7 +170,45 @@ class ADF(TableParameters):
         except Exception as e:
             logging.info(e)
 
-    def create_linked_service_sql(self):
+    def deploy(self, operations, name: str, resource):
+        """
+        Create or update a linked service, dataset or pipeline. With a provisioning cache, the call is skipped when the
+        same definition was deployed before.
+
+        Parameters
+        ----------
+        operations: LinkedServicesOperations, DatasetsOperations or PipelinesOperations
+            Operations of the adf client for the type of resource.
+        name: str
+            Name of the resource.
+        resource: LinkedServiceResource, DatasetResource or PipelineResource
+            Definition of the resource.
+        """
+        key = self.provisioning_key(operations, name)
+        self.deployments[key] = (operations, name, resource)
+        if self.provisioning_cache is None:
+            return operations.create_or_update(self.rg_name, self.df_name, name, resource)
+
+        fingerprint = self.provisioning_cache.fingerprint(resource)
+        if self.provisioning_cache.is_current(
+            key, fingerprint, get_resource=lambda: operations.get(self.rg_name, self.df_name, name)
+        ):
+            logging.debug(f"{name} is up to date, skipping deployment")
+            return None
+
+        deployed = operations.create_or_update(self.rg_name, self.df_name, name, resource)
+        self.provisioning_cache.store(key, fingerprint, etag=getattr(deployed, "etag", None))
+
+        return deployed
+
+    def provisioning_key(self, operations=None, name: str = None) -> str:
+        key = f"{os.environ.get('subscription_id')}/{self.rg_name}/{self.df_name}/"
+        if operations is not None:
+            key += f"{type(operations).__name__}/{name}"
+
+        return key
+
+    def linked_service_sql_resource(self):
         conn_string = SecureString(
             value=f"integrated security=False;encrypt=True;connection timeout=600;data "
             f"source={os.environ.get('SQL_SERVER')}"
@@ -150,28 +219,25 @@ class ADF(TableParameters):
 
         ls_azure_sql = LinkedServiceResource(properties=AzureSqlDatabaseLinkedService(connection_string=conn_string))
 
-        self.adf_client.linked_services.create_or_update(
-            self.rg_name,
-            self.df_name,
-            self.ls_sql_name,
-            ls_azure_sql,
-        )
+        return self.ls_sql_name, ls_azure_sql
 
-    def create_linked_service_blob(self):
+    def create_linked_service_sql(self):
+        self.deploy(self.adf_client.linked_services, *self.linked_service_sql_resource())
+
+    def linked_service_blob_resource(self):
         storage_string = SecureString(
             value=f"DefaultEndpointsProtocol=https;AccountName={os.environ.get('ls_blob_account_name')}"
             f";AccountKey={os.environ.get('ls_blob_account_key')}"
         )
 
         ls_azure_blob = LinkedServiceResource(properties=AzureStorageLinkedService(connection_string=storage_string))
-        self.adf_client.linked_services.create_or_update(
-            self.rg_name,
-            self.df_name,
-            self.ls_blob_name,
-            ls_azure_blob,
-        )
 
-    def create_input_blob(self):
+        return self.ls_blob_name, ls_azure_blob
+
+    def create_linked_service_blob(self):
+        self.deploy(self.adf_client.linked_services, *self.linked_service_blob_resource())
+
+    def input_blob_resource(self):
         ds_name = f"BLOB_dftoazure_{self.table_name}"
 
         ds_ls = LinkedServiceReference(type="LinkedServiceReference", reference_name=self.ls_blob_name)
@@ -182,9 +248,13 @@ class ADF(TableParameters):
             format=ParquetFormat(),
         )
         ds_azure_blob = DatasetResource(properties=ds_azure_blob)
-        self.adf_client.datasets.create_or_update(self.rg_name, self.df_name, ds_name, ds_azure_blob)
 
-    def create_output_sql(self):
+        return ds_name, ds_azure_blob
+
+    def create_input_blob(self):
+        self.deploy(self.adf_client.datasets, *self.input_blob_resource())
+
+    def output_sql_resource(self):
         ds_name = f"SQL_dftoazure_{self.table_name}"
 
         ds_ls = LinkedServiceReference(type="LinkedServiceReference", reference_name=self.ls_sql_name)
@@ -193,9 +263,13 @@ class ADF(TableParameters):
             table_name=f"{self.schema}.{self.table_name}",
         )
         data_azure_sql = DatasetResource(properties=data_azure_sql)
-        self.adf_client.datasets.create_or_update(self.rg_name, self.df_name, ds_name, data_azure_sql)
 
-    def create_pipeline(self, pipeline_name):
+        return ds_name, data_azure_sql
+
+    def create_output_sql(self):
+        self.deploy(self.adf_client.datasets, *self.output_sql_resource())
+
+    def pipeline_resource(self, pipeline_name: str = None):
         activities = [self.create_copy_activity()]
         # If user wants to upsert, we append stored procedure activity to pipeline.
         if self.method == "upsert":
@@ -205,12 +279,49 @@ class ADF(TableParameters):
             pipeline_name = f"{self.schema} {self.table_name} to SQL"
         params_for_pipeline = {}
         p_obj = PipelineResource(activities=activities, parameters=params_for_pipeline)
-        self.adf_client.pipelines.create_or_update(self.rg_name, self.df_name, pipeline_name, p_obj)
 
-        logging.info(f"Triggering pipeline run for {self.table_name}!")
-        run_response = self.adf_client.pipelines.create_run(self.rg_name, self.df_name, pipeline_name, parameters={})
+        return pipeline_name, p_obj
 
-        return run_response
+    def create_pipeline(self, pipeline_name):
+        return self.run_pipeline(*self.pipeline_resource(pipeline_name))
+
+    def run_pipeline(self, pipeline_name: str, p_obj: PipelineResource):
+        """
+        Deploy a pipeline and trigger a run.
+
+        Parameters
+        ----------
+        pipeline_name: str
+            Name of the pipeline.
+        p_obj: PipelineResource
+            Definition of the pipeline.
+
+        Returns
+        -------
+        run_response: PipelineRunHandle
+            Handle of the triggered run.
+        """
+        self.deploy(self.adf_client.pipelines, pipeline_name, p_obj)
+
+        logging.info(f"Triggering pipeline run for {pipeline_name}!")
+        try:
+            run_response = self.adf_client.pipelines.create_run(
+                self.rg_name, self.df_name, pipeline_name, parameters={}
+            )
+        except ResourceNotFoundError:
+            if self.provisioning_cache is None:
+                raise
+            # The factory was changed outside of df_to_azure, the pipeline or the linked services and datasets it
+            # uses can be gone while they are cached, so all resources of the run are deployed again
+            logging.info(f"Pipeline {pipeline_name} or its resources not found, invalidating provisioning cache")
+            self.provisioning_cache.invalidate(self.provisioning_key())
+            for operations, name, resource in list(self.deployments.values()):
+                self.deploy(operations, name, resource)
+            run_response = self.adf_client.pipelines.create_run(
+                self.rg_name, self.df_name, pipeline_name, parameters={}
+            )
+
+        return PipelineRunHandle(self.adf_client, self.rg_name, self.df_name, run_response.run_id)
 
     def create_copy_activity(self):
         act_name = f"Copy {self.table_name} to SQL"
@@ -229,7 +340,7 @@ class ADF(TableParameters):
 
         return copy_activity
 
-    def stored_procedure_activity(self):
+    def stored_procedure_activity(self, name: str = "UPSERT procedure"):
         dependency_condition = DependencyCondition("Succeeded")
         dependency = ActivityDependency(
             activity=f"Copy {self.table_name} to SQL", dependency_conditions=[dependency_condition]
@@ -239,10 +350,141 @@ class ADF(TableParameters):
         )
         activity = SqlServerStoredProcedureActivity(
             stored_procedure_name=f"UPSERT_{self.table_name}",
-            name="UPSERT procedure",
+            name=name,
             description="Trigger UPSERT procedure in SQL",
             depends_on=[dependency],
             linked_service_name=linked_service_reference,
         )
 
         return activity
+
+    def pipeline_parameters(self) -> dict:
+        """
+        Parameters for a run of the generic pipeline, pointing it to the parquet file and table of this export.
+        """
+        return {
+            "folder": f"dftoazure/{self.table_name}",
+            "file": f"{self.table_name}.parquet",
+            "schema": self.schema,
+            "table": self.table_name,
+        }
+
+    def generic_resources(self) -> list:
+        """
+        The parameterized datasets and pipelines which are shared by all tables, in the order they are deployed.
+
+        Returns
+        -------
+        resources: list
+            Tuples of the operations of the adf client, name and definition of every resource.
+        """
+        string_parameter = ParameterSpecification(type="String")
+        ds_azure_blob = AzureBlobDataset(
+            linked_service_name=LinkedServiceReference(type="LinkedServiceReference", reference_name=self.ls_blob_name),
+            parameters={"folder": string_parameter, "file": string_parameter},
+            folder_path=expression("@dataset().folder"),
+            file_name=expression("@dataset().file"),
+            format=ParquetFormat(),
+        )
+        data_azure_sql = AzureSqlTableDataset(
+            linked_service_name=LinkedServiceReference(type="LinkedServiceReference", reference_name=self.ls_sql_name),
+            parameters={"schema": string_parameter, "table": string_parameter},
+            schema_type_properties_schema=expression("@dataset().schema"),
+            table=expression("@dataset().table"),
+        )
+        resources = [
+            (self.adf_client.datasets, GENERIC_BLOB_DATASET_NAME, DatasetResource(properties=ds_azure_blob)),
+            (self.adf_client.datasets, GENERIC_SQL_DATASET_NAME, DatasetResource(properties=data_azure_sql)),
+        ]
+
+        copy_activity = CopyActivity(
+            name="Copy to SQL",
+            inputs=[
+                DatasetReference(
+                    type="DatasetReference",
+                    reference_name=GENERIC_BLOB_DATASET_NAME,
+                    parameters={
+                        "folder": expression("@pipeline().parameters.folder"),
+                        "file": expression("@pipeline().parameters.file"),
+                    },
+                )
+            ],
+            outputs=[
+                DatasetReference(
+                    type="DatasetReference",
+                    reference_name=GENERIC_SQL_DATASET_NAME,
+                    parameters={
+                        "schema": expression("@pipeline().parameters.schema"),
+                        "table": expression("@pipeline().parameters.table"),
+                    },
+                )
+            ],
+            source=BlobSource(),
+            sink=SqlSink(),
+        )
+        upsert_activity = SqlServerStoredProcedureActivity(
+            stored_procedure_name=expression("@concat('UPSERT_', pipeline().parameters.table)"),
+            name="UPSERT procedure",
+            description="Trigger UPSERT procedure in SQL",
+            depends_on=[
+                ActivityDependency(activity="Copy to SQL", dependency_conditions=[DependencyCondition("Succeeded")])
+            ],
+            linked_service_name=LinkedServiceReference(type="LinkedServiceReference", reference_name=self.ls_sql_name),
+        )
+        parameters = {name: string_parameter for name in ("folder", "file", "schema", "table")}
+        for pipeline_name, activities in (
+            (GENERIC_PIPELINE_NAME, [copy_activity]),
+            (GENERIC_UPSERT_PIPELINE_NAME, [copy_activity, upsert_activity]),
+        ):
+            p_obj = PipelineResource(activities=activities, parameters=parameters)
+            resources.append((self.adf_client.pipelines, pipeline_name, p_obj))
+
+        return resources
+
+    def create_generic_pipelines(self):
+        """
+        Deploy the parameterized datasets and pipelines which are shared by all tables. This is done once per process,
+        or when they do not exist in the data factory yet or were deployed with another definition. With create=True
+        the resources are always deployed.
+
+        The hash of the definitions is stored as an annotation of the upsert pipeline, which is deployed last, so a
+        single get call tells if all resources are up to date.
+        """
+        key = self.provisioning_key()
+        resources = self.generic_resources()
+        fingerprints = "".join(ProvisioningCache.fingerprint(resource) for _, _, resource in resources)
+        annotation = f"{GENERIC_HASH_ANNOTATION}{hashlib.sha256(fingerprints.encode()).hexdigest()}"
+        if not self.create:
+            if (key, annotation) in _GENERIC_PIPELINES_DEPLOYED:
+                return
+            try:
+                pipeline = self.adf_client.pipelines.get(self.rg_name, self.df_name, GENERIC_UPSERT_PIPELINE_NAME)
+                if annotation in (pipeline.annotations or []):
+                    _GENERIC_PIPELINES_DEPLOYED.add((key, annotation))
+                    return
+                logging.info("Generic pipeline has another definition, deploying it")
+            except ResourceNotFoundError:
+                logging.info("Generic pipeline not found, deploying it")
+
+        self.create_linked_service_sql()
+        self.create_linked_service_blob()
+        resources[-1][2].annotations = [annotation]
+        for operations, name, resource in resources:
+            self.deploy(operations, name, resource)
+
+        _GENERIC_PIPELINES_DEPLOYED.add((key, annotation))
+
+    @property
+    def generic_pipeline_name(self) -> str:
+        return GENERIC_UPSERT_PIPELINE_NAME if self.method == "upsert" else GENERIC_PIPELINE_NAME
+
+    def create_generic_pipeline_run(self):
+        """
+        Trigger a run of the generic pipeline for this table, without any management writes.
+        """
+        logging.info(f"Triggering generic pipeline run for {self.table_name}!")
+        run_response = self.adf_client.pipelines.create_run(
+            self.rg_name, self.df_name, self.generic_pipeline_name, parameters=self.pipeline_parameters()
+        )
+
+        return PipelineRunHandle(self.adf_client, self.rg_name, self.df_name, run_response.run_id)
@@ -0,0 +1,181 @@
+import asyncio
+import logging
+import os
+from functools import partial
+
+import pyarrow as pa
+from azure.core.exceptions import ResourceNotFoundError
+from azure.identity.aio import ClientSecretCredential
+from azure.mgmt.datafactory.aio import DataFactoryManagementClient
+from azure.storage.blob.aio import BlobServiceClient
+
+from df_to_azure.exceptions import PipelineRunError
+from df_to_azure.export import DfToAzure, df_to_azure
+from df_to_azure.runs import PipelineRunHandle
+
+
+async def df_to_azure_async(df, tablename, schema, parquet=False, **kwargs):
+    """
+    Asynchronous version of df_to_azure, with the same arguments and return value.
+
+    Calls to Azure are made with the aio clients, serialization and SQL statements run in the default executor so
+    they do not block the event loop. The parquet export runs completely in the executor.
+    """
+    loop = asyncio.get_running_loop()
+    if parquet:
+        return await loop.run_in_executor(None, partial(df_to_azure, df, tablename, schema, parquet=True, **kwargs))
+
+    return await AsyncDfToAzure(df=df, tablename=tablename, schema=schema, **kwargs).run()
+
+
+async def wait_until_pipeline_is_done_async(run_response: PipelineRunHandle, timeout: float = 60 * 60 * 3):
+    """
+    Asynchronous version of utils.wait_until_pipeline_is_done, awaits the future of the run handle.
+    """
+    # tracking the run fetches it with the synchronous client, so that runs in the executor
+    future = await asyncio.get_running_loop().run_in_executor(None, lambda: run_response.future)
+    try:
+        await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+    except asyncio.TimeoutError:
+        raise PipelineRunError("Pipeline is running too long")
+
+
+class AsyncDfToAzure(DfToAzure):
+    """
+    DfToAzure which talks to Azure with the aio clients, so many exports can run concurrently on one event loop.
+    """
+
+    @staticmethod
+    def create_async_credentials():
+        return ClientSecretCredential(
+            client_id=os.environ.get("AZURE_CLIENT_ID"),
+            client_secret=os.environ.get("AZURE_CLIENT_SECRET"),
+            tenant_id=os.environ.get("AZURE_TENANT_ID"),
+        )
+
+    async def run(self):
+        if self.df.empty:
+            logging.info("Data empty, no new records to upload.")
+            return None, None
+
+        loop = asyncio.get_running_loop()
+        if self.transport != "adf":
+            await loop.run_in_executor(None, self.run_bulk_insert)
+            return None, None
+
+        if self.create:
+            # azure components, only needed once so these use the synchronous clients
+            await loop.run_in_executor(None, self.create_resourcegroup)
+            await loop.run_in_executor(None, self.create_datafactory)
+            await loop.run_in_executor(None, self.create_blob_container)
+
+        async with self.create_async_credentials() as credentials:
+            async with DataFactoryManagementClient(credentials, os.environ.get("subscription_id")) as adf_client:
+                if self.generic_pipeline:
+                    await loop.run_in_executor(None, self.create_generic_pipelines)
+                    await loop.run_in_executor(None, self.prepare_tables)
+                    await self.upload_to_blob_async()
+                    logging.info(f"Triggering generic pipeline run for {self.table_name}!")
+                    run_response = await adf_client.pipelines.create_run(
+                        self.rg_name, self.df_name, self.generic_pipeline_name, parameters=self.pipeline_parameters()
+                    )
+                    run_response = PipelineRunHandle(self.adf_client, self.rg_name, self.df_name, run_response.run_id)
+                else:
+                    await asyncio.gather(
+                        self.deploy_async(adf_client.linked_services, *self.linked_service_sql_resource()),
+                        self.deploy_async(adf_client.linked_services, *self.linked_service_blob_resource()),
+                        loop.run_in_executor(None, self.prepare_tables),
+                    )
+                    # the sql dataset points to the staging schema after preparing the tables for an upsert
+                    await asyncio.gather(
+                        self.upload_to_blob_async(),
+                        self.deploy_async(adf_client.datasets, *self.input_blob_resource()),
+                        self.deploy_async(adf_client.datasets, *self.output_sql_resource()),
+                    )
+                    logging.info(f"Finished exporting {self.df.shape[0]} records to Azure Blob Storage.")
+                    run_response = await self.run_pipeline_async(
+                        adf_client, *self.pipeline_resource(self.pipeline_name)
+                    )
+
+        if self.wait_till_finished or (self.clean_staging and self.method == "upsert"):
+            await wait_until_pipeline_is_done_async(run_response)
+
+        if self.clean_staging and self.method == "upsert":
+            await loop.run_in_executor(None, self.clean_staging_after_upsert)
+
+        return self.adf_client, run_response
+
+    async def upload_to_blob_async(self):
+        loop = asyncio.get_running_loop()
+        if self.streaming or self.adaptive_upload:
+            # the block writer is synchronous, so the whole upload runs on a worker thread
+            await loop.run_in_executor(None, self.upload_to_blob)
+            return
+
+        data = await loop.run_in_executor(None, self.parquet_data)
+        async with BlobServiceClient.from_connection_string(
+            self.blob_connection_string,
+            timeout=600,
+            max_block_size=self.block_size,
+            max_single_put_size=self.max_single_put_size,
+        ) as blob_service_client:
+            blob_client = blob_service_client.get_blob_client(container="dftoazure", blob=self.blob_name)
+            await blob_client.upload_blob(
+                pa.BufferReader(data), overwrite=True, length=len(data), max_concurrency=self.max_concurrency
+            )
+
+    async def deploy_async(self, operations, name: str, resource):
+        """
+        Asynchronous version of ADF.deploy.
+        """
+        key = self.provisioning_key(operations, name)
+        self.deployments[key] = (operations, name, resource)
+        if self.provisioning_cache is None:
+            return await operations.create_or_update(self.rg_name, self.df_name, name, resource)
+
+        fingerprint = self.provisioning_cache.fingerprint(resource)
+        if self.provisioning_cache.is_current(key, fingerprint):
+            if not self.provisioning_cache.verify:
+                logging.debug(f"{name} is up to date, skipping deployment")
+                return None
+            try:
+                deployed = await operations.get(self.rg_name, self.df_name, name)
+            except ResourceNotFoundError:
+                deployed = None
+            if deployed is not None and self.provisioning_cache.is_current(
+                key, fingerprint, get_resource=lambda: deployed
+            ):
+                logging.debug(f"{name} is up to date, skipping deployment")
+                return None
+
+        deployed = await operations.create_or_update(self.rg_name, self.df_name, name, resource)
+        self.provisioning_cache.store(key, fingerprint, etag=getattr(deployed, "etag", None))
+
+        return deployed
+
+    async def run_pipeline_async(self, adf_client, pipeline_name: str, p_obj):
+        """
+        Asynchronous version of ADF.run_pipeline.
+        """
+        await self.deploy_async(adf_client.pipelines, pipeline_name, p_obj)
+
+        logging.info(f"Triggering pipeline run for {pipeline_name}!")
+        try:
+            run_response = await adf_client.pipelines.create_run(
+                self.rg_name, self.df_name, pipeline_name, parameters={}
+            )
+        except ResourceNotFoundError:
+            if self.provisioning_cache is None:
+                raise
+            # like ADF.run_pipeline, all resources of the run are deployed again
+            logging.info(f"Pipeline {pipeline_name} or its resources not found, invalidating provisioning cache")
+            self.provisioning_cache.invalidate(self.provisioning_key())
+            # in the order of the first deployment, so the linked services exist before the datasets which use them
+            for operations, name, resource in list(self.deployments.values()):
+                await self.deploy_async(operations, name, resource)
+            run_response = await adf_client.pipelines.create_run(
+                self.rg_name, self.df_name, pipeline_name, parameters={}
+            )
+
+        # the status is polled with the synchronous client, shared with the other runs of the data factory
+        return PipelineRunHandle(self.adf_client, self.rg_name, self.df_name, run_response.run_id)
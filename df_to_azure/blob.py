@@ -0,0 +1,483 @@
+import io
+import logging
+import random
+import time
+from base64 import b64encode
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Union
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from azure.core import MatchConditions
+from azure.storage.blob import BlobBlock
+from pandas import DataFrame
+
+# Size of the blocks which are staged on blob storage.
+DEFAULT_BLOCK_SIZE = 32 * 1024 * 1024
+# Number of rows written per parquet row group while streaming.
+DEFAULT_ROW_GROUP_SIZE = 500_000
+# Number of blocks which are uploaded in parallel.
+DEFAULT_MAX_CONCURRENCY = 4
+# Data up to this size is uploaded with a single put request instead of staged blocks.
+DEFAULT_MAX_SINGLE_PUT_SIZE = 64 * 1024 * 1024
+# Upper bounds for adaptive uploads, Azure accepts blocks up to 4000 MiB.
+MAX_ADAPTIVE_BLOCK_SIZE = 256 * 1024 * 1024
+MAX_ADAPTIVE_CONCURRENCY = 32
+# Upper bound in seconds of the random wait before a conditional write is tried again.
+MAX_CONFLICT_BACKOFF = 5.0
+
+
+class BlockBlobWriter(io.RawIOBase):
+    """
+    Writable file-like object which stages every full chunk of data as a block of a block blob.
+
+    Blocks are staged in parallel on a thread pool and the block list is committed when the writer is closed, so the
+    blob only becomes visible once all data is written. Memory usage is bounded by block size times concurrency and
+    does not depend on the total amount of data written.
+
+    With ``adaptive=True`` the throughput is measured over windows of staged blocks. As long as the throughput keeps
+    improving, the block size and concurrency are doubled, until the link is saturated.
+    """
+
+    def __init__(
+        self,
+        blob_client,
+        block_size: int = DEFAULT_BLOCK_SIZE,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        adaptive: bool = False,
+        etag: str = None,
+        match_condition: MatchConditions = None,
+    ):
+        """
+        Parameters
+        ----------
+        blob_client: BlobClient
+            Client of the blob to write to.
+        block_size: int
+            Size in bytes of each staged block, starting size when adaptive.
+        max_concurrency: int
+            Number of blocks staged in parallel, starting concurrency when adaptive.
+        adaptive: bool
+            Resize blocks and concurrency based on the measured throughput.
+        etag: str
+            Etag the blob must have for the block list to be committed, used with match_condition.
+        match_condition: MatchConditions
+            Condition on the blob for committing, the commit raises when the condition is not met.
+        """
+        super().__init__()
+        self.blob_client = blob_client
+        self.block_size = block_size
+        self.max_concurrency = max_concurrency
+        self.adaptive = adaptive
+        self.etag = etag
+        self.match_condition = match_condition
+        # properties of the committed blob, like its etag
+        self.result = None
+        self.block_ids = []
+        self._buffer = bytearray()
+        self._position = 0
+        self._committed = False
+        self._pending = set()
+        self._executor = ThreadPoolExecutor(max_workers=MAX_ADAPTIVE_CONCURRENCY if adaptive else max_concurrency)
+        # throughput measurement for adaptive uploads
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+        self._window_blocks = 0
+        self._throughput = 0.0
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def write(self, data) -> int:
+        if self.closed:
+            raise ValueError("I/O operation on closed writer.")
+        data = memoryview(data).cast("B")
+        self._position += len(data)
+        offset = 0
+        while offset < len(data):
+            # Copy at most one block at a time, so large writes are not duplicated in memory as a whole
+            needed = self.block_size - len(self._buffer)
+            self._buffer += data[offset : offset + needed]
+            offset += needed
+            if len(self._buffer) >= self.block_size:
+                self._stage(bytes(self._buffer))
+                self._buffer.clear()
+
+        return len(data)
+
+    def _stage(self, block: bytes):
+        # Block ids have to be base64 encoded and of equal length within one blob
+        block_id = b64encode(f"{len(self.block_ids):010d}".encode()).decode()
+        self.block_ids.append(block_id)
+        while len(self._pending) >= self.max_concurrency:
+            self._collect(return_when=FIRST_COMPLETED)
+        self._pending.add(self._executor.submit(self._stage_block, block_id, block))
+
+    def _stage_block(self, block_id: str, block: bytes) -> int:
+        self.blob_client.stage_block(block_id=block_id, data=block, length=len(block))
+        return len(block)
+
+    def _collect(self, return_when):
+        done, self._pending = wait(self._pending, return_when=return_when)
+        for future in done:
+            # raises the exception of a failed block upload
+            self._window_bytes += future.result()
+            self._window_blocks += 1
+        if self.adaptive:
+            self._adapt()
+
+    def _adapt(self):
+        """
+        Scale up block size and concurrency while the throughput over the last window keeps improving by at least 10%.
+        """
+        if self._window_blocks < 2 * self.max_concurrency:
+            return
+        elapsed = time.monotonic() - self._window_start
+        throughput = self._window_bytes / elapsed if elapsed > 0 else float("inf")
+        if throughput > 1.1 * self._throughput and (
+            self.block_size < MAX_ADAPTIVE_BLOCK_SIZE or self.max_concurrency < MAX_ADAPTIVE_CONCURRENCY
+        ):
+            self.block_size = min(2 * self.block_size, MAX_ADAPTIVE_BLOCK_SIZE)
+            self.max_concurrency = min(2 * self.max_concurrency, MAX_ADAPTIVE_CONCURRENCY)
+            logging.debug(
+                f"Upload throughput {throughput / 1024**2:.1f} MiB/s, scaling to blocks of "
+                f"{self.block_size // 1024**2} MiB with concurrency {self.max_concurrency}"
+            )
+        else:
+            # link is saturated, keep the current settings
+            self.adaptive = False
+        self._throughput = throughput
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+        self._window_blocks = 0
+
+    def commit(self):
+        """
+        Stage the remaining buffered data and commit the block list, overwriting the blob if it exists and meets the
+        match condition.
+        """
+        if self._committed:
+            return
+        if self._buffer:
+            self._stage(bytes(self._buffer))
+            self._buffer.clear()
+        while self._pending:
+            self._collect(return_when=FIRST_COMPLETED)
+        self.result = self.blob_client.commit_block_list(
+            [BlobBlock(block_id=block_id) for block_id in self.block_ids],
+            etag=self.etag,
+            match_condition=self.match_condition,
+        )
+        self._committed = True
+        logging.debug(
+            f"Committed {len(self.block_ids)} blocks of {self._position} bytes to {self.blob_client.blob_name}"
+        )
+
+    def close(self):
+        if not self.closed:
+            try:
+                self.commit()
+            finally:
+                self._executor.shutdown(cancel_futures=True)
+                super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            # Do not commit a partially written blob, uncommitted blocks are garbage collected by Azure.
+            self._committed = True
+        self.close()
+
+
+class BufferWriter(io.RawIOBase):
+    """
+    Seekable writable file-like object over a preallocated buffer, so a parallel download writes its ranges straight
+    into the buffer.
+    """
+
+    def __init__(self, buffer):
+        super().__init__()
+        self._view = memoryview(buffer).cast("B")
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self._position = offset
+        elif whence == io.SEEK_CUR:
+            self._position += offset
+        elif whence == io.SEEK_END:
+            self._position = len(self._view) + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+
+        return self._position
+
+    def write(self, data) -> int:
+        data = memoryview(data).cast("B")
+        self._view[self._position : self._position + len(data)] = data
+        self._position += len(data)
+
+        return len(data)
+
+
+def download_to_buffer(downloaded_blob) -> pa.Buffer:
+    """
+    Download a blob into a preallocated arrow buffer, in max_concurrency parallel ranges.
+
+    The ranges are written in place, so the file is held in memory once and pyarrow reads it without another copy.
+    All ranges are conditional on the etag of the first response of the download.
+
+    Parameters
+    ----------
+    downloaded_blob: StorageStreamDownloader
+        Download started with blob_client.download_blob(max_concurrency=...).
+
+    Returns
+    -------
+    buffer: pa.Buffer
+        Contents of the blob.
+    """
+    buffer = pa.allocate_buffer(downloaded_blob.size)
+    downloaded_blob.readinto(BufferWriter(buffer))
+
+    return buffer
+
+
+class BlobReader(io.RawIOBase):
+    """
+    Seekable read-only file-like object which downloads the requested byte ranges of a blob.
+
+    Parquet readers only fetch the footer and the column chunks they need, so a large blob can be read row group by
+    row group without downloading it completely. All reads are conditional on the etag of the blob when the reader
+    was opened, so a blob which is changed in the meantime raises instead of returning mixed data.
+    """
+
+    def __init__(self, blob_client):
+        """
+        Parameters
+        ----------
+        blob_client: BlobClient
+            Client of the blob to read.
+        """
+        super().__init__()
+        self.blob_client = blob_client
+        properties = blob_client.get_blob_properties()
+        self.size = properties.size
+        self.etag = properties.etag
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self._position = offset
+        elif whence == io.SEEK_CUR:
+            self._position += offset
+        elif whence == io.SEEK_END:
+            self._position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+
+        return self._position
+
+    def readinto(self, buffer) -> int:
+        length = min(len(buffer), self.size - self._position)
+        if length <= 0:
+            return 0
+        data = self.blob_client.download_blob(
+            offset=self._position, length=length, etag=self.etag, match_condition=MatchConditions.IfNotModified
+        ).readall()
+        buffer[: len(data)] = data
+        self._position += len(data)
+
+        return len(data)
+
+
+def upload_data(
+    blob_client,
+    data: Union[bytes, pa.Buffer],
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    block_size: int = DEFAULT_BLOCK_SIZE,
+    max_single_put_size: int = DEFAULT_MAX_SINGLE_PUT_SIZE,
+    adaptive: bool = False,
+    etag: str = None,
+    match_condition: MatchConditions = None,
+) -> str:
+    """
+    Upload data to a block blob, overwriting the blob if it exists and meets the match condition.
+
+    Small data is uploaded with a single put request. Larger data is uploaded in parallel blocks, either by the Azure
+    SDK or, when adaptive, by a BlockBlobWriter which resizes blocks and concurrency to saturate the link.
+
+    Parameters
+    ----------
+    blob_client: BlobClient
+        Client of the blob to write to. The SDK block size and single put threshold are configured on the client.
+    data: bytes or pa.Buffer
+        Data to upload.
+    max_concurrency: int
+        Number of blocks uploaded in parallel.
+    block_size: int
+        Size in bytes of each block, only used here when adaptive.
+    max_single_put_size: int
+        Data up to this size is uploaded with a single put request, only used here when adaptive.
+    adaptive: bool
+        Resize blocks and concurrency based on the measured throughput.
+    etag: str
+        Etag the blob must have to be overwritten, used with match_condition.
+    match_condition: MatchConditions
+        Condition on the blob, for example IfNotModified with the etag of the downloaded blob or IfMissing. The upload
+        raises ResourceModifiedError or ResourceExistsError when the condition is not met.
+
+    Returns
+    -------
+    etag: str
+        Etag of the uploaded blob.
+    """
+    if adaptive and len(data) > max_single_put_size:
+        with BlockBlobWriter(
+            blob_client,
+            block_size=block_size,
+            max_concurrency=max_concurrency,
+            adaptive=True,
+            etag=etag,
+            match_condition=match_condition,
+        ) as sink:
+            sink.write(data)
+        return sink.result["etag"]
+
+    length = len(data)
+    if isinstance(data, pa.Buffer):
+        # the SDK takes bytes or a file, a reader on the buffer uploads it without converting it to bytes first
+        data = pa.BufferReader(data)
+    result = blob_client.upload_blob(
+        data,
+        overwrite=True,
+        length=length,
+        max_concurrency=max_concurrency,
+        etag=etag,
+        match_condition=match_condition,
+    )
+
+    return result["etag"]
+
+
+def conflict_backoff(attempt: int):
+    """
+    Wait a random time before a conditional write is tried again, growing with the attempt, so writers which
+    conflicted do not conflict again.
+    """
+    time.sleep(random.uniform(0, min(MAX_CONFLICT_BACKOFF, 0.1 * 2**attempt)))
+
+
+def to_arrow_table(df: DataFrame, schema: pa.Schema = None) -> pa.Table:
+    """
+    Convert a DataFrame to an Arrow table with the given schema, one column at a time.
+
+    Timedeltas are converted to seconds, floats are rounded to the scale of a decimal type and timestamps are cast to
+    the unit of the schema. The DataFrame itself is not changed.
+
+    Parameters
+    ----------
+    df: DataFrame
+        Data to convert.
+    schema: pa.Schema
+        Schema of the table, by default the schema is inferred by pyarrow.
+
+    Returns
+    -------
+    table: pa.Table
+        Table with the columns of the DataFrame.
+    """
+    if schema is None:
+        return pa.Table.from_pandas(df, preserve_index=False)
+
+    arrays = []
+    for field in schema:
+        col = df[field.name]
+        if col.dtype.kind == "m":
+            col = col.dt.total_seconds()
+        arr = pa.array(col, from_pandas=True)
+        if pa.types.is_dictionary(arr.type):
+            arr = arr.dictionary_decode()
+        if pa.types.is_decimal(field.type) and pa.types.is_floating(arr.type):
+            arr = pc.round(arr, field.type.scale)
+        if arr.type != field.type:
+            # sub-microsecond parts of timestamps are truncated, SQL Server does not store them
+            arr = arr.cast(field.type, safe=not pa.types.is_timestamp(field.type))
+        arrays.append(arr)
+
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def to_parquet_buffer(df: DataFrame, schema: pa.Schema = None) -> pa.Buffer:
+    """
+    Serialize a DataFrame to parquet with the given schema, in an arrow buffer which is uploaded without a copy.
+    """
+    buffer = pa.BufferOutputStream()
+    pq.write_table(to_arrow_table(df, schema), buffer)
+
+    return buffer.getvalue()
+
+
+def stream_parquet_to_blob(
+    df: DataFrame,
+    blob_client,
+    schema: pa.Schema = None,
+    row_group_size: int = DEFAULT_ROW_GROUP_SIZE,
+    block_size: int = DEFAULT_BLOCK_SIZE,
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    adaptive: bool = False,
+):
+    """
+    Write a DataFrame as parquet to a block blob, one row group at a time.
+
+    Only one row group and the blocks in flight are held in memory on top of the DataFrame itself.
+
+    Parameters
+    ----------
+    df: DataFrame
+        Data to upload.
+    blob_client: BlobClient
+        Client of the blob to write to.
+    schema: pa.Schema
+        Schema of the parquet file, by default the schema is inferred by pyarrow.
+    row_group_size: int
+        Number of rows per parquet row group.
+    block_size: int
+        Size in bytes of each staged block.
+    max_concurrency: int
+        Number of blocks staged in parallel.
+    adaptive: bool
+        Resize blocks and concurrency based on the measured throughput.
+    """
+    if schema is None:
+        schema = pa.Schema.from_pandas(df, preserve_index=False)
+    with BlockBlobWriter(
+        blob_client, block_size=block_size, max_concurrency=max_concurrency, adaptive=adaptive
+    ) as sink:
+        with pq.ParquetWriter(sink, schema) as writer:
+            for start in range(0, len(df), row_group_size):
+                chunk = df.iloc[start : start + row_group_size]
+                writer.write_table(to_arrow_table(chunk, schema))
+
+    logging.info(f"Streamed {df.shape[0]} records in {len(sink.block_ids)} blocks to {blob_client.blob_name}.")
@@ -0,0 +1,197 @@
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+
+import azure.core.exceptions
+import pyarrow as pa
+from azure.core import MatchConditions
+
+from df_to_azure.blob import DEFAULT_MAX_CONCURRENCY, download_to_buffer
+
+# Total size in bytes of the cached blobs, above which the least recently used blobs are removed.
+DEFAULT_CACHE_SIZE = 10 * 1024 * 1024 * 1024
+# Seconds after which a data file which no entry refers to is removed, it was replaced by another process.
+ORPHAN_AGE = 60
+
+
+class BlobCache:
+    """
+    Local disk cache of blobs, validated with the etag of the blob.
+
+    A cached blob is downloaded with an If-None-Match request on its etag, which returns no data when the blob was
+    not changed, so the cached file is used. After an upload the uploaded data is stored with the etag of the upload,
+    so a process which upserts the same blob again does not download it at all. The cached files are memory mapped.
+
+    Every blob has an entry {key}.json with its etag and the name of its data file, which is replaced atomically after
+    the data file is written, so processes can share the directory. When the cached files are larger than max_size,
+    the entries which were used least recently are removed.
+    """
+
+    def __init__(self, directory: str, max_size: int = DEFAULT_CACHE_SIZE):
+        """
+        Parameters
+        ----------
+        directory: str
+            Directory of the cache, it is created when it does not exist.
+        max_size: int
+            Total size in bytes of the cached blobs.
+        """
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, blob_client) -> str:
+        name = f"{getattr(blob_client, 'account_name', '')}/{blob_client.container_name}/{blob_client.blob_name}"
+
+        return hashlib.sha256(name.encode()).hexdigest()
+
+    def entry(self, key: str) -> dict:
+        try:
+            with open(os.path.join(self.directory, f"{key}.json")) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def read(self, key: str):
+        """
+        Cached data and etag of a blob, None when it is not cached.
+        """
+        entry = self.entry(key)
+        if entry is None:
+            return None, None
+        try:
+            with pa.memory_map(os.path.join(self.directory, entry["file"])) as source:
+                buffer = source.read_buffer()
+        except FileNotFoundError:
+            return None, None
+        try:
+            # the entry is used, for the least recently used eviction
+            os.utime(os.path.join(self.directory, f"{key}.json"))
+        except FileNotFoundError:
+            pass
+
+        return buffer, entry["etag"]
+
+    def download(self, blob_client, max_concurrency: int = DEFAULT_MAX_CONCURRENCY):
+        """
+        Download a blob, unless the cached version still has the etag of the blob.
+
+        Parameters
+        ----------
+        blob_client: BlobClient
+            Client of the blob to download.
+        max_concurrency: int
+            Number of ranges downloaded in parallel.
+
+        Returns
+        -------
+        buffer: pa.Buffer
+            Contents of the blob.
+        etag: str
+            Etag of the blob.
+        """
+        key = self.key(blob_client)
+        buffer, etag = self.read(key)
+        if etag is None:
+            downloaded_blob = blob_client.download_blob(max_concurrency=max_concurrency)
+        else:
+            try:
+                downloaded_blob = blob_client.download_blob(
+                    max_concurrency=max_concurrency, etag=etag, match_condition=MatchConditions.IfModified
+                )
+            except azure.core.exceptions.HttpResponseError as e:
+                # the storage sdk raises a 304 Not Modified as a plain HttpResponseError
+                if e.status_code != 304:
+                    raise
+                logging.info(f"Using the cached version of {blob_client.blob_name}.")
+                return buffer, etag
+
+        buffer = download_to_buffer(downloaded_blob)
+        etag = downloaded_blob.properties.etag
+        self.put(blob_client, buffer, etag)
+
+        return buffer, etag
+
+    def put(self, blob_client, data, etag: str):
+        """
+        Store the data of a blob with its etag, after a download or an upload.
+        """
+        key = self.key(blob_client)
+        previous = self.entry(key)
+        # the data and the entry are written to temporary files first, so readers never see them half written
+        file_name = f"{key}-{uuid.uuid4().hex[:12]}.data"
+        tmp_path = os.path.join(self.directory, f"{file_name}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, os.path.join(self.directory, file_name))
+
+        entry = {
+            "container": blob_client.container_name,
+            "blob": blob_client.blob_name,
+            "etag": etag,
+            "file": file_name,
+        }
+        tmp_path = os.path.join(self.directory, f"{key}-{uuid.uuid4().hex[:12]}.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, os.path.join(self.directory, f"{key}.json"))
+
+        if previous is not None:
+            remove(os.path.join(self.directory, previous["file"]))
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cached files fit in max_size.
+
+        When two processes store the same blob at the same time, the entry of one refers to the data file of the
+        other, so the data files which no entry refers to are removed as well. Only files older than ORPHAN_AGE
+        seconds are removed, newer ones can belong to an entry which is being written.
+        """
+        names = os.listdir(self.directory)
+        entries = []
+        referenced = set()
+        for name in names:
+            if not name.endswith(".json"):
+                continue
+            key = name[: -len(".json")]
+            entry = self.entry(key)
+            if entry is not None:
+                referenced.add(entry["file"])
+            try:
+                entry_stat = os.stat(os.path.join(self.directory, name))
+                size = os.path.getsize(os.path.join(self.directory, entry["file"]))
+            except (FileNotFoundError, TypeError):
+                continue
+            entries.append((entry_stat.st_mtime, size, key, entry["file"]))
+
+        total_size = sum(size for _, size, _, _ in entries)
+        for _, size, key, file_name in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            remove(os.path.join(self.directory, f"{key}.json"))
+            remove(os.path.join(self.directory, file_name))
+            total_size -= size
+            logging.debug(f"Removed {file_name} from the cache.")
+
+        for name in names:
+            if name.endswith(".data") and name not in referenced:
+                path = os.path.join(self.directory, name)
+                try:
+                    orphaned = time.time() - os.path.getmtime(path) > ORPHAN_AGE
+                except FileNotFoundError:
+                    continue
+                if orphaned:
+                    remove(path)
+                    logging.debug(f"Removed unreferenced {name} from the cache.")
+
+
+def remove(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        # removed by another process already, or still memory mapped on Windows
+        pass
@@ -0,0 +1,132 @@
+"""
+Calibrate the costs of the transports for transport="auto" in the current environment.
+
+Every transport loads synthetic DataFrames of the given numbers of rows into the given schema, once with a few
+narrow columns and once with wide text columns, so the time per row and per byte can be told apart. The fitted
+costs are stored in calibration_path(), under the server and database in the environment variables.
+
+    python -m df_to_azure.calibrate --schema test --rows 1000 100000 1000000
+"""
+
+import argparse
+import logging
+import time
+
+import numpy as np
+import pandas as pd
+
+from df_to_azure.db import execute_stmt
+from df_to_azure.export import DfToAzure
+from df_to_azure.transport import TRANSPORTS, CostModel, estimate_size
+
+
+def synthetic_frame(rows: int, text_columns: int, seed: int = 0) -> pd.DataFrame:
+    """
+    DataFrame with an id, a number, a date and text_columns columns of 50 characters.
+    """
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(
+        {
+            "id": np.arange(rows),
+            "value": rng.random(rows),
+            "date": pd.Timestamp("2020-01-01") + pd.to_timedelta(rng.integers(0, 10**8, rows), unit="s"),
+        }
+    )
+    for i in range(text_columns):
+        df[f"text_{i}"] = pd.Series(rng.integers(0, 10**12, rows)).astype(str).str.pad(50, fillchar="x")
+
+    return df
+
+
+def time_transport(transport: str, df: pd.DataFrame, schema: str, create: bool = False) -> float:
+    """
+    Seconds to create a table from the DataFrame with the transport, until the data is in the table.
+    """
+    start = time.perf_counter()
+    DfToAzure(
+        df=df,
+        tablename=f"calibration_{transport}",
+        schema=schema,
+        method="create",
+        wait_till_finished=True,
+        create=create,
+        transport=transport,
+    ).run()
+
+    return time.perf_counter() - start
+
+
+def fit(measurements: list) -> dict:
+    """
+    Least squares fit of seconds = startup + rows * row_cost + size * byte_cost, negative costs are set to 0.
+
+    Parameters
+    ----------
+    measurements: list
+        Tuples of rows, size and seconds.
+
+    Returns
+    -------
+    costs: dict
+        Startup, row_cost and byte_cost.
+    """
+    x = np.array([[1.0, rows, size] for rows, size, _ in measurements])
+    y = np.array([seconds for _, _, seconds in measurements])
+    startup, row_cost, byte_cost = np.clip(np.linalg.lstsq(x, y, rcond=None)[0], 0, None)
+
+    return {"startup": float(startup), "row_cost": float(row_cost), "byte_cost": float(byte_cost)}
+
+
+def calibrate(schema: str, rows: list, repeat: int = 1, create: bool = False, path: str = None) -> CostModel:
+    """
+    Time every transport on synthetic DataFrames and store the fitted costs.
+
+    Parameters
+    ----------
+    schema: str
+        Schema to create the calibration tables in, they are dropped afterwards.
+    rows: list
+        Numbers of rows of the synthetic DataFrames, at least two different numbers.
+    repeat: int
+        Number of times every load is timed, the fastest time is used.
+    create: bool
+        Create the resource group, data factory and blob container for the ADF transport.
+    path: str
+        Path of the calibration file, defaults to calibration_path().
+
+    Returns
+    -------
+    cost_model: CostModel
+        The calibrated costs.
+    """
+    if len(set(rows)) < 2:
+        raise ValueError("Give at least two different numbers of rows to calibrate with.")
+
+    frames = [synthetic_frame(n, text_columns) for n in sorted(set(rows)) for text_columns in (0, 10)]
+    costs = {}
+    for transport in TRANSPORTS:
+        measurements = []
+        for df in frames:
+            seconds = min(time_transport(transport, df, schema, create) for _ in range(repeat))
+            measurements.append((df.shape[0], estimate_size(df), seconds))
+            logging.info(f"{transport}: {df.shape[0]} records of {df.shape[1]} columns in {seconds:.1f}s")
+        execute_stmt(f"DROP TABLE IF EXISTS {schema}.calibration_{transport}")
+        costs[transport] = fit(measurements)
+        logging.info(f"Calibrated {transport}: {costs[transport]}")
+
+    cost_model = CostModel(costs, calibrated=True)
+    cost_model.save(path)
+
+    return cost_model
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calibrate the costs of the transports for transport='auto'.")
+    parser.add_argument("--schema", required=True, help="Schema to create the calibration tables in.")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1_000, 100_000], help="Numbers of rows to time.")
+    parser.add_argument("--repeat", type=int, default=1, help="Number of times every load is timed.")
+    parser.add_argument("--create", action="store_true", help="Create the Azure resources for the ADF transport.")
+    parser.add_argument("--path", help="Path of the calibration file.")
+    args = parser.parse_args()
+
+    calibrate(args.schema, args.rows, args.repeat, args.create, args.path)
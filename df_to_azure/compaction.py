@@ -0,0 +1,210 @@
+import logging
+import os
+import posixpath
+from datetime import datetime
+from io import BytesIO
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from azure.storage.blob import BlobServiceClient
+
+from df_to_azure.blob import (
+    DEFAULT_BLOCK_SIZE,
+    DEFAULT_MAX_CONCURRENCY,
+    DEFAULT_ROW_GROUP_SIZE,
+    BlobReader,
+    BlockBlobWriter,
+)
+from df_to_azure.manifest import Manifest, file_entry
+from df_to_azure.parquet import append_file_name, append_file_time, data_columns
+
+# Files are merged until the merged file reaches this size.
+DEFAULT_TARGET_FILE_SIZE = 256 * 1024 * 1024
+# Maximum number of blobs deleted in one batch request.
+MAX_DELETE_BATCH = 256
+
+
+def compact_parquet(
+    tablename: str,
+    folder: str,
+    container_name: str = "parquet",
+    target_file_size: int = DEFAULT_TARGET_FILE_SIZE,
+    row_group_size: int = DEFAULT_ROW_GROUP_SIZE,
+    start: datetime = None,
+    end: datetime = None,
+    block_size: int = DEFAULT_BLOCK_SIZE,
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+) -> list:
+    """
+    Merge the small files written with method append into files of about target_file_size with large row groups.
+
+    Files are merged per folder, so the partitions of a partitioned dataset stay apart. Only files smaller than
+    target_file_size whose name has a time within [start, end) are merged, so compaction can run incrementally on
+    recent files. A merged file gets the time of its first file, so it sorts and filters like the files it
+    replaces. The merged file is committed before the small files are deleted, so readers never miss rows. If
+    the process stops between the commit and the deletion, the rows of the small files are in two files until they
+    are removed. When the dataset has a manifest, the merged files replace the small files in it, with the statistics
+    of the columns the manifest had statistics of.
+
+    Parameters
+    ----------
+    tablename: str
+        Name of the dataset.
+    folder: str
+        Folder of the dataset, in df_to_azure this is the 'schema' parameter.
+    container_name: str
+        Name of the container with the dataset.
+    target_file_size: int
+        Size in bytes the merged files grow to.
+    row_group_size: int
+        Number of rows per row group of the merged files.
+    start: datetime
+        Only merge files written at or after this time.
+    end: datetime
+        Only merge files written before this time.
+    block_size: int
+        Size in bytes of the blocks for uploading the merged files.
+    max_concurrency: int
+        Number of blocks uploaded in parallel.
+
+    Returns
+    -------
+    compacted: list
+        Names of the merged files.
+    """
+    blob_service_client = BlobServiceClient.from_connection_string(
+        os.environ.get("AZURE_STORAGE_CONNECTION_STRING"), max_block_size=block_size
+    )
+    container_client = blob_service_client.get_container_client(container=container_name)
+
+    folders = {}
+    for blob in container_client.list_blobs(name_starts_with=f"{folder}/{tablename}/"):
+        file_time = append_file_time(tablename, posixpath.basename(blob.name))
+        if file_time is None or blob.size >= target_file_size:
+            continue
+        if (start is not None and file_time < start) or (end is not None and file_time >= end):
+            continue
+        folders.setdefault(posixpath.dirname(blob.name), []).append((file_time, blob))
+
+    manifest = Manifest(container_client, f"{folder}/{tablename}")
+    files_manifest, etag = manifest.read()
+
+    compacted = []
+    for blob_folder, files in folders.items():
+        files.sort(key=lambda file: (file[0], file[1].name))
+        for group in pack_files(files, target_file_size):
+            names = [blob.name for _, blob in group]
+            name = f"{blob_folder}/{append_file_name(tablename, file_time=group[0][0])}"
+            metadata, size = merge_files(container_client, names, name, row_group_size, block_size, max_concurrency)
+            if etag is not None:
+                entries = [
+                    files_manifest["files"][file_name] for file_name in names if file_name in files_manifest["files"]
+                ]
+                stats_cols = sorted({col for entry in entries for col in entry["stats"]})
+                partition = entries[0]["partition"] if entries else None
+                manifest.update(added={name: file_entry(metadata, size, stats_cols, partition)}, removed=names)
+            delete_blobs(container_client, names)
+            logging.info(f"Compacted {len(names)} files into {name}.")
+            compacted.append(name)
+
+    return compacted
+
+
+def pack_files(files: list, target_file_size: int) -> list:
+    """
+    Divide consecutive files in groups with a total size up to target_file_size, groups of one file are left out.
+
+    Parameters
+    ----------
+    files: list
+        Tuples of the time and the BlobProperties of the files, in order of time.
+    target_file_size: int
+        Maximum total size in bytes of a group.
+
+    Returns
+    -------
+    groups: list
+        Lists of files to merge.
+    """
+    groups = [[]]
+    size = 0
+    for file in files:
+        if groups[-1] and size + file[1].size > target_file_size:
+            groups.append([])
+            size = 0
+        groups[-1].append(file)
+        size += file[1].size
+
+    return [group for group in groups if len(group) > 1]
+
+
+def merge_files(
+    container_client,
+    names: list,
+    name: str,
+    row_group_size: int = DEFAULT_ROW_GROUP_SIZE,
+    block_size: int = DEFAULT_BLOCK_SIZE,
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+):
+    """
+    Write the rows of the files to one file, with row groups of row_group_size rows.
+
+    The schemas of the files are unified, so files in which a column is missing or has a narrower type are merged
+    as well. Only one small file and one row group are held in memory.
+
+    Returns
+    -------
+    metadata: pq.FileMetaData
+        Footer of the merged file.
+    size: int
+        Size in bytes of the merged file.
+    """
+    # the footers are read with ranged downloads to unify the schemas before writing
+    schemas = []
+    for file_name in names:
+        with BlobReader(container_client.get_blob_client(file_name)) as source:
+            schema = pq.read_schema(source)
+        schemas.append(pa.schema([schema.field(col) for col in data_columns(schema)]))
+    schema = pa.unify_schemas(schemas, promote_options="permissive")
+
+    pending = []
+    num_rows = 0
+    metadata = []
+    with BlockBlobWriter(
+        container_client.get_blob_client(name), block_size=block_size, max_concurrency=max_concurrency
+    ) as sink:
+        with pq.ParquetWriter(sink, schema, metadata_collector=metadata) as writer:
+            for file_name in names:
+                table = pq.read_table(BytesIO(container_client.download_blob(file_name).readall()))
+                pending.append(conform(table, schema))
+                num_rows += table.num_rows
+                if num_rows >= row_group_size:
+                    # write the full row groups, the remaining rows go into the next row group
+                    rows = pa.concat_tables(pending)
+                    full = num_rows - num_rows % row_group_size
+                    writer.write_table(rows.slice(0, full), row_group_size=row_group_size)
+                    pending = [rows.slice(full)]
+                    num_rows -= full
+            if num_rows:
+                writer.write_table(pa.concat_tables(pending), row_group_size=row_group_size)
+
+    return metadata[0], sink.tell()
+
+
+def conform(table: pa.Table, schema: pa.Schema) -> pa.Table:
+    """
+    Cast a table to the unified schema, adding the missing columns as nulls.
+    """
+    columns = [
+        table.column(field.name).cast(field.type)
+        if field.name in table.column_names
+        else pa.nulls(table.num_rows, type=field.type)
+        for field in schema
+    ]
+
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def delete_blobs(container_client, names: list):
+    for i in range(0, len(names), MAX_DELETE_BATCH):
+        container_client.delete_blobs(*names[i : i + MAX_DELETE_BATCH])
@@ -1,21 +1,41 @@
+import hashlib
 import logging
 import os
 import re
+import threading
+from functools import lru_cache
 from urllib.parse import quote_plus
 
-from sqlalchemy import create_engine
+from sqlalchemy import Engine, create_engine
 from sqlalchemy.exc import ProgrammingError
 from sqlalchemy.sql import text
 
 from df_to_azure.exceptions import DriverError, UpsertError
 
+# Extended property of the upsert procedure with the hash of its definition.
+PROCEDURE_HASH_PROPERTY = "df_to_azure_hash"
+# Milliseconds to wait for another upsert which deploys the same procedure.
+PROCEDURE_LOCK_TIMEOUT = 60_000
+# Persisted column of the staging table with a hash of the id columns, to batch upserts with composite keys.
+KEY_HASH_COLUMN = "_key_hash"
+
+
+def sql_string(value: str) -> str:
+    """
+    Unicode string literal of T-SQL, for dynamic SQL.
+    """
+    escaped = value.replace("'", "''")
+    return f"N'{escaped}'"
+
 
 class SqlUpsert:
-    def __init__(self, table_name, schema, id_cols, columns):
+    def __init__(self, table_name, schema, id_cols, columns, batch_size=None, key_hash=False):
         self.table_name = table_name
         self.schema = schema
         self.id_cols = id_cols
         self.columns = [col.strip() for col in columns]
+        self.batch_size = batch_size
+        self.key_hash = key_hash
 
     def create_on_statement(self):
         on = " AND ".join([f"s.[{id_col}] = t.[{id_col}]" for id_col in self.id_cols])
@@ -34,9 +54,12 @@ class SqlUpsert:
         return insert, values
 
     def create_merge_query(self):
+        if self.batch_size:
+            return self.create_batched_merge_query()
+
         insert = self.create_insert_statement()
         query = f"""
-        CREATE PROCEDURE [UPSERT_{self.table_name}]
+        CREATE OR ALTER PROCEDURE [UPSERT_{self.table_name}]
         AS
         MERGE {self.schema}.{self.table_name} t
             USING staging.{self.table_name} s
@@ -52,25 +75,182 @@ class SqlUpsert:
 
         return text(query)
 
+    @property
+    def batch_key(self) -> str:
+        # the key ranges of the batches are ranges of the hash, or of the first id column
+        return f"[{KEY_HASH_COLUMN}]" if self.key_hash else f"[{self.id_cols[0]}]"
+
+    def create_key_hash_statement(self) -> str:
+        values = ", ".join(f"CONVERT(nvarchar(4000), [{id_col}], 126)" for id_col in self.id_cols)
+        add_column = (
+            f"ALTER TABLE staging.{self.table_name} ADD [{KEY_HASH_COLUMN}] AS "
+            f"CAST(HASHBYTES('SHA2_256', CONCAT_WS('|', {values})) AS binary(32)) PERSISTED"
+        )
+        return f"""
+        IF COL_LENGTH(N'staging.{self.table_name}', N'{KEY_HASH_COLUMN}') IS NULL
+            EXEC({sql_string(add_column)});
+        """
+
+    def create_batch_merge_statement(self, source: str) -> str:
+        insert = self.create_insert_statement()
+        return f"""
+                MERGE {self.schema}.{self.table_name} t
+                    USING ({source}) s
+                ON {self.create_on_statement()}
+                WHEN MATCHED
+                    THEN UPDATE SET
+                        {self.create_update_statement()}
+                WHEN NOT MATCHED BY TARGET
+                    THEN INSERT {insert[0]}
+                         VALUES {insert[1]};"""
+
+    def create_batched_merge_query(self):
+        """
+        Procedure which merges the staging table in batches of batch_size rows, each batch in its own transaction.
+
+        The staging table gets a clustered index on the id columns, or on a persisted hash of the id columns when
+        key_hash. The batches are ranges of the first column of that index, so every batch is read with a seek and the
+        transaction log, locks and memory grants stay small. A failing batch is rolled back, the batches before it stay
+        committed. Rows with a null key are in no range, they are merged in a last batch. The batch loop is dynamic SQL,
+        so it is compiled after the hash column is added.
+        """
+        index_cols = f"[{KEY_HASH_COLUMN}]" if self.key_hash else ", ".join(f"[{col}]" for col in self.id_cols)
+        create_index = (
+            f"CREATE CLUSTERED INDEX [CIX_UPSERT_{self.table_name}] ON staging.{self.table_name} ({index_cols})"
+        )
+        key = self.batch_key
+        key_hash_statement = self.create_key_hash_statement() if self.key_hash else ""
+        range_source = (
+            f"SELECT s.* FROM staging.{self.table_name} s "
+            f"JOIN #upsert_batch b ON s.{key} >= b.lower AND s.{key} <= b.upper"
+        )
+        null_source = f"SELECT * FROM staging.{self.table_name} WHERE {key} IS NULL"
+        batch_loop = f"""
+            SELECT TOP (0) {key} AS lower, {key} AS upper INTO #upsert_batch FROM staging.{self.table_name};
+            INSERT INTO #upsert_batch (lower, upper) SELECT MIN({key}), NULL FROM staging.{self.table_name};
+            WHILE (SELECT lower FROM #upsert_batch) IS NOT NULL
+            BEGIN
+                UPDATE #upsert_batch SET upper = (
+                    SELECT MAX(n.k) FROM (
+                        SELECT TOP (@batch_size) s.{key} AS k
+                        FROM staging.{self.table_name} s JOIN #upsert_batch b ON s.{key} >= b.lower
+                        ORDER BY s.{key}
+                    ) n
+                );
+                BEGIN TRANSACTION;{self.create_batch_merge_statement(range_source)}
+                COMMIT TRANSACTION;
+                UPDATE #upsert_batch SET lower = (
+                    SELECT MIN(s.{key}) FROM staging.{self.table_name} s JOIN #upsert_batch b ON s.{key} > b.upper
+                );
+            END
+            IF EXISTS ({null_source})
+            BEGIN
+                BEGIN TRANSACTION;{self.create_batch_merge_statement(null_source)}
+                COMMIT TRANSACTION;
+            END
+            """
+        query = f"""
+        CREATE OR ALTER PROCEDURE [UPSERT_{self.table_name}]
+        AS
+        SET NOCOUNT ON;
+        SET XACT_ABORT ON;
+        {key_hash_statement}
+        IF NOT EXISTS (
+            SELECT * FROM sys.indexes
+            WHERE object_id = OBJECT_ID(N'staging.{self.table_name}') AND name = N'CIX_UPSERT_{self.table_name}'
+        )
+            EXEC({sql_string(create_index)});
+        EXEC sp_executesql {sql_string(batch_loop)}, N'@batch_size int', @batch_size = {int(self.batch_size)};
+        """
+        logging.debug(query)
+
+        return text(query)
+
     def drop_procedure(self):
         query = f"DROP PROCEDURE IF EXISTS [UPSERT_{self.table_name}];"
         return text(query)
 
+    @staticmethod
+    def definition_hash(query) -> str:
+        """
+        Hash of the procedure definition, which covers the schema, key columns and columns.
+        """
+        return hashlib.sha256(query.text.encode()).hexdigest()
+
+    def select_hash(self):
+        query = f"""
+        SELECT CAST(value AS nvarchar(64))
+        FROM sys.extended_properties
+        WHERE class = 1
+            AND major_id = OBJECT_ID(N'[UPSERT_{self.table_name}]')
+            AND minor_id = 0
+            AND name = N'{PROCEDURE_HASH_PROPERTY}';
+        """
+        return text(query)
+
+    def set_hash(self, definition_hash: str):
+        properties = (
+            f"@name = N'{PROCEDURE_HASH_PROPERTY}', @value = N'{definition_hash}', @level0type = N'SCHEMA', "
+            f"@level0name = @schema, @level1type = N'PROCEDURE', @level1name = N'UPSERT_{self.table_name}'"
+        )
+        query = f"""
+        DECLARE @schema sysname = OBJECT_SCHEMA_NAME(OBJECT_ID(N'[UPSERT_{self.table_name}]'));
+        IF EXISTS (
+            SELECT * FROM sys.extended_properties
+            WHERE class = 1
+                AND major_id = OBJECT_ID(N'[UPSERT_{self.table_name}]')
+                AND minor_id = 0
+                AND name = N'{PROCEDURE_HASH_PROPERTY}'
+        )
+            EXEC sp_updateextendedproperty {properties};
+        ELSE
+            EXEC sp_addextendedproperty {properties};
+        """
+        return text(query)
+
+    def lock_procedure(self):
+        """
+        Application lock on the procedure, held until the transaction ends.
+        """
+        query = f"""
+        DECLARE @result int;
+        EXEC @result = sp_getapplock
+            @Resource = N'UPSERT_{self.table_name}',
+            @LockMode = N'Exclusive',
+            @LockOwner = N'Transaction',
+            @LockTimeout = {PROCEDURE_LOCK_TIMEOUT};
+        IF @result < 0
+            THROW 50000, N'Could not lock the deployment of procedure UPSERT_{self.table_name}.', 1;
+        """
+        return text(query)
+
     def create_stored_procedure(self):
+        """
+        Create the upsert procedure, or alter it when its definition changed.
+
+        The hash of the definition is stored in an extended property of the procedure. When the deployed procedure has
+        the same hash no DDL is executed, so upserts with a stable schema keep the cached plan of the procedure and do
+        not take schema locks. The check and the deployment are done under an application lock, so concurrent
+        upserts into the same table deploy the procedure once and the others find the new hash.
+        """
+        query_create_merge = self.create_merge_query()
+        definition_hash = self.definition_hash(query_create_merge)
         with auth_azure() as con:
-            t = con.begin()
-            query_drop_procedure = self.drop_procedure()
-            con.execute(query_drop_procedure)
-            query_create_merge = self.create_merge_query()
-            try:
-                con.execute(query_create_merge)
-                t.commit()
-            except ProgrammingError:
-                raise UpsertError(
-                    "During upsert there has been an issue. One of the sources could be that the table in"
-                    " staging has columns that do not match the table you want to upsert. Remove the "
-                    f"staging table {self.table_name} manually in that case"
-                )
+            with con.begin():
+                con.execute(self.lock_procedure())
+                if con.execute(self.select_hash()).scalar() == definition_hash:
+                    logging.debug(f"Procedure UPSERT_{self.table_name} is up to date.")
+                    return
+                try:
+                    con.execute(query_create_merge)
+                except ProgrammingError:
+                    raise UpsertError(
+                        "During upsert there has been an issue. One of the sources could be that the table in"
+                        " staging has columns that do not match the table you want to upsert. Remove the "
+                        f"staging table {self.table_name} manually in that case"
+                    )
+                con.execute(self.set_hash(definition_hash))
+            logging.info(f"Deployed procedure UPSERT_{self.table_name}.")
 
 
 def get_sql_driver() -> str:
@@ -85,9 +265,36 @@ def get_sql_driver() -> str:
     return sql_driver
 
 
-def auth_azure(driver: str = None):
+@lru_cache(maxsize=None)
+def cached_sql_driver() -> str:
+    """Look up the ODBC driver once per process, enumerating the drivers is slow."""
+    return get_sql_driver()
+
+
+# Engines per connection string, shared by all calls in this process so connections stay warm in the pool.
+_ENGINES = {}
+_ENGINES_LOCK = threading.Lock()
+
+
+def get_engine(driver: str = None) -> Engine:
+    """
+    Get the SQLAlchemy engine for the database in the environment variables.
+
+    Engines are created once per connection string and reused, with a connection pool which checks connections
+    before use and recycles them before Azure SQL closes idle connections.
+
+    Parameters
+    ----------
+    driver: str
+        ODBC driver to use, defaults to the latest installed SQL Server driver.
+
+    Returns
+    -------
+    engine: Engine
+        Engine with a warm connection pool.
+    """
     if driver is None:
-        driver = get_sql_driver()
+        driver = cached_sql_driver()
 
     connection_string = "mssql+pyodbc://{}:{}@{}:1433/{}?driver={}".format(
         os.environ.get("SQL_USER"),
@@ -96,12 +303,36 @@ def auth_azure(driver: str = None):
         os.environ.get("SQL_DB"),
         driver,
     )
-    con = create_engine(connection_string).connect()
+    with _ENGINES_LOCK:
+        engine = _ENGINES.get(connection_string)
+        if engine is None:
+            engine = create_engine(
+                connection_string,
+                pool_size=5,
+                max_overflow=10,
+                pool_pre_ping=True,
+                pool_recycle=1800,
+            )
+            _ENGINES[connection_string] = engine
+
+    return engine
+
+
+def dispose_engines():
+    """Close all pooled connections, for example after forking a process."""
+    with _ENGINES_LOCK:
+        for engine in _ENGINES.values():
+            engine.dispose()
+        _ENGINES.clear()
+
+
+def auth_azure(driver: str = None):
+    con = get_engine(driver).connect()
 
     return con
 
 
-def execute_stmt(stmt: str):
+def execute_stmt(stmt: str, autocommit: bool = False):
     """
     Execute SQL query
 
@@ -109,11 +340,16 @@ def execute_stmt(stmt: str):
     ----------
     stmt: str
         SQL query statement.
+    autocommit: bool
+        Execute the statement outside a transaction, for procedures which commit their own transactions.
     Returns
     -------
 
     """
 
     with auth_azure() as con:
+        if autocommit:
+            con.execution_options(isolation_level="AUTOCOMMIT").execute(text(stmt))
+            return
         with con.begin():
             con.execute(text(stmt))
@@ -36,6 +36,12 @@ class UpsertError(Exception):
     pass
 
 
+class ConcurrentWriteError(Exception):
+    """A blob kept being changed by other writers during a conditional write"""
+
+    pass
+
+
 class DriverError(Exception):
     """Can't find correct odbc driver"""
 
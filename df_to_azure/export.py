@@ -1,19 +1,78 @@
+import hashlib
+import json
 import logging
 import os
-from datetime import datetime
-from io import BytesIO
+import posixpath
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
 from typing import Union
 
 import azure.core.exceptions
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from azure.core import MatchConditions
+from azure.identity import ClientSecretCredential
+from azure.mgmt.datafactory import DataFactoryManagementClient
+from azure.mgmt.datafactory.models import PipelineResource
 from azure.storage.blob import BlobServiceClient
 from pandas import CategoricalDtype, DataFrame
-from pandas.api.types import is_bool_dtype, is_datetime64_any_dtype, is_float_dtype, is_integer_dtype, is_string_dtype
-from sqlalchemy.types import BigInteger, Boolean, DateTime, Integer, Numeric, String, TypeEngine
+from pandas.api.types import (
+    is_bool_dtype,
+    is_datetime64_any_dtype,
+    is_float_dtype,
+    is_integer_dtype,
+    is_string_dtype,
+    is_timedelta64_dtype,
+)
+from sqlalchemy.sql import text
+from sqlalchemy.types import BigInteger, Boolean, DateTime, Float, Integer, Numeric, String, TypeEngine
 
 from df_to_azure.adf import ADF
+from df_to_azure.blob import (
+    DEFAULT_BLOCK_SIZE,
+    DEFAULT_MAX_CONCURRENCY,
+    DEFAULT_MAX_SINGLE_PUT_SIZE,
+    DEFAULT_ROW_GROUP_SIZE,
+    BlobReader,
+    BlockBlobWriter,
+    conflict_backoff,
+    download_to_buffer,
+    stream_parquet_to_blob,
+    to_arrow_table,
+    to_parquet_buffer,
+    upload_data,
+)
+from df_to_azure.cache import DEFAULT_CACHE_SIZE, BlobCache
 from df_to_azure.db import SqlUpsert, auth_azure, execute_stmt
-from df_to_azure.exceptions import WrongDtypeError
+from df_to_azure.exceptions import ConcurrentWriteError, WrongDtypeError
+from df_to_azure.manifest import MANIFEST_FILE, Manifest, file_entry
+from df_to_azure.parquet import (
+    BUCKET_HASH,
+    BUCKETING_FILE,
+    DEFAULT_MAX_UPSERT_ATTEMPTS,
+    UPSERT_ENGINES,
+    append_file_name,
+    arrow_upsert,
+    bucket_numbers,
+    bucketing_metadata,
+    data_columns,
+    partition_path,
+    sort_merge_upsert,
+    table_to_parquet,
+)
+from df_to_azure.provisioning import ProvisioningCache
+from df_to_azure.transport import (
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_MAX_CONNECTIONS,
+    TRANSPORTS,
+    BulkInsert,
+    CostModel,
+    ExternalDataSource,
+    bulk_insert_statement,
+    write_csv,
+)
 from df_to_azure.utils import test_unique_column_names, test_uniqueness_columns, wait_until_pipeline_is_done
 
 
@@ -32,6 +91,26 @@ def df_to_azure(
     parquet=False,
     clean_staging=True,
     container_name="parquet",
+    streaming=False,
+    row_group_size=DEFAULT_ROW_GROUP_SIZE,
+    block_size=DEFAULT_BLOCK_SIZE,
+    max_concurrency=DEFAULT_MAX_CONCURRENCY,
+    max_single_put_size=DEFAULT_MAX_SINGLE_PUT_SIZE,
+    adaptive_upload=False,
+    provisioning_cache=False,
+    generic_pipeline=False,
+    upsert_engine="pandas",
+    partition_cols=None,
+    buckets=None,
+    manifest=False,
+    max_upsert_attempts=DEFAULT_MAX_UPSERT_ATTEMPTS,
+    cache_dir=None,
+    cache_size=DEFAULT_CACHE_SIZE,
+    transport="adf",
+    batch_size=DEFAULT_BATCH_SIZE,
+    max_connections=DEFAULT_MAX_CONNECTIONS,
+    upsert_batch_size=None,
+    upsert_key_hash=False,
 ):
     if parquet:
         DfToParquet(
@@ -41,6 +120,17 @@ def df_to_azure(
             method=method,
             id_field=id_field,
             container_name=container_name,
+            block_size=block_size,
+            max_concurrency=max_concurrency,
+            max_single_put_size=max_single_put_size,
+            adaptive_upload=adaptive_upload,
+            upsert_engine=upsert_engine,
+            partition_cols=partition_cols,
+            buckets=buckets,
+            manifest=manifest,
+            max_upsert_attempts=max_upsert_attempts,
+            cache_dir=cache_dir,
+            cache_size=cache_size,
         ).run()
         return None
     else:
@@ -57,11 +147,116 @@ def df_to_azure(
             create=create,
             dtypes=dtypes,
             clean_staging=clean_staging,
+            streaming=streaming,
+            row_group_size=row_group_size,
+            block_size=block_size,
+            max_concurrency=max_concurrency,
+            max_single_put_size=max_single_put_size,
+            adaptive_upload=adaptive_upload,
+            provisioning_cache=provisioning_cache,
+            generic_pipeline=generic_pipeline,
+            transport=transport,
+            batch_size=batch_size,
+            max_connections=max_connections,
+            upsert_batch_size=upsert_batch_size,
+            upsert_key_hash=upsert_key_hash,
         ).run()
 
         return adf_client, run_response
 
 
+def df_to_azure_many(
+    tables,
+    schema,
+    method="create",
+    id_field=None,
+    wait_till_finished=False,
+    pipeline_name=None,
+    create=False,
+    clean_staging=True,
+    max_workers=8,
+    **kwargs,
+):
+    """
+    Export multiple DataFrames to Azure SQL with a single pipeline run.
+
+    The parquet files are uploaded concurrently and one pipeline is created with a copy activity per table, followed
+    by the upsert procedure of that table if the method is upsert.
+
+    Parameters
+    ----------
+    tables: dict
+        Mapping of tablename to a DataFrame, or to a dict with key "df" and optionally "schema", "method", "id_field",
+        "dtypes", "text_length" and "decimal_precision" to override the arguments for that table.
+    schema: str
+        Default schema of the tables.
+    method: str
+        Default method, create, append or upsert.
+    id_field: str or list
+        Default id field for upserts.
+    wait_till_finished: bool
+        Wait until the pipeline run is finished.
+    pipeline_name: str
+        Name of the pipeline, defaults to a name derived from the tables.
+    create: bool
+        Create the resource group, data factory and blob container.
+    clean_staging: bool
+        Drop the staging tables after upserting.
+    max_workers: int
+        Number of tables which are prepared and uploaded in parallel.
+    kwargs
+        Other arguments of df_to_azure which are used for all tables.
+
+    Returns
+    -------
+    adf_client, run_response
+    """
+    adf_client, run_response = DfToAzureBatch(
+        tables=tables,
+        schema=schema,
+        method=method,
+        id_field=id_field,
+        wait_till_finished=wait_till_finished,
+        pipeline_name=pipeline_name,
+        create=create,
+        clean_staging=clean_staging,
+        max_workers=max_workers,
+        **kwargs,
+    ).run()
+
+    return adf_client, run_response
+
+
+def max_str_len(col: pd.Series) -> int:
+    """
+    Maximum number of characters of the values in a column, nulls are skipped.
+
+    Lengths are computed with pyarrow in one pass without creating a Python string per value. Of a categorical
+    column only the categories are inspected.
+
+    Parameters
+    ----------
+    col: pd.Series
+        Column with strings, or other values which are measured by their string representation.
+
+    Returns
+    -------
+    max_len: int
+        Maximum length, 0 when the column only has nulls.
+    """
+    values = col.cat.categories if isinstance(col.dtype, CategoricalDtype) else col
+    try:
+        arr = pa.array(values, from_pandas=True)
+        if not (pa.types.is_string(arr.type) or pa.types.is_large_string(arr.type)):
+            arr = pc.cast(arr, pa.large_string())
+        max_len = pc.max(pc.utf8_length(arr)).as_py()
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError):
+        # mixed types, fall back to the string representation of each value
+        max_len = pd.Series(values).dropna().astype(str).str.len().max()
+
+    return 0 if max_len is None or pd.isna(max_len) else int(max_len)
+
+
 class DfToAzure(ADF):
     def __init__(
         self,
@@ -77,6 +272,21 @@ class DfToAzure(ADF):
         create: bool = False,
         dtypes: dict = None,
         clean_staging: bool = True,
+        streaming: bool = False,
+        row_group_size: int = DEFAULT_ROW_GROUP_SIZE,
+        block_size: int = DEFAULT_BLOCK_SIZE,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        max_single_put_size: int = DEFAULT_MAX_SINGLE_PUT_SIZE,
+        adaptive_upload: bool = False,
+        provisioning_cache: Union[bool, ProvisioningCache] = False,
+        generic_pipeline: bool = False,
+        transport: str = "adf",
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        max_connections: int = DEFAULT_MAX_CONNECTIONS,
+        upsert_batch_size: int = None,
+        upsert_key_hash: bool = False,
+        credentials: ClientSecretCredential = None,
+        adf_client: DataFactoryManagementClient = None,
     ):
         super().__init__(
             df=df,
@@ -86,34 +296,67 @@ class DfToAzure(ADF):
             id_field=id_field,
             pipeline_name=pipeline_name,
             create=create,
+            provisioning_cache=provisioning_cache,
+            credentials=credentials,
+            adf_client=adf_client,
         )
         self.wait_till_finished = wait_till_finished
         self.text_length = text_length
         self.decimal_precision = decimal_precision
         self.dtypes = dtypes
         self.clean_staging = clean_staging
+        self.streaming = streaming
+        self.row_group_size = row_group_size
+        self.block_size = block_size
+        self.max_concurrency = max_concurrency
+        self.max_single_put_size = max_single_put_size
+        self.adaptive_upload = adaptive_upload
+        self.generic_pipeline = generic_pipeline
+        self.transport = transport
+        self.batch_size = batch_size
+        self.max_connections = max_connections
+        self.upsert_batch_size = upsert_batch_size
+        self.upsert_key_hash = upsert_key_hash
+        # schemas which are known to exist, shared by the tables of a batch
+        self.created_schemas = set()
+        if self.transport not in (*TRANSPORTS, "auto"):
+            raise ValueError(
+                f"No valid transport given: {self.transport}. choose from {', '.join(TRANSPORTS)} or auto."
+            )
+        if self.transport == "auto":
+            self.transport = CostModel.load().choose(self.df)
 
     def run(self):
         if self.df.empty:
             logging.info("Data empty, no new records to upload.")
             return None, None
 
+        if self.transport != "adf":
+            self.run_bulk_insert()
+            return None, None
+
         if self.create:
             # azure components
             self.create_resourcegroup()
             self.create_datafactory()
             self.create_blob_container()
 
-        # linked services
-        self.create_linked_service_sql()
-        self.create_linked_service_blob()
+        if self.generic_pipeline:
+            # one parameterized pipeline for all tables, only deployed when it does not exist yet
+            self.create_generic_pipelines()
+            self.upload_dataset()
+            run_response = self.create_generic_pipeline_run()
+        else:
+            # linked services
+            self.create_linked_service_sql()
+            self.create_linked_service_blob()
 
-        self.upload_dataset()
-        self.create_input_blob()
-        self.create_output_sql()
+            self.upload_dataset()
+            self.create_input_blob()
+            self.create_output_sql()
 
-        # pipelines
-        run_response = self.create_pipeline(pipeline_name=self.pipeline_name)
+            # pipelines
+            run_response = self.create_pipeline(pipeline_name=self.pipeline_name)
         if self.wait_till_finished:
             wait_until_pipeline_is_done(self.adf_client, run_response)
         if self.clean_staging & (self.method == "upsert"):
@@ -127,12 +370,56 @@ class DfToAzure(ADF):
 
         return self.adf_client, run_response
 
+    def run_bulk_insert(self):
+        """
+        Load the rows without an ADF pipeline, which saves the queueing and start-up of the pipeline. With the
+        bulk_insert transport the rows are inserted over the database connection, with blob_bulk_insert the database
+        reads a CSV file from blob storage with BULK INSERT. The tables are prepared and the upsert procedure is run
+        like with the pipeline.
+        """
+        self.prepare_tables()
+        if self.transport == "blob_bulk_insert":
+            if self.create:
+                self.create_blob_container()
+            self.upload_to_blob()
+            logging.info(f"Finished exporting {self.df.shape[0]} records to Azure Blob Storage.")
+            data_source = ExternalDataSource(self.ls_blob_account_name, os.environ.get("ls_blob_account_key"))
+            data_source.create()
+            execute_stmt(
+                bulk_insert_statement(self.schema, self.table_name, self.blob_name, data_source.name, self.batch_size)
+            )
+            logging.info(f"Bulk inserted {self.df.shape[0]} records into {self.schema}.{self.table_name}.")
+        else:
+            col_types = self.table_types()
+            BulkInsert(
+                schema=self.schema,
+                table_name=self.table_name,
+                sql_types={col: col_types[col] for col in self.df.columns},
+                batch_size=self.batch_size,
+                max_connections=self.max_connections,
+            ).run(to_arrow_table(self.df, self.arrow_schema()))
+
+        if self.method == "upsert":
+            # outside a transaction, a batched upsert commits every batch itself
+            execute_stmt(f"EXEC [UPSERT_{self.table_name}]", autocommit=True)
+            logging.info(f"Upserted {self.df.shape[0]} records into {self.table_name}.")
+            if self.clean_staging:
+                self.clean_staging_after_upsert()
+
     def _checks(self):
         if self.dtypes:
             if not all([type(given_type) == TypeEngine for given_type in self.dtypes.keys()]):
                 WrongDtypeError("Wrong dtype given, only SqlAlchemy types are accepted")
 
     def upload_dataset(self):
+        self.prepare_tables()
+        self.upload_to_blob()
+        logging.info(f"Finished exporting {self.df.shape[0]} records to Azure Blob Storage.")
+
+    def prepare_tables(self):
+        """
+        Create the table in SQL to copy the data to, for upserts the table in staging and the upsert procedure.
+        """
         if self.method == "create":
             self.create_schema()
             self.push_to_azure()
@@ -144,23 +431,47 @@ class DfToAzure(ADF):
                 schema=self.schema,
                 id_cols=self.id_field,
                 columns=self.df.columns,
+                batch_size=self.upsert_batch_size,
+                key_hash=self.upsert_key_hash,
             )
             upsert.create_stored_procedure()
             self.schema = "staging"
             self.create_schema()
             self.push_to_azure()
 
-        self.upload_to_blob()
-        logging.info(f"Finished exporting {self.df.shape[0]} records to Azure Blob Storage.")
+    def table_columns(self) -> list:
+        """
+        Columns of the table in SQL in their order, which must be the same set as the columns of the DataFrame.
+        """
+        query = text(
+            "SELECT COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS "
+            "WHERE TABLE_SCHEMA = :schema AND TABLE_NAME = :table_name ORDER BY ORDINAL_POSITION"
+        )
+        with auth_azure() as con:
+            columns = list(con.execute(query, {"schema": self.schema, "table_name": self.table_name}).scalars())
+
+        diff_cols = set(columns).symmetric_difference(self.df.columns)
+        if diff_cols:
+            raise ValueError(
+                f"Columns of {self.schema}.{self.table_name} must be equal to the columns of the DataFrame. "
+                f"Difference in columns: {', '.join(sorted(diff_cols))}"
+            )
+
+        return columns
+
+    def table_types(self) -> dict:
+        """
+        SQL types of the columns of the table, with the string lengths of the data.
+        """
+        col_types = self.sql_types()
+        col_types.update(self.get_max_str_len())
+        if self.dtypes:
+            col_types.update(self.dtypes)
+
+        return col_types
 
     def push_to_azure(self):
-        self.convert_timedelta_to_seconds()
-        max_str = self.get_max_str_len()
-        bigint = self.check_for_bigint()
-        dtypes_given = {} if self.dtypes is None else self.dtypes
-        col_types = self.column_types()
-        for u in [max_str, bigint, dtypes_given]:
-            col_types.update(u)
+        col_types = self.table_types()
 
         with auth_azure() as con:
             self.df.head(n=0).to_sql(
@@ -175,45 +486,110 @@ class DfToAzure(ADF):
         logging.info(f"Created {self.df.shape[1]} columns in {self.schema}.{self.table_name}.")
 
     def upload_to_blob(self):
-        blob_client = self.blob_service_client()
-        blob_client = blob_client.get_blob_client(
-            container="dftoazure",
-            blob=f"{self.table_name}/{self.table_name}.parquet",
+        blob_client = self.blob_service_client(
+            max_block_size=self.block_size, max_single_put_size=self.max_single_put_size
         )
+        blob_client = blob_client.get_blob_client(container="dftoazure", blob=self.blob_name)
 
-        # This is needed because ADF converts datetime to Unix Epoch
-        #   resulting in INT64 type,
-        #   which conflicts with our Datetime column in the database
-        #   https://shorturl.at/dtSm6
-        datetime_dtypes = self.df.select_dtypes("datetime")
-        if datetime_dtypes.empty is False:
-            for col in datetime_dtypes.columns:
-                self.df[col] = self.df[col].astype(str).replace("NaT", None)
-        data = self.df.to_parquet(index=False)
-        blob_client.upload_blob(data, overwrite=True)
-
-    def create_schema(self):
-        query = f"""
-        IF NOT EXISTS (SELECT * FROM sys.schemas WHERE name = N'{self.schema}')
-        EXEC('CREATE SCHEMA [{self.schema}]');
+        if self.transport == "blob_bulk_insert":
+            # BULK INSERT in Azure SQL reads CSV, not parquet, and maps its fields to the columns of the table by
+            # position, so the fields are written in the order of the table
+            schema = self.arrow_schema()
+            schema = pa.schema([schema.field(col) for col in self.table_columns()])
+            with BlockBlobWriter(
+                blob_client,
+                block_size=self.block_size,
+                max_concurrency=self.max_concurrency,
+                adaptive=self.adaptive_upload,
+            ) as sink:
+                write_csv(self.df, sink, schema=schema, chunk_size=self.row_group_size)
+        elif self.streaming:
+            # Write row groups as staged blocks, so we never hold the complete parquet file in memory
+            stream_parquet_to_blob(
+                self.df,
+                blob_client,
+                schema=self.arrow_schema(),
+                row_group_size=self.row_group_size,
+                block_size=self.block_size,
+                max_concurrency=self.max_concurrency,
+                adaptive=self.adaptive_upload,
+            )
+        else:
+            upload_data(
+                blob_client,
+                self.parquet_data(),
+                max_concurrency=self.max_concurrency,
+                block_size=self.block_size,
+                max_single_put_size=self.max_single_put_size,
+                adaptive=self.adaptive_upload,
+            )
+
+    @property
+    def blob_name(self) -> str:
+        extension = "csv" if self.transport == "blob_bulk_insert" else "parquet"
+        return f"{self.table_name}/{self.table_name}.{extension}"
+
+    def arrow_schema(self) -> pa.Schema:
         """
-        execute_stmt(query)
+        Arrow schema of the parquet file, aligned with the SQL types of the table.
 
-    def convert_timedelta_to_seconds(self):
+        ADF reads parquet timestamps in nanoseconds as INT64, so timestamps are written in microseconds, which ADF maps
+        to datetime. Numeric columns are written as decimals with the precision and scale of the SQL column, so the
+        parquet maps onto the table without conversions.
+
+        Returns
+        -------
+        schema: pa.Schema
+            Schema with a field for every column.
         """
-        We convert timedelta columns to seconds since this will error in SQL DB.
-        If there are no timedelta columns, nothing will happen.
+        inferred = pa.Schema.from_pandas(self.df.iloc[:0], preserve_index=False)
+        fields = []
+        for col_name, sql_type in self.sql_types().items():
+            col_type = self.df[col_name].dtype
+            if isinstance(sql_type, String):
+                arrow_type = pa.string()
+            elif isinstance(sql_type, Boolean):
+                arrow_type = pa.bool_()
+            elif isinstance(sql_type, (Integer, BigInteger)):
+                arrow_type = pa.int64()
+            elif isinstance(sql_type, Float):
+                arrow_type = pa.float64()
+            elif isinstance(sql_type, Numeric):
+                arrow_type = pa.decimal128(sql_type.precision, sql_type.scale)
+            elif isinstance(sql_type, DateTime):
+                arrow_type = pa.timestamp("us", tz=getattr(col_type, "tz", None))
+            else:
+                arrow_type = inferred.field(col_name).type
+                if pa.types.is_null(arrow_type):
+                    arrow_type = pa.string()
+            fields.append(pa.field(col_name, arrow_type))
 
-        Parameters
-        ----------
-        self.df: DataFrame
-            DataFrame to convert timedelta columns to seconds
+        return pa.schema(fields)
+
+    def parquet_data(self) -> pa.Buffer:
+        return to_parquet_buffer(self.df, self.arrow_schema())
 
+    def create_schema(self, schema: str = None):
+        schema = schema or self.schema
+        if schema in self.created_schemas:
+            return
+        query = f"""
+        IF NOT EXISTS (SELECT * FROM sys.schemas WHERE name = N'{schema}')
+        EXEC('CREATE SCHEMA [{schema}]');
         """
-        td_cols = self.df.iloc[:1].select_dtypes("timedelta").columns
+        execute_stmt(query)
+        self.created_schemas.add(schema)
 
-        if len(td_cols):
-            self.df[td_cols] = self.df[td_cols].apply(lambda x: x.dt.total_seconds())
+    def sql_types(self) -> dict:
+        """
+        SQL types of the columns, the inferred types overridden by the given dtypes.
+        """
+        col_types = self.column_types()
+        col_types.update(self.check_for_bigint())
+        if self.dtypes:
+            col_types.update(self.dtypes)
+
+        return col_types
 
     def column_types(self) -> dict:
         """
@@ -238,6 +614,9 @@ class DfToAzure(ADF):
                 return numeric
             elif is_datetime64_any_dtype(col_type):
                 return DateTime()
+            elif is_timedelta64_dtype(col_type):
+                # timedeltas are exported as seconds
+                return numeric
             elif isinstance(col_type, CategoricalDtype):
                 return string
             else:
@@ -250,13 +629,15 @@ class DfToAzure(ADF):
         return col_types
 
     def get_max_str_len(self):
-        df = self.df.select_dtypes("object")
+        str_cols = self.df.iloc[:0].select_dtypes(["object", "string", "category"]).columns
         default_len = self.text_length
 
         update_dict_len = {}
-        if not df.empty:
-            for col in df.columns:
-                len_col = df[col].astype(str).str.len().max()
+        if len(str_cols):
+            # pyarrow releases the GIL while computing, so the columns are measured in parallel
+            with ThreadPoolExecutor(max_workers=min(len(str_cols), os.cpu_count() or 1)) as executor:
+                lengths = dict(zip(str_cols, executor.map(max_str_len, (self.df[col] for col in str_cols))))
+            for col, len_col in lengths.items():
                 if default_len < len_col < 8000:
                     update_dict_len[col] = String(length=int(len_col))
                 elif len_col > 8000:
@@ -267,15 +648,14 @@ class DfToAzure(ADF):
         return update_dict_len
 
     def check_for_bigint(self):
-        ints = self.df.select_dtypes(include=["int8", "int16", "int32", "int64"])
-        if ints.empty:
+        int_cols = self.df.iloc[:0].select_dtypes(include=["int8", "int16", "int32", "int64"]).columns
+        if not len(int_cols):
             return {}
 
         # These are the highest and lowest number
         # which can be stored in an integer column in SQL.
         # For numbers out of these bounds, we convert to bigint
-        check = (ints.lt(-2147483648) | ints.gt(2147483647)).any()
-        cols_bigint = check[check].index.tolist()
+        cols_bigint = [col for col in int_cols if self.df[col].min() < -2147483648 or self.df[col].max() > 2147483647]
 
         update_dict_bigint = {col: BigInteger() for col in cols_bigint}
 
@@ -292,6 +672,128 @@ class DfToAzure(ADF):
         execute_stmt(query)
 
 
+class DfToAzureBatch:
+    """
+    Export multiple DataFrames to Azure SQL with one pipeline containing a copy activity per table.
+    """
+
+    table_options = ("schema", "method", "id_field", "dtypes", "text_length", "decimal_precision")
+
+    def __init__(
+        self,
+        tables: dict,
+        schema: str,
+        method: str = "create",
+        id_field: Union[str, list] = None,
+        wait_till_finished: bool = False,
+        pipeline_name: str = None,
+        create: bool = False,
+        clean_staging: bool = True,
+        max_workers: int = 8,
+        **kwargs,
+    ):
+        self.wait_till_finished = wait_till_finished
+        self.pipeline_name = pipeline_name
+        self.create = create
+        self.clean_staging = clean_staging
+        self.max_workers = max_workers
+        self.credentials = ADF.create_credentials()
+        self.adf_client = DataFactoryManagementClient(self.credentials, os.environ.get("subscription_id"))
+        self.exports = []
+        for tablename, options in tables.items():
+            if isinstance(options, DataFrame):
+                options = {"df": options}
+            unknown = set(options) - {"df", *self.table_options}
+            if unknown:
+                raise ValueError(f"Unknown options for table {tablename}: {', '.join(sorted(unknown))}")
+            table_kwargs = {**kwargs, "schema": schema, "method": method, "id_field": id_field, **options}
+            if table_kwargs["df"].empty:
+                logging.info(f"Data empty for {tablename}, no new records to upload.")
+                continue
+            self.exports.append(
+                DfToAzure(
+                    tablename=tablename,
+                    clean_staging=clean_staging,
+                    create=create,
+                    credentials=self.credentials,
+                    adf_client=self.adf_client,
+                    **table_kwargs,
+                )
+            )
+
+    def default_pipeline_name(self) -> str:
+        # Same set of tables gives the same pipeline, different batches do not overwrite each other
+        tables = sorted(f"{export.schema}.{export.table_name}" for export in self.exports)
+        return f"dftoazure batch {hashlib.sha1(','.join(tables).encode()).hexdigest()[:10]} to SQL"
+
+    def create_schemas(self):
+        """
+        Create the schemas of the tables, and the staging schema for upserts, once before the tables are prepared in
+        parallel, instead of every table checking and creating its schema at the same time.
+        """
+        schemas = {
+            "staging" if export.method == "upsert" else export.schema
+            for export in self.exports
+            if export.method in ("create", "upsert")
+        }
+        created_schemas = set()
+        for export in self.exports:
+            export.created_schemas = created_schemas
+        for schema in sorted(schemas):
+            self.exports[0].create_schema(schema)
+
+    def prepare(self, export: DfToAzure):
+        export.upload_dataset()
+        export.create_input_blob()
+        export.create_output_sql()
+
+    def run(self):
+        self.create_schemas()
+        direct = [export for export in self.exports if export.transport != "adf"]
+        if direct:
+            # tables with another transport are loaded without the pipeline
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                list(executor.map(lambda export: export.run(), direct))
+            self.exports = [export for export in self.exports if export.transport == "adf"]
+
+        if not self.exports:
+            if not direct:
+                logging.info("Data empty, no new records to upload.")
+            return None, None
+
+        first = self.exports[0]
+        for export in self.exports:
+            # the resources of all tables are deployed again when the run of the batch pipeline does not find one
+            export.deployments = first.deployments
+        if self.create:
+            first.create_resourcegroup()
+            first.create_datafactory()
+            first.create_blob_container()
+        first.create_linked_service_sql()
+        first.create_linked_service_blob()
+        pipeline_name = self.pipeline_name or self.default_pipeline_name()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            # list() raises the first exception of a failed table
+            list(executor.map(self.prepare, self.exports))
+
+        activities = []
+        for export in self.exports:
+            activities.append(export.create_copy_activity())
+            if export.method == "upsert":
+                activities.append(export.stored_procedure_activity(name=f"UPSERT {export.table_name}"))
+        run_response = first.run_pipeline(pipeline_name, PipelineResource(activities=activities, parameters={}))
+
+        upserts = [export for export in self.exports if export.method == "upsert"]
+        if self.wait_till_finished or (self.clean_staging and upserts):
+            wait_until_pipeline_is_done(first.adf_client, run_response)
+        if self.clean_staging:
+            for export in upserts:
+                export.clean_staging_after_upsert()
+
+        return first.adf_client, run_response
+
+
 class DfToParquet:
     """
     This class is intended for uploading a dataframe to the blob container "parquet". The dataframe will be stored in
@@ -300,7 +802,24 @@ class DfToParquet:
     """
 
     def __init__(
-        self, df: pd.DataFrame, tablename: str, folder: str, method: str, container_name: str, id_field: list = None
+        self,
+        df: pd.DataFrame,
+        tablename: str,
+        folder: str,
+        method: str,
+        container_name: str,
+        id_field: list = None,
+        block_size: int = DEFAULT_BLOCK_SIZE,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        max_single_put_size: int = DEFAULT_MAX_SINGLE_PUT_SIZE,
+        adaptive_upload: bool = False,
+        upsert_engine: str = "pandas",
+        partition_cols: list = None,
+        buckets: int = None,
+        manifest: bool = False,
+        max_upsert_attempts: int = DEFAULT_MAX_UPSERT_ATTEMPTS,
+        cache_dir: str = None,
+        cache_size: int = DEFAULT_CACHE_SIZE,
     ):
         """
 
@@ -318,27 +837,78 @@ class DfToParquet:
             Name of the container to write the parquet to
         id_field: list
             Keys to perform upsert on.
+        block_size: int
+            Size in bytes of the blocks for uploading large files.
+        max_concurrency: int
+            Number of blocks uploaded in parallel.
+        max_single_put_size: int
+            Files up to this size in bytes are uploaded with a single request.
+        adaptive_upload: bool
+            Resize blocks and concurrency during upload based on the measured throughput.
+        upsert_engine: str
+            Engine to perform the upsert with, "pandas" or "arrow". The arrow engine uses a hash anti-join and keeps
+            the schema of the existing file, but does not sort the rows on the id columns. The "sort_merge" engine
+            merges the sorted rows into the existing file one row group at a time, for files larger than memory.
+        partition_cols: list
+            Columns to partition the dataset on, the files are written in a col=value/ folder per partition. An upsert
+            only rewrites the partitions which are in df, rows are not removed from the partition they were in before.
+        buckets: int
+            Number of files to divide the rows over by a hash of the id columns. An upsert only rewrites the files of
+            the buckets which the keys in df hash to. The number of buckets and the hash are stored in
+            _bucketing.json, for an existing dataset the number of buckets in this file is used.
+        manifest: bool
+            Keep a _manifest.json in the folder of the dataset with the path, rows, size, schema hash and the
+            minimum and maximum of the id columns of every file, so readers do not have to list the folder. Every
+            writer of the dataset has to pass manifest=True, otherwise the manifest misses the files it writes.
+        max_upsert_attempts: int
+            Number of times an upsert is done when other writers change the file between the download and the upload.
+            The upload only succeeds when the etag of the file is still the etag of the download, so parallel
+            writers can upsert the same file without losing rows.
+        cache_dir: str
+            Directory to cache the downloaded and uploaded files in. An upsert only downloads the file when its etag
+            differs from the etag of the cached file, so repeated upserts of the same file skip the download.
+        cache_size: int
+            Size in bytes of the cache, the least recently used files are removed above this size.
         """
 
         self.df = df
         self.tablename = tablename
         self.method = method
-        self.id_field = id_field
+        self.id_field = [id_field] if isinstance(id_field, str) else id_field
+        self.upsert_engine = upsert_engine
+        self.partition_cols = [partition_cols] if isinstance(partition_cols, str) else partition_cols
+        self.buckets = buckets
+        self.manifest = manifest
+        self.max_upsert_attempts = max_upsert_attempts
+        self.create_missing = False
+        self.cache = BlobCache(cache_dir, max_size=cache_size) if cache_dir else None
+        self.dataset_name = f"{folder}/{self.tablename}"
         self.upload_name = self.set_upload_name(folder)
         self.connection_string = os.environ.get("AZURE_STORAGE_CONNECTION_STRING")
         self._checks()
         self.container_name = container_name
+        self.block_size = block_size
+        self.max_concurrency = max_concurrency
+        self.max_single_put_size = max_single_put_size
+        self.adaptive_upload = adaptive_upload
         test_unique_column_names(self.df)
 
     def _checks(self):
         if self.method == "upsert" and not self.id_field:
             raise ValueError("With method is upsert, you need to give one or more id columns in argument id_cols")
+        if self.buckets and not self.id_field:
+            raise ValueError("With buckets, you need to give one or more id columns in argument id_field")
+        if self.upsert_engine not in UPSERT_ENGINES:
+            raise ValueError(
+                f"No valid upsert engine given: {self.upsert_engine}. choose from {', '.join(UPSERT_ENGINES)}."
+            )
 
     def set_upload_name(self, folder: str) -> str:
         """
-        The method parameter dictates the filename. If append is used, a timestamp will be added in order not to
-        overwrite the parquet file. if method = create (default), the filename will be uploaded as is. To keep files
-        organised, the foldername wil also include the filename. Although this creates redundancy in filename
+        The method parameter dictates the filename. If append is used, a timestamp and a random suffix will be added
+        in order not to overwrite the parquet file. if method = create (default), the filename will be uploaded as is.
+        To keep files organised, the foldername wil also include the filename. Although this creates redundancy in
+        filename
 
         Parameters
         ----------
@@ -353,7 +923,7 @@ class DfToParquet:
         if self.method in ("create", "upsert"):
             name = f"{folder}/{self.tablename}.parquet"
         elif self.method == "append":
-            name = f"{folder}/{self.tablename}/{self.tablename}_{datetime.now().strftime('%Y%m%d%H%M%S')}.parquet"
+            name = f"{folder}/{self.tablename}/{append_file_name(self.tablename)}"
         else:
             allow_list = ["create", "append", "upsert"]
             raise ValueError(f"No valid method given: {self.method}. choose from {', '.join(allow_list)}.")
@@ -370,6 +940,9 @@ class DfToParquet:
         2. We do the upsert with the given dataframe
         3. We upload and overwrite the parquet file on storage with the updated dataframe
 
+        The result is built with a single concat of the new rows and the existing rows which are not updated, self.df
+        is not changed.
+
         Parameters
         ----------
         df_existing: pd.DataFrame
@@ -389,35 +962,310 @@ class DfToParquet:
             )
             raise ValueError(err_msg)
 
-        # check if there are any NaNs in the new data, else we use pd.concat instead of combine_first
-        idx = self.df.set_index(self.id_field)
-        any_nan = idx.isna().any(axis=1)
-        if any_nan.any():
-            self.df = pd.concat([self.df, df_existing]).drop_duplicates(subset=self.id_field)
-            self.df = self.df.sort_values(self.id_field, ignore_index=True)
-        else:
-            # set indices with id columns
-            df_existing = df_existing.set_index(self.id_field)
-            # perform upsert
-            self.df = idx.combine_first(df_existing)
-            # set id columns back as regular colums
-            self.df = self.df.reset_index()
+        # rows of the existing data which are not in the new data
+        keep = ~self.key_index(df_existing).isin(self.key_index(self.df))
+        result = pd.concat([self.df, df_existing.loc[keep]], ignore_index=True)
+        result.sort_values(self.id_field, ignore_index=True, inplace=True)
+
+        return result
+
+    def upsert_arrow(self, existing: pa.Table) -> pa.Table:
+        """
+        Perform insert or update with the arrow engine, see parquet.arrow_upsert.
+
+        Parameters
+        ----------
+        existing: pa.Table
+            The table which is already on Azure Storage and has to be updated.
+
+        Returns
+        -------
+        result: pa.Table
+            Updated table to be uploaded.
+        """
+        new = pa.Table.from_pandas(self.df, preserve_index=False)
+
+        return arrow_upsert(existing, new, self.id_field)
+
+    def upsert_sort_merge(self, container_client):
+        """
+        Perform insert or update with the sort_merge engine, see parquet.sort_merge_upsert.
+
+        The existing blob is read row group by row group with ranged downloads and the result is written as staged
+        blocks, which replace the blob when all blocks are committed. The reads and the commit are conditional on
+        the etag of the blob when it was opened.
+
+        Returns
+        -------
+        metadata: pq.FileMetaData
+            Footer of the updated file.
+        size: int
+            Size in bytes of the updated file.
+        """
+        blob_client = container_client.get_blob_client(self.upload_name)
+        new = pa.Table.from_pandas(self.df, preserve_index=False)
+        with BlobReader(blob_client) as source:
+            with BlockBlobWriter(
+                blob_client,
+                block_size=self.block_size,
+                max_concurrency=self.max_concurrency,
+                adaptive=self.adaptive_upload,
+                etag=source.etag,
+                match_condition=MatchConditions.IfNotModified,
+            ) as sink:
+                metadata = sort_merge_upsert(pq.ParquetFile(source), new, self.id_field, sink)
+
+        logging.info(
+            f"Upserted {self.df.shape[0]} records into {self.upload_name}, which has {metadata.num_rows} records."
+        )
+
+        return metadata, sink.tell()
+
+    def key_index(self, df: pd.DataFrame) -> pd.Index:
+        """
+        Index of the id columns, without copying the other columns.
+        """
+        if len(self.id_field) == 1:
+            return pd.Index(df[self.id_field[0]])
+
+        return pd.MultiIndex.from_arrays([df[col] for col in self.id_field])
+
+    def download(self, container_client):
+        """
+        Download the existing file in parallel ranges, or use the cached file when the blob was not changed.
+
+        Returns
+        -------
+        buffer: pa.Buffer
+            Contents of the file.
+        etag: str
+            Etag of the file.
+        """
+        blob_client = container_client.get_blob_client(self.upload_name)
+        if self.cache is not None:
+            return self.cache.download(blob_client, max_concurrency=self.max_concurrency)
+
+        downloaded_blob = blob_client.download_blob(max_concurrency=self.max_concurrency)
+
+        return download_to_buffer(downloaded_blob), downloaded_blob.properties.etag
+
+    def upload(self, container_client, data: bytes, etag: str = None, match_condition: MatchConditions = None) -> str:
+        return upload_data(
+            container_client.get_blob_client(self.upload_name),
+            data,
+            max_concurrency=self.max_concurrency,
+            block_size=self.block_size,
+            max_single_put_size=self.max_single_put_size,
+            adaptive=self.adaptive_upload,
+            etag=etag,
+            match_condition=match_condition,
+        )
 
     def run(self):
-        blob_service_client = BlobServiceClient.from_connection_string(self.connection_string)
+        blob_service_client = BlobServiceClient.from_connection_string(
+            self.connection_string,
+            max_block_size=self.block_size,
+            max_single_put_size=self.max_single_put_size,
+            max_chunk_get_size=self.block_size,
+        )
         container_client = blob_service_client.get_container_client(container=self.container_name)
 
+        if self.partition_cols or self.buckets:
+            self.write_partitions(container_client)
+        else:
+            entry = self.write(container_client)
+            if self.manifest:
+                Manifest(container_client, self.dataset_name).update(added={self.upload_name: entry})
+
+    def write(self, container_client) -> dict:
+        """
+        Write the DataFrame to upload_name, creating the container when it does not exist.
+
+        An upsert only replaces the file when it was not changed since it was downloaded. When another writer changed
+        it in the meantime, the upsert is done again on the new version of the file, up to max_upsert_attempts times.
+
+        Returns
+        -------
+        entry: dict
+            Manifest entry of the written file.
+        """
+        if self.method != "upsert":
+            return self.write_file(container_client)
+
+        test_uniqueness_columns(self.df, self.id_field)
+        for attempt in range(self.max_upsert_attempts):
+            try:
+                return self.write_file(container_client)
+            except (azure.core.exceptions.ResourceModifiedError, azure.core.exceptions.ResourceExistsError):
+                logging.info(f"{self.upload_name} was changed by another writer, attempt {attempt + 1}")
+                conflict_backoff(attempt)
+
+        raise ConcurrentWriteError(
+            f"Could not upsert {self.upload_name}, it was changed by other writers {self.max_upsert_attempts} times."
+        )
+
+    def write_file(self, container_client) -> dict:
+        """
+        Write the DataFrame, or the upsert of the DataFrame into the existing file, to upload_name once.
+
+        Returns
+        -------
+        entry: dict
+            Manifest entry of the written file.
+        """
+        etag, match_condition = None, None
         if self.method == "upsert":
-            test_uniqueness_columns(self.df, self.id_field)
-            downloaded_blob = container_client.download_blob(self.upload_name)
-            bytes_io = BytesIO(downloaded_blob.readall())
-            df_existing = pd.read_parquet(bytes_io)
-            self.upsert(df_existing=df_existing)
+            try:
+                if self.upsert_engine == "sort_merge":
+                    return self.manifest_entry(*self.upsert_sort_merge(container_client))
+                buffer, etag = self.download(container_client)
+            except azure.core.exceptions.ResourceNotFoundError:
+                if not self.create_missing:
+                    raise
+                # a new file, which another writer must not have created in the meantime
+                text_stream = self.df.to_parquet()
+                match_condition = MatchConditions.IfMissing
+            else:
+                match_condition = MatchConditions.IfNotModified
+                parquet_file = pq.ParquetFile(pa.BufferReader(buffer))
+                # the stored index columns are dropped by the upsert, so they are not read
+                existing = parquet_file.read(columns=data_columns(parquet_file.schema_arrow))
+                del parquet_file
+                if self.upsert_engine == "arrow":
+                    table = self.upsert_arrow(existing)
+                    text_stream = table_to_parquet(table)
+                else:
+                    df_existing = existing.to_pandas()
+                    del existing
+                    df = self.upsert(df_existing=df_existing)
+                    del df_existing
+                    text_stream = df.to_parquet()
+        else:
+            text_stream = self.df.to_parquet()
 
-        text_stream = self.df.to_parquet()
         try:
-            container_client.upload_blob(data=text_stream, name=self.upload_name, overwrite=True)
+            uploaded_etag = self.upload(container_client, text_stream, etag=etag, match_condition=match_condition)
         except azure.core.exceptions.ResourceNotFoundError:
             logging.info(f"Container {self.container_name} is created!")
             container_client.create_container()
-            container_client.upload_blob(data=text_stream, name=self.upload_name, overwrite=True)
+            uploaded_etag = self.upload(container_client, text_stream, etag=etag, match_condition=match_condition)
+        if self.cache is not None and self.method != "append":
+            # the next upsert of this file uses the uploaded data instead of downloading it
+            self.cache.put(container_client.get_blob_client(self.upload_name), text_stream, uploaded_etag)
+
+        return self.manifest_entry(pq.read_metadata(pa.BufferReader(text_stream)), len(text_stream))
+
+    def manifest_entry(self, metadata: pq.FileMetaData, size: int) -> dict:
+        return file_entry(metadata, size, stats_cols=self.id_field)
+
+    def write_partitions(self, container_client):
+        """
+        Write every partition and bucket of the DataFrame to its own file, in parallel.
+
+        With method create the files of partitions which are not in the DataFrame are removed, with method upsert
+        only the partitions and buckets in the DataFrame are rewritten.
+        """
+        if self.method == "upsert":
+            test_uniqueness_columns(self.df, self.id_field)
+        try:
+            container_client.create_container()
+            logging.info(f"Container {self.container_name} is created!")
+        except azure.core.exceptions.ResourceExistsError:
+            pass
+
+        by = [self.df[col] for col in self.partition_cols or []]
+        if self.buckets:
+            metadata_name = self.write_bucketing_metadata(container_client)
+            by.append(pd.Series(bucket_numbers(self.df, self.id_field, self.buckets), index=self.df.index))
+
+        groups = self.df.groupby(by, dropna=False, observed=True, sort=False)
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            written = dict(executor.map(lambda group: self.write_partition(container_client, *group), groups))
+
+        removed = []
+        if self.method == "create":
+            keep = set(written) | {f"{self.dataset_name}/{MANIFEST_FILE}"}
+            if self.buckets:
+                keep.add(metadata_name)
+            for blob in container_client.list_blobs(name_starts_with=f"{self.dataset_name}/"):
+                if blob.name not in keep:
+                    container_client.delete_blob(blob.name)
+                    removed.append(blob.name)
+
+        if self.manifest:
+            Manifest(container_client, self.dataset_name).update(added=written, removed=removed)
+
+        logging.info(f"Written {len(written)} files of {self.dataset_name}.")
+
+    def write_bucketing_metadata(self, container_client) -> str:
+        """
+        Read the number of buckets of an existing dataset, or store it for a new dataset.
+
+        Returns
+        -------
+        name: str
+            Name of the metadata blob.
+        """
+        blob_client = container_client.get_blob_client(f"{self.dataset_name}/{BUCKETING_FILE}")
+        if self.method != "create":
+            try:
+                metadata = json.loads(blob_client.download_blob().readall())
+            except azure.core.exceptions.ResourceNotFoundError:
+                metadata = None
+            if metadata is not None:
+                if metadata["hash"] != BUCKET_HASH or metadata["id_field"] != list(self.id_field):
+                    raise ValueError(
+                        f"Dataset {self.dataset_name} is bucketed on {', '.join(metadata['id_field'])} with "
+                        f"{metadata['hash']}, which does not match the given id_field."
+                    )
+                if metadata["buckets"] != self.buckets:
+                    logging.info(f"Dataset {self.dataset_name} has {metadata['buckets']} buckets, using those.")
+                    self.buckets = metadata["buckets"]
+                return blob_client.blob_name
+
+        blob_client.upload_blob(json.dumps(bucketing_metadata(self.id_field, self.buckets)), overwrite=True)
+
+        return blob_client.blob_name
+
+    def write_partition(self, container_client, values, df: pd.DataFrame):
+        """
+        Write the rows of one partition, without the partition columns, to the folder of the partition. The file of
+        a bucket has the bucket number as suffix.
+
+        Returns
+        -------
+        name: str
+            Name of the written file.
+        entry: dict
+            Manifest entry of the written file, with the partition values and bucket.
+        """
+        values = values if isinstance(values, tuple) else (values,)
+        partition_cols = self.partition_cols or []
+        file_name = posixpath.basename(self.upload_name)
+        if self.buckets:
+            file_bucket = int(values[-1])
+            file_name = f"{posixpath.splitext(file_name)[0]}_{file_bucket:05d}.parquet"
+            values = values[:-1]
+        folder = self.dataset_name
+        if partition_cols:
+            folder = f"{folder}/{partition_path(partition_cols, values)}"
+
+        partition = copy(self)
+        partition.df = df.drop(columns=partition_cols)
+        partition.df.index = pd.RangeIndex(len(df))
+        partition.partition_cols = None
+        partition.buckets = None
+        partition.upload_name = f"{folder}/{file_name}"
+        if self.method == "upsert":
+            partition.id_field = [col for col in self.id_field if col not in partition_cols]
+            # the file of a new partition is created by the upsert
+            partition.create_missing = True
+            if not partition.id_field:
+                # the id columns are all partition columns: the rows replace the partition
+                partition.method = "create"
+        entry = partition.write(container_client)
+        entry["partition"] = {col: None if pd.isna(value) else value for col, value in zip(partition_cols, values)}
+        if self.buckets:
+            entry["partition"]["bucket"] = file_bucket
+
+        return partition.upload_name, entry
@@ -0,0 +1,196 @@
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime, timezone
+
+import azure.core.exceptions
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from azure.core import MatchConditions
+from azure.storage.blob import BlobServiceClient, ContentSettings
+
+from df_to_azure.blob import conflict_backoff
+from df_to_azure.exceptions import ConcurrentWriteError
+
+# Name of the manifest in the folder of a dataset.
+MANIFEST_FILE = "_manifest.json"
+# Number of times a conditional update of the manifest is tried when other writers update it at the same time.
+MAX_MANIFEST_ATTEMPTS = 10
+
+
+def json_value(value):
+    """
+    Value of a numpy scalar, the string of dates, decimals and other values json can not serialize.
+    """
+    if isinstance(value, np.generic):
+        return value.item()
+
+    return str(value)
+
+
+def schema_hash(metadata: pq.FileMetaData) -> str:
+    """
+    Hash of the column names and types of a parquet file, without the pandas metadata.
+    """
+    schema = metadata.schema.to_arrow_schema().remove_metadata()
+
+    return hashlib.sha256(schema.to_string().encode()).hexdigest()[:16]
+
+
+def file_entry(metadata: pq.FileMetaData, size: int, stats_cols: list = None, partition: dict = None) -> dict:
+    """
+    Manifest entry of a parquet file.
+
+    Parameters
+    ----------
+    metadata: pq.FileMetaData
+        Footer of the file.
+    size: int
+        Size of the file in bytes.
+    stats_cols: list
+        Columns to record the minimum and maximum of, taken from the row group statistics.
+    partition: dict
+        Values of the partition columns and bucket of the file.
+
+    Returns
+    -------
+    entry: dict
+        Rows, size, schema hash, partition values and column statistics of the file.
+    """
+    stats = {}
+    for col in stats_cols or []:
+        minimums, maximums = [], []
+        for i in range(metadata.num_row_groups):
+            row_group = metadata.row_group(i)
+            for j in range(row_group.num_columns):
+                column = row_group.column(j)
+                if column.path_in_schema == col and column.statistics is not None and column.statistics.has_min_max:
+                    minimums.append(column.statistics.min)
+                    maximums.append(column.statistics.max)
+        if minimums:
+            stats[col] = {"min": min(minimums), "max": max(maximums)}
+
+    return {
+        "rows": metadata.num_rows,
+        "size": size,
+        "schema_hash": schema_hash(metadata),
+        "partition": partition or {},
+        "stats": stats,
+    }
+
+
+class Manifest:
+    """
+    The _manifest.json of a dataset, with an entry for every parquet file of the dataset.
+
+    Readers can plan which files to read from this one blob, instead of listing the folder and reading every footer.
+    Every update is a conditional write on the etag of the manifest that was read, when another writer updated the
+    manifest in the meantime the update is applied again on the new version.
+    """
+
+    def __init__(self, container_client, dataset_name: str):
+        """
+        Parameters
+        ----------
+        container_client: ContainerClient
+            Client of the container with the dataset.
+        dataset_name: str
+            Folder of the dataset, {folder}/{tablename}.
+        """
+        self.blob_client = container_client.get_blob_client(f"{dataset_name}/{MANIFEST_FILE}")
+        self.dataset_name = dataset_name
+
+    def read(self):
+        """
+        Returns
+        -------
+        manifest: dict
+            The manifest, an empty manifest when it does not exist.
+        etag: str
+            Etag of the manifest, None when it does not exist.
+        """
+        try:
+            downloaded_blob = self.blob_client.download_blob()
+        except azure.core.exceptions.ResourceNotFoundError:
+            return {"version": 1, "dataset": self.dataset_name, "files": {}}, None
+
+        return json.loads(downloaded_blob.readall()), downloaded_blob.properties.etag
+
+    def update(self, added: dict = None, removed: list = None) -> dict:
+        """
+        Add or replace the entries of the written files and remove the entries of the deleted files.
+
+        Parameters
+        ----------
+        added: dict
+            Entries by path of the files which are written.
+        removed: list
+            Paths of the files which are deleted.
+
+        Returns
+        -------
+        manifest: dict
+            The updated manifest.
+        """
+        for attempt in range(MAX_MANIFEST_ATTEMPTS):
+            manifest, etag = self.read()
+            for path in removed or []:
+                manifest["files"].pop(path, None)
+            manifest["files"].update(added or {})
+            manifest["updated"] = datetime.now(timezone.utc).isoformat()
+
+            if etag is None:
+                conditions = {"match_condition": MatchConditions.IfMissing}
+            else:
+                conditions = {"etag": etag, "match_condition": MatchConditions.IfNotModified}
+            try:
+                self.blob_client.upload_blob(
+                    json.dumps(manifest, default=json_value),
+                    overwrite=etag is not None,
+                    content_settings=ContentSettings(content_type="application/json"),
+                    **conditions,
+                )
+                return manifest
+            except (azure.core.exceptions.ResourceModifiedError, azure.core.exceptions.ResourceExistsError):
+                # another writer updated the manifest first, apply the update again on its version
+                logging.debug(f"Manifest of {self.dataset_name} was changed, attempt {attempt + 1}")
+                conflict_backoff(attempt)
+
+        raise ConcurrentWriteError(f"Could not update the manifest of {self.dataset_name}, it keeps changing.")
+
+
+def read_manifest(tablename: str, folder: str, container_name: str = "parquet") -> pd.DataFrame:
+    """
+    Read the manifest of a parquet dataset written by df_to_azure.
+
+    Parameters
+    ----------
+    tablename: str
+        Name of the dataset.
+    folder: str
+        Folder of the dataset, in df_to_azure this is the 'schema' parameter.
+    container_name: str
+        Name of the container with the dataset.
+
+    Returns
+    -------
+    files: pd.DataFrame
+        One row per file with the path, rows, size and schema_hash, a column per partition column and a
+        {column}_min and {column}_max column for the statistics of the id and partition columns.
+    """
+    blob_service_client = BlobServiceClient.from_connection_string(os.environ.get("AZURE_STORAGE_CONNECTION_STRING"))
+    container_client = blob_service_client.get_container_client(container=container_name)
+    manifest, _ = Manifest(container_client, f"{folder}/{tablename}").read()
+
+    records = []
+    for path, entry in manifest["files"].items():
+        record = {"path": path, "rows": entry["rows"], "size": entry["size"], "schema_hash": entry["schema_hash"]}
+        record.update(entry["partition"])
+        for col, stats in entry["stats"].items():
+            record[f"{col}_min"] = stats["min"]
+            record[f"{col}_max"] = stats["max"]
+        records.append(record)
+
+    return pd.DataFrame(records, columns=None if records else ["path", "rows", "size", "schema_hash"])
@@ -0,0 +1,295 @@
+import re
+import uuid
+from bisect import bisect_right
+from datetime import datetime
+from decimal import Decimal
+from typing import Union
+from urllib.parse import quote
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from pandas.api.types import is_bool_dtype, is_integer_dtype, is_scalar
+
+# Engines to perform an upsert on a parquet file.
+UPSERT_ENGINES = ("pandas", "arrow", "sort_merge")
+# Number of times an upsert is done when other writers change the file in the meantime.
+DEFAULT_MAX_UPSERT_ATTEMPTS = 5
+# Folder name of the partition with null values, as used by Hive and Spark.
+HIVE_DEFAULT_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+# Metadata file of a bucketed dataset and the hash function which assigns rows to buckets.
+BUCKETING_FILE = "_bucketing.json"
+# Every key is normalized on its own before hashing: integers and integral floats to their decimal digits, other
+# floats to their shortest repr, datetimes to the ISO format in UTC and all other values to str.
+BUCKET_HASH = "pandas.util.hash_pandas_object:normalized-keys-2"
+
+
+def normalize_key(value) -> Union[str, None]:
+    """
+    Canonical string of one key, which only depends on the value and not on the dtype of its column.
+    """
+    if is_scalar(value) and pd.isna(value):
+        return None
+    if isinstance(value, (bool, np.bool_, int, np.integer)):
+        return str(int(value))
+    if isinstance(value, (float, np.floating, Decimal)):
+        value = float(value)
+        return str(int(value)) if value.is_integer() else repr(value)
+    if isinstance(value, (datetime, np.datetime64)):
+        value = pd.Timestamp(value)
+        if value.tzinfo is not None:
+            value = value.tz_convert("UTC").tz_localize(None)
+        return value.isoformat()
+
+    return str(value)
+
+
+def normalize_keys(col: pd.Series) -> pd.Series:
+    """
+    Key column as canonical strings, so equal keys have the same hash whatever the dtype or other values of the
+    column. Nulls stay null.
+    """
+    if (is_integer_dtype(col.dtype) or is_bool_dtype(col.dtype)) and not col.hasnans:
+        # the decimal digits of numpy integers are the same as those of normalize_key, without a call per key
+        digits = col.to_numpy(dtype=np.uint64 if col.dtype.kind == "u" else np.int64).astype(str)
+        return pd.Series(digits, index=col.index, dtype=object)
+
+    return col.astype(object).map(normalize_key).astype(object)
+
+
+def bucket_numbers(df: pd.DataFrame, id_field: list, buckets: int) -> np.ndarray:
+    """
+    Bucket of every row, a stable hash of the normalized id columns modulo the number of buckets.
+
+    The hash only depends on the value of each key, so it is the same for every process, for keys of different
+    dtypes like int32, int64 and float, and for a key in frames with different other keys.
+    """
+    keys = pd.DataFrame({col: normalize_keys(df[col]) for col in id_field})
+    hashes = pd.util.hash_pandas_object(keys, index=False).to_numpy()
+
+    return (hashes % np.uint64(buckets)).astype(np.int64)
+
+
+def bucketing_metadata(id_field: list, buckets: int) -> dict:
+    return {"buckets": buckets, "id_field": list(id_field), "hash": BUCKET_HASH}
+
+
+def append_file_name(tablename: str, file_time: datetime = None) -> str:
+    """
+    Name of a file written with method append: the time in microseconds, by default now, and a random suffix, so
+    parallel writers never write the same file.
+    """
+    file_time = datetime.now() if file_time is None else file_time
+
+    return f"{tablename}_{file_time.strftime('%Y%m%d%H%M%S%f')}_{uuid.uuid4().hex[:12]}.parquet"
+
+
+def append_file_time(tablename: str, file_name: str) -> datetime:
+    """
+    Time in the name of a file written with method append, None for other files.
+
+    Both the current names and the names with a time in seconds of earlier versions are recognized.
+    """
+    match = re.fullmatch(rf"{re.escape(tablename)}_(\d{{14}})(\d{{6}})?(_[0-9a-f]+)?\.parquet", file_name)
+    if match is None:
+        return None
+
+    return datetime.strptime(match.group(1) + (match.group(2) or "000000"), "%Y%m%d%H%M%S%f")
+
+
+def partition_path(partition_cols: list, values: tuple) -> str:
+    """
+    Hive style folder of a partition, like col1=value1/col2=value2. Values are url encoded.
+    """
+    return "/".join(
+        f"{col}={HIVE_DEFAULT_PARTITION if pd.isna(value) else quote(str(value), safe='')}"
+        for col, value in zip(partition_cols, values)
+    )
+
+
+def index_columns(schema: pa.Schema) -> list:
+    """
+    Names of the index columns pandas stored in a schema, a RangeIndex is only described in the pandas metadata.
+    """
+    pandas_metadata = schema.pandas_metadata or {}
+
+    return [col for col in pandas_metadata.get("index_columns", []) if isinstance(col, str)]
+
+
+def data_columns(schema: pa.Schema) -> list:
+    """
+    Names of the columns of a schema written by pandas, without the stored index columns.
+    """
+    stored_index = index_columns(schema)
+
+    return [col for col in schema.names if col not in stored_index]
+
+
+def check_columns(columns: list, new: pa.Table):
+    diff_cols = set(columns).symmetric_difference(new.column_names)
+    if diff_cols:
+        raise ValueError(
+            f"When performing upsert, column names must be equal. Difference in columns: {', '.join(sorted(diff_cols))}"
+        )
+
+
+def anti_join(existing: pa.Table, new: pa.Table, id_field: list) -> pa.Table:
+    """
+    Rows of the existing table with a key which is not in the new table, in their original order.
+
+    Parameters
+    ----------
+    existing: pa.Table
+        Table to filter.
+    new: pa.Table
+        Table with the keys to remove.
+    id_field: list
+        Key columns.
+
+    Returns
+    -------
+    kept: pa.Table
+        Existing rows which are not updated.
+    """
+    if len(id_field) == 1:
+        key = id_field[0]
+        return existing.filter(pc.invert(pc.is_in(existing[key], value_set=new[key].combine_chunks())))
+
+    # is_in only supports a single column, so join the keys with their row number and take the remaining rows
+    keys = existing.select(id_field).append_column("__row__", pa.array(np.arange(existing.num_rows)))
+    rows = keys.join(new.select(id_field), keys=id_field, join_type="left anti", use_threads=True)["__row__"]
+
+    return existing.take(pc.take(rows, pc.sort_indices(rows)))
+
+
+def arrow_upsert(existing: pa.Table, new: pa.Table, id_field: list) -> pa.Table:
+    """
+    Upsert with pyarrow compute: the existing rows which are not in the new data followed by the new rows.
+
+    The new rows are cast to the schema of the existing table, so the types of the file do not change. Compared to
+    the pandas engine the rows are not sorted on the id columns.
+
+    Parameters
+    ----------
+    existing: pa.Table
+        Table which is already on Azure Storage.
+    new: pa.Table
+        Table with the new and updated rows.
+    id_field: list
+        Key columns.
+
+    Returns
+    -------
+    result: pa.Table
+        Updated table.
+    """
+    columns = data_columns(existing.schema)
+    check_columns(columns, new)
+    if index_columns(existing.schema):
+        # stored index columns are dropped, like the pandas engine does, also when they were not read
+        existing = existing.select(columns).replace_schema_metadata(None)
+
+    new = new.select(columns).cast(existing.schema)
+
+    return pa.concat_tables([anti_join(existing, new, id_field), new])
+
+
+def arrow_order(value) -> tuple:
+    """
+    Key which orders values like an ascending Arrow sort: NaN after the other values and nulls last.
+    """
+    is_nan = isinstance(value, float) and value != value
+    return value is None, is_nan, None if value is None or is_nan else value
+
+
+class SortedKeys:
+    """
+    Sequence of the key tuples of a table sorted on its key columns, to bisect on. Keys with nulls are ordered as
+    Arrow sorts them, so they can be compared.
+    """
+
+    def __init__(self, table: pa.Table, id_field: list):
+        self.columns = [table.column(col).combine_chunks() for col in id_field]
+        self.num_rows = table.num_rows
+
+    def __len__(self):
+        return self.num_rows
+
+    def __getitem__(self, i: int) -> tuple:
+        return tuple(arrow_order(col[i].as_py()) for col in self.columns)
+
+
+def sort_merge_upsert(parquet_file: pq.ParquetFile, new: pa.Table, id_field: list, sink) -> pq.FileMetaData:
+    """
+    Upsert a parquet file which is sorted on the id columns, one row group at a time.
+
+    The new rows are sorted and, for every row group of the existing file, the new rows up to the last key of the
+    row group are merged in. Only the new rows, one row group and the write buffers of the sink are held in memory,
+    so the existing file can be larger than memory. The result is sorted on the id columns again and has the same
+    row groups as the existing file, plus one for the new rows after the last existing key.
+
+    Parameters
+    ----------
+    parquet_file: pq.ParquetFile
+        The existing file, sorted on the id columns as the pandas and sort_merge engines write it.
+    new: pa.Table
+        Table with the new and updated rows.
+    id_field: list
+        Key columns.
+    sink: file-like
+        Writable file to write the updated parquet file to.
+
+    Returns
+    -------
+    metadata: pq.FileMetaData
+        Footer of the updated file.
+    """
+    columns = data_columns(parquet_file.schema_arrow)
+    check_columns(columns, new)
+    schema = pa.schema([parquet_file.schema_arrow.field(col) for col in columns])
+    if columns == parquet_file.schema_arrow.names:
+        schema = schema.with_metadata(parquet_file.schema_arrow.metadata)
+
+    sort_keys = [(col, "ascending") for col in id_field]
+    new = new.select(columns).cast(schema).sort_by(sort_keys)
+    new_keys = SortedKeys(new, id_field)
+
+    start = 0
+    last_key = None
+    metadata = []
+    with pq.ParquetWriter(sink, schema, metadata_collector=metadata) as writer:
+        for i in range(parquet_file.num_row_groups):
+            row_group = parquet_file.read_row_group(i, columns=columns).cast(schema)
+            if row_group.num_rows == 0:
+                continue
+            indices = pc.sort_indices(row_group, sort_keys=sort_keys)
+            if not pc.all(pc.equal(indices, pa.array(np.arange(row_group.num_rows, dtype=np.uint64)))).as_py():
+                row_group = row_group.take(indices)
+            row_group_keys = SortedKeys(row_group, id_field)
+            if last_key is not None and not row_group_keys[0] > last_key:
+                raise ValueError(
+                    f"Existing file is not sorted on {', '.join(id_field)}, upsert it once with the pandas engine."
+                )
+            last_key = row_group_keys[len(row_group_keys) - 1]
+
+            # the new rows within the key range of this row group
+            end = bisect_right(new_keys, last_key, lo=start)
+            updates = new.slice(start, end - start)
+            start = end
+
+            merged = pa.concat_tables([anti_join(row_group, updates, id_field), updates])
+            writer.write_table(merged.sort_by(sort_keys))
+
+        if start < new.num_rows:
+            writer.write_table(new.slice(start))
+
+    return metadata[0]
+
+
+def table_to_parquet(table: pa.Table) -> bytes:
+    buffer = pa.BufferOutputStream()
+    pq.write_table(table, buffer)
+
+    return buffer.getvalue().to_pybytes()
@@ -0,0 +1,116 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from azure.core.exceptions import ResourceNotFoundError
+
+# Deployed resources are trusted for a day, after that they are deployed again.
+DEFAULT_TTL = 24 * 60 * 60
+
+
+class ProvisioningCache:
+    """
+    On-disk store of the fingerprints of the Data Factory resources which were deployed last.
+
+    When the definition of a linked service, dataset or pipeline did not change since the last deployment, the
+    create_or_update call to Azure Resource Manager can be skipped. Entries expire after ``ttl`` seconds. With
+    ``verify=True`` a cheap get call checks that the etag of the deployed resource did not change in the meantime.
+    """
+
+    def __init__(self, path: str = None, ttl: int = DEFAULT_TTL, verify: bool = False):
+        """
+        Parameters
+        ----------
+        path: str
+            Path of the json file to store the fingerprints, defaults to env variable DF_TO_AZURE_CACHE_DIR or
+            ~/.cache/df_to_azure.
+        ttl: int
+            Number of seconds a deployed resource is trusted.
+        verify: bool
+            Compare the etag of the deployed resource before skipping a deployment.
+        """
+        if path is None:
+            cache_dir = os.environ.get(
+                "DF_TO_AZURE_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "df_to_azure")
+            )
+            path = os.path.join(cache_dir, "provisioning.json")
+        self.path = path
+        self.ttl = ttl
+        self.verify = verify
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(resource) -> str:
+        """
+        Hash of the definition of an Azure resource model.
+        """
+        definition = json.dumps(resource.as_dict(), sort_keys=True, default=str)
+        return hashlib.sha256(definition.encode()).hexdigest()
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _save(self, entries: dict):
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+        # Write to a temporary file first, so concurrent readers never see a half written file
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, self.path)
+
+    def is_current(self, key: str, fingerprint: str, get_resource=None) -> bool:
+        """
+        Check if the resource with this fingerprint is already deployed.
+
+        Parameters
+        ----------
+        key: str
+            Unique name of the resource.
+        fingerprint: str
+            Fingerprint of the resource definition.
+        get_resource: callable
+            Function returning the deployed resource, only used with verify=True.
+
+        Returns
+        -------
+        current: bool
+            True if the deployment can be skipped.
+        """
+        entry = self._load().get(key)
+        if entry is None or entry["fingerprint"] != fingerprint or time.time() - entry["deployed_at"] > self.ttl:
+            return False
+        if self.verify and get_resource is not None:
+            try:
+                deployed = get_resource()
+            except ResourceNotFoundError:
+                self.invalidate(key)
+                return False
+            if getattr(deployed, "etag", None) != entry.get("etag"):
+                return False
+
+        return True
+
+    def store(self, key: str, fingerprint: str, etag: str = None):
+        with self._lock:
+            entries = self._load()
+            entries[key] = {"fingerprint": fingerprint, "etag": etag, "deployed_at": time.time()}
+            self._save(entries)
+
+    def invalidate(self, prefix: str = ""):
+        """
+        Remove all entries with a key starting with prefix, by default all entries.
+        """
+        with self._lock:
+            entries = self._load()
+            entries = {key: entry for key, entry in entries.items() if not key.startswith(prefix)}
+            self._save(entries)
+        logging.debug(f"Invalidated provisioning cache for '{prefix}'")
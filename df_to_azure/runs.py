@@ -0,0 +1,224 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from datetime import datetime, timedelta, timezone
+
+from azure.mgmt.datafactory.models import RunFilterParameters
+
+from df_to_azure.exceptions import PipelineRunError
+
+FAILED_STATUSES = ("failed", "canceling", "canceled")
+FINISHED_STATUSES = ("succeeded",) + FAILED_STATUSES
+
+
+class PipelineRunHandle:
+    """
+    Handle to a triggered pipeline run.
+
+    The status of runs which are waited on, or which have callbacks, is refreshed by a RunPoller which queries all
+    outstanding runs of the data factory at once. The handle has the run_id of the create run response, so it can be
+    used where the response was used before.
+    """
+
+    def __init__(self, adf_client, rg_name: str, df_name: str, run_id: str):
+        """
+        Parameters
+        ----------
+        adf_client: DataFactoryManagementClient
+            Client of the data factory.
+        rg_name: str
+            Name of the resource group.
+        df_name: str
+            Name of the data factory.
+        run_id: str
+            Id of the pipeline run.
+        """
+        self.adf_client = adf_client
+        self.rg_name = rg_name
+        self.df_name = df_name
+        self.run_id = run_id
+        self.pipeline_run = None
+        self._status = "Queued"
+        self._future = Future()
+        self._future.set_running_or_notify_cancel()
+        self._tracked = False
+
+    def __repr__(self):
+        return f"PipelineRunHandle(run_id={self.run_id!r}, status={self._status!r})"
+
+    def update(self, pipeline_run) -> bool:
+        """
+        Set the latest state of the run, resolving the future when the run is finished.
+
+        Returns
+        -------
+        changed: bool
+            True if the status changed.
+        """
+        self.pipeline_run = pipeline_run
+        changed = pipeline_run.status != self._status
+        self._status = pipeline_run.status
+        if self._status.lower() in FINISHED_STATUSES and not self._future.done():
+            if self._status.lower() in FAILED_STATUSES:
+                self._future.set_exception(PipelineRunError(f"Pipeline failed or canceled: {pipeline_run.message}"))
+            else:
+                self._future.set_result(pipeline_run)
+
+        return changed
+
+    def status(self) -> str:
+        """
+        Current status of the run: Queued, InProgress, Succeeded, Failed, Canceling or Canceled.
+
+        A run which is not waited on is fetched from the data factory. Once the run is waited on or has callbacks,
+        this is the status of the last poll of the RunPoller, which is at most max_interval seconds old.
+        """
+        if not self._future.done() and not self._tracked:
+            self.update(self.adf_client.pipeline_runs.get(self.rg_name, self.df_name, self.run_id))
+
+        return self._status
+
+    def done(self) -> bool:
+        return self._future.done()
+
+    @property
+    def future(self) -> Future:
+        """
+        Future which resolves to the finished PipelineRun, or raises PipelineRunError when the run failed.
+        """
+        self._track()
+        return self._future
+
+    def _track(self):
+        if not self._tracked and not self._future.done():
+            # the poller only sees runs which are updated after it starts, so a finished run is resolved right away
+            self.update(self.adf_client.pipeline_runs.get(self.rg_name, self.df_name, self.run_id))
+            if self._future.done():
+                return
+            self._tracked = True
+            RunPoller.for_factory(self.adf_client, self.rg_name, self.df_name).register(self)
+
+    def wait(self, timeout: float = None):
+        """
+        Wait until the run is finished.
+
+        Parameters
+        ----------
+        timeout: float
+            Maximum number of seconds to wait, by default there is no limit.
+
+        Returns
+        -------
+        pipeline_run: PipelineRun
+            The finished run.
+        """
+        try:
+            return self.future.result(timeout=timeout)
+        except FutureTimeoutError:
+            raise PipelineRunError("Pipeline is running too long")
+
+    def cancel(self):
+        self.adf_client.pipeline_runs.cancel(self.rg_name, self.df_name, self.run_id)
+
+    def add_done_callback(self, fn):
+        """
+        Call fn with this handle when the run is finished.
+        """
+        self.future.add_done_callback(lambda _: fn(self))
+
+
+class RunPoller:
+    """
+    Background thread which refreshes all outstanding runs of one data factory with a single query_by_factory call.
+
+    Only runs which were updated since the previous poll are returned by the query. The poll interval doubles while
+    nothing changes, up to max_interval, and is reset when a status changes or a run is registered.
+    """
+
+    min_interval = 1
+    max_interval = 30
+    # margin for clock differences between this machine and Azure
+    clock_skew = timedelta(minutes=5)
+
+    _pollers = {}
+    _pollers_lock = threading.Lock()
+
+    def __init__(self, adf_client, rg_name: str, df_name: str):
+        self.adf_client = adf_client
+        self.rg_name = rg_name
+        self.df_name = df_name
+        self.handles = {}
+        self.interval = self.min_interval
+        self._last_poll = datetime.now(timezone.utc)
+        self._lock = threading.Lock()
+        self._running = False
+
+    @classmethod
+    def for_factory(cls, adf_client, rg_name: str, df_name: str):
+        with cls._pollers_lock:
+            poller = cls._pollers.get((rg_name, df_name))
+            if poller is None:
+                poller = cls._pollers[(rg_name, df_name)] = cls(adf_client, rg_name, df_name)
+
+        return poller
+
+    def register(self, handle: PipelineRunHandle):
+        """
+        Refresh the run of the handle until it is finished. The handle must have the status of the run fetched after
+        the run was triggered, the poller only returns runs which are updated after it is registered.
+        """
+        with self._lock:
+            if not self.handles:
+                self._last_poll = datetime.now(timezone.utc)
+            self.handles[handle.run_id] = handle
+            self.interval = self.min_interval
+            if not self._running:
+                self._running = True
+                threading.Thread(target=self._run, name=f"RunPoller {self.df_name}", daemon=True).start()
+
+    def poll(self) -> bool:
+        """
+        Refresh the outstanding runs.
+
+        Returns
+        -------
+        changed: bool
+            True if the status of any run changed.
+        """
+        now = datetime.now(timezone.utc)
+        filter_parameters = RunFilterParameters(
+            last_updated_after=self._last_poll - self.clock_skew, last_updated_before=now + self.clock_skew
+        )
+        changed = False
+        while True:
+            response = self.adf_client.pipeline_runs.query_by_factory(self.rg_name, self.df_name, filter_parameters)
+            for pipeline_run in response.value:
+                handle = self.handles.get(pipeline_run.run_id)
+                if handle is not None:
+                    changed |= handle.update(pipeline_run)
+            if not response.continuation_token:
+                break
+            filter_parameters.continuation_token = response.continuation_token
+        self._last_poll = now
+
+        with self._lock:
+            self.handles = {run_id: handle for run_id, handle in self.handles.items() if not handle.done()}
+
+        return changed
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                changed = self.poll()
+            except Exception as e:
+                # keep polling, a failing request should not leave the outstanding runs unresolved
+                logging.warning(f"Failed to refresh pipeline runs: {e}")
+                changed = False
+            with self._lock:
+                if not self.handles:
+                    self._running = False
+                    return
+                self.interval = self.min_interval if changed else min(2 * self.interval, self.max_interval)
@@ -1,8 +1,10 @@
+import asyncio
+
 from pandas import DataFrame, Timedelta, date_range, read_sql_query, read_sql_table
 from pandas._testing import assert_frame_equal
 from sqlalchemy.types import Date
 
-from df_to_azure import df_to_azure
+from df_to_azure import df_to_azure, df_to_azure_async
 from df_to_azure.db import auth_azure
 from df_to_azure.tests import data
 
@@ -83,3 +85,47 @@ def test_dtype_given():
         result = read_sql_query(query, con=con)
 
     assert_frame_equal(expected, result)
+
+
+def test_create_streaming():
+    expected = data["employee_1"]
+    df_to_azure(
+        df=expected,
+        tablename="employee_streaming",
+        schema="test",
+        method="create",
+        wait_till_finished=True,
+        streaming=True,
+        row_group_size=2,
+        block_size=1024,
+    )
+
+    with auth_azure() as con:
+        result = read_sql_table(table_name="employee_streaming", con=con, schema="test")
+
+    assert_frame_equal(expected, result)
+
+
+def test_create_async():
+    async def create_tables():
+        await asyncio.gather(
+            df_to_azure_async(
+                df=data["sample_1"], tablename="sample_async", schema="test", method="create", wait_till_finished=True
+            ),
+            df_to_azure_async(
+                df=data["category_1"],
+                tablename="category_async",
+                schema="test",
+                method="create",
+                wait_till_finished=True,
+            ),
+        )
+
+    asyncio.run(create_tables())
+
+    with auth_azure() as con:
+        result_sample = read_sql_table(table_name="sample_async", con=con, schema="test")
+        result_category = read_sql_table(table_name="category_async", con=con, schema="test")
+
+    assert_frame_equal(data["sample_1"], result_sample)
+    assert_frame_equal(data["category_1"], result_category)
@@ -1,19 +1,32 @@
+import asyncio
 import logging
+import tracemalloc
+from decimal import Decimal
+from io import BytesIO
 
+import pyarrow as pa
+import pyarrow.parquet as pq
 import pytest
 import pyodbc
 import re
 
+from azure.core.exceptions import ResourceNotFoundError
+from azure.mgmt.datafactory.models import PipelineResource
 from keyvault import secrets_to_environment
 from numpy import array, nan
-from pandas import DataFrame, Series, date_range, read_sql_query, read_sql_table, NaT
+from numpy.random import random
+from pandas import DataFrame, Series, date_range, read_sql_query, read_sql_table, to_timedelta, NaT
 from pandas._testing import assert_frame_equal
 
 from df_to_azure import df_to_azure
-from df_to_azure.db import auth_azure, get_sql_driver
+from df_to_azure.aio import AsyncDfToAzure
+from df_to_azure.db import auth_azure, get_engine, get_sql_driver
 from df_to_azure.exceptions import DoubleColumnNamesError
+from df_to_azure.export import DfToAzure, DfToAzureBatch, max_str_len
+from df_to_azure.provisioning import ProvisioningCache
+from df_to_azure.runs import PipelineRunHandle
 
-from unittest.mock import patch
+from unittest.mock import AsyncMock, MagicMock, patch
 
 
 logging.getLogger("azure.core.pipeline.policies.http_logging_policy").setLevel(logging.WARNING)
@@ -38,6 +51,205 @@ def test_auth_azure_with_non_sql_server_driver():
         assert re.match(r"ODBC Driver \d+ for SQL Server", sql_driver)
 
 
+def test_engine_is_reused():
+    """
+    All connections in one process should come from the same engine and connection pool.
+    """
+    assert get_engine() is get_engine()
+
+    with auth_azure() as con:
+        first_connection = con.connection.dbapi_connection
+    with auth_azure() as con:
+        assert con.connection.dbapi_connection is first_connection
+
+
+def test_provisioning_cache(tmp_path):
+    """
+    Unchanged resource definitions should be skipped, changed definitions and expired entries deployed again.
+    """
+    cache = ProvisioningCache(path=str(tmp_path / "provisioning.json"), ttl=60)
+    pipeline = PipelineResource(activities=[], parameters={})
+    fingerprint = cache.fingerprint(pipeline)
+    assert not cache.is_current("pipelines/test", fingerprint)
+
+    cache.store("pipelines/test", fingerprint)
+    assert cache.is_current("pipelines/test", fingerprint)
+    assert not cache.is_current("pipelines/test", cache.fingerprint(PipelineResource(activities=[], concurrency=2)))
+
+    cache.invalidate("pipelines/")
+    assert not cache.is_current("pipelines/test", fingerprint)
+
+    cache.ttl = -1
+    cache.store("pipelines/test", fingerprint)
+    assert not cache.is_current("pipelines/test", fingerprint)
+
+
+def test_provisioning_cache_run():
+    """
+    A second run with the same table should skip all deployments and still load the data.
+    """
+    df = DataFrame({"A": [1, 2, 3], "B": list("abc"), "C": [4.0, 5.0, nan]})
+    for _ in range(2):
+        df_to_azure(
+            df=df,
+            tablename="provisioning_cache",
+            schema="test",
+            method="create",
+            wait_till_finished=True,
+            provisioning_cache=True,
+        )
+
+    with auth_azure() as con:
+        result = read_sql_table(table_name="provisioning_cache", con=con, schema="test")
+
+    assert_frame_equal(df, result)
+
+
+def test_provisioning_cache_stale(tmp_path):
+    """
+    When a cached dataset was deleted from the factory, the failed run deploys all resources of the run again.
+    """
+    cache = ProvisioningCache(path=str(tmp_path / "provisioning.json"), ttl=60)
+    adf_client = MagicMock()
+    for operations in (adf_client.linked_services, adf_client.datasets, adf_client.pipelines):
+        operations.create_or_update.return_value = MagicMock(etag=None)
+    adf_client.pipelines.create_run.side_effect = [
+        MagicMock(run_id="first"),
+        ResourceNotFoundError("Dataset not found"),
+        MagicMock(run_id="second"),
+    ]
+    for _ in range(2):
+        export = DfToAzure(
+            df=DataFrame({"A": [1]}),
+            tablename="provisioning_stale",
+            schema="test",
+            provisioning_cache=cache,
+            adf_client=adf_client,
+        )
+        export.create_linked_service_sql()
+        export.create_linked_service_blob()
+        export.create_input_blob()
+        export.create_output_sql()
+        run_response = export.create_pipeline(pipeline_name=None)
+
+    assert run_response.run_id == "second"
+    assert adf_client.linked_services.create_or_update.call_count == 4
+    assert adf_client.datasets.create_or_update.call_count == 4
+    assert adf_client.pipelines.create_or_update.call_count == 2
+
+
+def test_provisioning_cache_stale_async(tmp_path):
+    """
+    Like test_provisioning_cache_stale, with the aio client of the asynchronous export.
+    """
+    cache = ProvisioningCache(path=str(tmp_path / "provisioning.json"), ttl=60)
+    adf_client = MagicMock()
+    for operations in (adf_client.linked_services, adf_client.datasets, adf_client.pipelines):
+        operations.create_or_update = AsyncMock(return_value=MagicMock(etag=None))
+    adf_client.pipelines.create_run = AsyncMock(
+        side_effect=[MagicMock(run_id="first"), ResourceNotFoundError("Dataset not found"), MagicMock(run_id="second")]
+    )
+
+    async def run(export):
+        await export.deploy_async(adf_client.linked_services, *export.linked_service_sql_resource())
+        await export.deploy_async(adf_client.linked_services, *export.linked_service_blob_resource())
+        await export.deploy_async(adf_client.datasets, *export.input_blob_resource())
+        await export.deploy_async(adf_client.datasets, *export.output_sql_resource())
+        return await export.run_pipeline_async(adf_client, *export.pipeline_resource())
+
+    for _ in range(2):
+        export = AsyncDfToAzure(
+            df=DataFrame({"A": [1]}),
+            tablename="provisioning_stale",
+            schema="test",
+            provisioning_cache=cache,
+            adf_client=MagicMock(),
+        )
+        run_response = asyncio.run(run(export))
+
+    assert run_response.run_id == "second"
+    assert adf_client.linked_services.create_or_update.await_count == 4
+    assert adf_client.datasets.create_or_update.await_count == 4
+    assert adf_client.pipelines.create_or_update.await_count == 2
+
+
+def test_generic_pipeline_definition_changed():
+    """
+    A generic pipeline deployed with another definition is deployed again, an up to date one is not.
+    """
+    adf_client = MagicMock()
+    adf_client.pipelines.get.return_value = MagicMock(annotations=["dftoazure_hash:older"])
+    export = DfToAzure(df=DataFrame({"A": [1]}), tablename="generic", schema="test", adf_client=adf_client)
+
+    with patch("df_to_azure.adf._GENERIC_PIPELINES_DEPLOYED", set()):
+        export.create_generic_pipelines()
+    assert adf_client.pipelines.create_or_update.call_count == 2
+    deployed = adf_client.pipelines.create_or_update.call_args.args[3]
+
+    # another process finds the deployed definition
+    adf_client.reset_mock()
+    adf_client.pipelines.get.return_value = deployed
+    with patch("df_to_azure.adf._GENERIC_PIPELINES_DEPLOYED", set()):
+        export.create_generic_pipelines()
+    adf_client.pipelines.create_or_update.assert_not_called()
+
+
+def test_run_handles():
+    """
+    Runs which are not waited for return a handle, the handles are resolved by one shared poller.
+    """
+    df = DataFrame({"A": [1, 2, 3], "B": list("abc")})
+    handles = []
+    for table_name in ["run_handle_1", "run_handle_2"]:
+        _, run_response = df_to_azure(df=df, tablename=table_name, schema="test", method="create")
+        handles.append(run_response)
+
+    for handle in handles:
+        assert handle.wait(timeout=60 * 30).status == "Succeeded"
+        assert handle.status() == "Succeeded"
+
+    with auth_azure() as con:
+        result = read_sql_table(table_name="run_handle_2", con=con, schema="test")
+
+    assert_frame_equal(df, result)
+
+
+def test_run_handle_finished_before_wait():
+    """
+    A run which finished long before it is waited on is not returned by the poller, it is fetched when it is tracked.
+    """
+    adf_client = MagicMock()
+    adf_client.pipeline_runs.get.return_value = MagicMock(status="Succeeded", run_id="finished")
+    adf_client.pipeline_runs.query_by_factory.return_value = MagicMock(value=[], continuation_token=None)
+    handle = PipelineRunHandle(adf_client, "rg", "finished_factory", "finished")
+
+    assert handle.wait(timeout=5).status == "Succeeded"
+    assert handle.done()
+
+
+def test_batch_shares_client_and_schemas():
+    """
+    The tables of a batch share one ADF client, and every schema is created once before the tables are prepared.
+    """
+    batch = DfToAzureBatch(
+        tables={
+            "batch_a": DataFrame({"id": [1]}),
+            "batch_b": DataFrame({"id": [2]}),
+            "batch_c": {"df": DataFrame({"id": [3]}), "method": "upsert", "id_field": "id"},
+        },
+        schema="test",
+    )
+    assert all(export.adf_client is batch.adf_client for export in batch.exports)
+
+    with patch("df_to_azure.export.execute_stmt") as execute_stmt:
+        batch.create_schemas()
+        for export in batch.exports:
+            export.create_schema("test")
+            export.create_schema("staging")
+
+    assert execute_stmt.call_count == 2
+
+
 def test_mapping_column_types():
     """
     Test if the mapping of the pandas column types to SQL column types goes correctly.
@@ -147,6 +359,81 @@ def test_long_string():
     )
 
 
+def test_max_str_len():
+    """
+    Nulls are skipped and of categoricals only the categories are measured.
+    """
+    assert max_str_len(Series(["a", "abcdé", None, nan])) == 5
+    assert max_str_len(Series([None, nan])) == 0
+    assert max_str_len(Series(["ab", 123456])) == 6
+    assert max_str_len(Series(["a", "bcd"], dtype="string")) == 3
+    assert max_str_len(Series(["x", "yyyy", "x"] * 1000, dtype="category")) == 4
+
+
+def test_arrow_schema():
+    """
+    The parquet schema follows the SQL types, timestamps in microseconds and floats as decimals.
+    """
+    df = DataFrame(
+        {
+            "String": ["a", None, "c"],
+            "Int": [1, 2, 3],
+            "Float": [4.523, 5.28, nan],
+            "Date": date_range("2020-01-01", periods=3, freq="D"),
+        }
+    )
+    expected = pa.schema(
+        [
+            ("String", pa.string()),
+            ("Int", pa.int64()),
+            ("Float", pa.decimal128(18, 2)),
+            ("Date", pa.timestamp("us")),
+        ]
+    )
+    export = DfToAzure(df=df.copy(), tablename="arrow_schema", schema="test")
+    assert export.arrow_schema() == expected
+
+    table = pq.read_table(BytesIO(export.parquet_data()))
+    assert table.schema.remove_metadata() == expected
+    assert table.column("Float").to_pylist() == [Decimal("4.52"), Decimal("5.28"), None]
+    assert_frame_equal(export.df, df)
+
+
+def test_export_memory():
+    """
+    Serializing does not change the DataFrame and peak memory stays within a fixed factor of the DataFrame size.
+    """
+    n = 200_000
+    df = DataFrame(
+        {
+            "Int": range(n),
+            "Float": random(n),
+            "String": Series(["abc", "defgh", "x" * 30] * (n // 2))[:n].astype(object),
+            "Date": date_range("2020-01-01", periods=n, freq="s"),
+            "Timedelta": to_timedelta(range(n), unit="s"),
+            "Categorical": Series(["a", "b"] * (n // 2), dtype="category"),
+        }
+    )
+    expected = df.copy()
+    export = DfToAzure(df=df, tablename="export_memory", schema="test")
+
+    # the default memory pool keeps its peak since the start of the process, so measure with a fresh proxy pool
+    default_pool = pa.default_memory_pool()
+    pool = pa.proxy_memory_pool(default_pool)
+    pa.set_memory_pool(pool)
+    tracemalloc.start()
+    try:
+        export.get_max_str_len()
+        export.parquet_data()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        pa.set_memory_pool(default_pool)
+
+    assert_frame_equal(expected, df)
+    assert peak + pool.max_memory() < 2 * df.memory_usage(deep=True).sum()
+
+
 def test_quote_char():
     """
     Check if quote char is used correctly when line seperator is in text column
@@ -1,14 +1,21 @@
+import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 from time import sleep
+from unittest.mock import MagicMock, patch
 
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 import pytest
 from azure.storage.blob import BlobServiceClient
-from pandas import DataFrame, concat, read_parquet
+from pandas import DataFrame, Series, concat, read_parquet
 from pandas.testing import assert_frame_equal
 
-from df_to_azure import df_to_azure
+from df_to_azure import compact_parquet, df_to_azure, read_manifest
+from df_to_azure.cache import BlobCache
+from df_to_azure.parquet import bucket_numbers, sort_merge_upsert
 from df_to_azure.tests import data
 
 BLOB_SERVICE_CLIENT = BlobServiceClient.from_connection_string(os.environ.get("AZURE_STORAGE_CONNECTION_STRING"))
@@ -36,6 +43,25 @@ def test_create_not_existing_container():
     client_for_deletion.delete_container()
 
 
+def test_create_parquet_adaptive_upload():
+    df = DataFrame({"id": range(100_000), "value": ["abcdefghij"] * 100_000})
+    df_to_azure(
+        df=df,
+        tablename="adaptive_upload",
+        schema="test_parquet",
+        parquet=True,
+        block_size=64 * 1024,
+        max_single_put_size=64 * 1024,
+        max_concurrency=2,
+        adaptive_upload=True,
+    )
+
+    downloaded_blob = CONTAINER_CLIENT.download_blob("test_parquet/adaptive_upload.parquet")
+    result = read_parquet(BytesIO(downloaded_blob.readall()))
+
+    assert_frame_equal(df, result)
+
+
 def test_append_parquet():
     df = data["sample_1"]
 
@@ -44,6 +70,59 @@ def test_append_parquet():
     df_to_azure(df=df, tablename="my_test_tablename_append", schema="my_test_schema", parquet=True, method="append")
 
 
+def test_compact_parquet():
+    df = DataFrame({"id": range(10), "value": list("abcdefghij")})
+    prefix = "test_parquet/compact/"
+    for blob in CONTAINER_CLIENT.list_blobs(name_starts_with=prefix):
+        CONTAINER_CLIENT.delete_blob(blob.name)
+
+    # without sleeping in between, the file names do not collide
+    for _ in range(5):
+        df_to_azure(df=df, tablename="compact", schema="test_parquet", parquet=True, method="append", manifest=True)
+    assert len(list(CONTAINER_CLIENT.list_blobs(name_starts_with=f"{prefix}compact_"))) == 5
+
+    compacted = compact_parquet(tablename="compact", folder="test_parquet")
+
+    assert [blob.name for blob in CONTAINER_CLIENT.list_blobs(name_starts_with=f"{prefix}compact_")] == compacted
+    assert read_manifest(tablename="compact", folder="test_parquet")["path"].tolist() == compacted
+    result = read_parquet(BytesIO(CONTAINER_CLIENT.download_blob(compacted[0]).readall()))
+    assert_frame_equal(concat([df] * 5, ignore_index=True), result)
+
+
+def test_parquet_manifest():
+    df1 = DataFrame({"id": range(10), "day": ["2024-01-01", "2024-01-02"] * 5, "value": 1.0})
+    df2 = DataFrame({"id": [3, 10], "day": ["2024-01-02", "2024-01-03"], "value": 2.0})
+
+    df_to_azure(
+        df=df1,
+        tablename="manifest",
+        schema="test_parquet",
+        parquet=True,
+        id_field="id",
+        partition_cols="day",
+        manifest=True,
+    )
+    df_to_azure(
+        df=df2,
+        tablename="manifest",
+        schema="test_parquet",
+        method="upsert",
+        parquet=True,
+        id_field="id",
+        partition_cols="day",
+        manifest=True,
+    )
+
+    result = read_manifest(tablename="manifest", folder="test_parquet").sort_values("day", ignore_index=True)
+    assert result["path"].tolist() == [
+        f"test_parquet/manifest/day={day}/manifest.parquet" for day in ["2024-01-01", "2024-01-02", "2024-01-03"]
+    ]
+    assert result["rows"].tolist() == [5, 5, 1]
+    assert result["id_min"].tolist() == [0, 1, 10]
+    assert result["id_max"].tolist() == [8, 9, 10]
+    assert result["schema_hash"].nunique() == 1
+
+
 def test_upsert_parquet_same_shape():
     df = DataFrame({"id": range(1000, 1050, 10), "value1": range(10, 60, 10), "value2": list("abcde")})
     # upload original df to storage
@@ -67,6 +146,26 @@ def test_upsert_parquet_same_shape():
     assert_frame_equal(df, result)
 
 
+def test_upsert_parquet_stored_index():
+    # the index is stored as a column, which is not downloaded and not in the upserted file
+    df = DataFrame({"id": [1, 2, 3], "value": [1.0, 2.0, 3.0]}, index=[10, 20, 30])
+    df_to_azure(df=df, tablename="upsert_stored_index", schema="test_parquet", parquet=True)
+
+    df_to_azure(
+        df=DataFrame({"id": [3, 4], "value": [30.0, 4.0]}),
+        tablename="upsert_stored_index",
+        schema="test_parquet",
+        method="upsert",
+        parquet=True,
+        id_field="id",
+        max_concurrency=8,
+    )
+
+    downloaded_blob = CONTAINER_CLIENT.download_blob("test_parquet/upsert_stored_index.parquet")
+    result = read_parquet(BytesIO(downloaded_blob.readall()))
+    assert_frame_equal(DataFrame({"id": [1, 2, 3, 4], "value": [1.0, 2.0, 30.0, 4.0]}), result)
+
+
 def test_upsert_new_rows():
     df1 = DataFrame({"id": [1, 2, 3], "value1": ["A", "B", "C"], "value2": ["D", "E", "F"]})
 
@@ -77,10 +176,12 @@ def test_upsert_new_rows():
     # upload original df to storage
     df_to_azure(df=df1, tablename="upsert_new_rows", schema="test_parquet", parquet=True)
 
-    # perform upsert
+    # perform upsert, the given dataframe is not changed
+    expected = df2.copy()
     df_to_azure(
         df=df2, tablename="upsert_new_rows", schema="test_parquet", method="upsert", parquet=True, id_field=["id"]
     )
+    assert_frame_equal(expected, df2)
 
     # download the parquet back
     downloaded_blob = CONTAINER_CLIENT.download_blob("test_parquet/upsert_new_rows.parquet")
@@ -155,3 +256,190 @@ def test_upsert_nans():
 
     # check if upsert was successful
     assert_frame_equal(expected, result)
+
+
+def test_upsert_parquet_arrow_engine():
+    df1 = DataFrame({"id": [1, 2, 3], "value1": [1.5, 2.5, 3.5], "value2": ["D", "E", "F"]})
+    df2 = DataFrame({"id": [4, 2], "value1": [np.nan, 9.5], "value2": ["ZZ", "EE"]})
+
+    df_to_azure(df=df1, tablename="upsert_arrow", schema="test_parquet", parquet=True)
+    df_to_azure(
+        df=df2,
+        tablename="upsert_arrow",
+        schema="test_parquet",
+        method="upsert",
+        parquet=True,
+        id_field="id",
+        upsert_engine="arrow",
+    )
+
+    downloaded_blob = CONTAINER_CLIENT.download_blob("test_parquet/upsert_arrow.parquet")
+    result = read_parquet(BytesIO(downloaded_blob.readall()))
+
+    # untouched rows first, followed by the new rows
+    expected = DataFrame({"id": [1, 3, 4, 2], "value1": [1.5, 3.5, np.nan, 9.5], "value2": ["D", "F", "ZZ", "EE"]})
+    assert_frame_equal(expected, result)
+
+
+def test_upsert_parquet_sort_merge_engine():
+    df1 = DataFrame({"id": range(0, 100_000, 2), "value": "existing"})
+    df2 = DataFrame({"id": [99_999, 10, 3, -1], "value": "new"})
+
+    df_to_azure(df=df1, tablename="upsert_sort_merge", schema="test_parquet", parquet=True)
+    df_to_azure(
+        df=df2,
+        tablename="upsert_sort_merge",
+        schema="test_parquet",
+        method="upsert",
+        parquet=True,
+        id_field="id",
+        upsert_engine="sort_merge",
+    )
+
+    downloaded_blob = CONTAINER_CLIENT.download_blob("test_parquet/upsert_sort_merge.parquet")
+    result = read_parquet(BytesIO(downloaded_blob.readall()))
+
+    expected = concat([df1[df1["id"] != 10], df2]).sort_values("id", ignore_index=True)
+    assert_frame_equal(expected, result)
+
+
+def test_upsert_parquet_concurrent():
+    df = DataFrame({"id": range(10), "value": 0})
+    df_to_azure(df=df, tablename="concurrent", schema="test_parquet", parquet=True)
+
+    def upsert(i):
+        df_to_azure(
+            df=DataFrame({"id": [i, 10 + i], "value": 1}),
+            tablename="concurrent",
+            schema="test_parquet",
+            method="upsert",
+            parquet=True,
+            id_field="id",
+            max_upsert_attempts=20,
+        )
+
+    # the workers upsert the same file at the same time, the conflicting uploads are retried
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(upsert, range(4)))
+
+    result = read_parquet(BytesIO(CONTAINER_CLIENT.download_blob("test_parquet/concurrent.parquet").readall()))
+    assert result.loc[result["value"] == 1, "id"].tolist() == [0, 1, 2, 3, 10, 11, 12, 13]
+    assert len(result) == 14
+
+
+def test_upsert_parquet_cache(tmp_path):
+    df = DataFrame({"id": range(5), "value": 0})
+    kwargs = {"tablename": "upsert_cache", "schema": "test_parquet", "parquet": True, "id_field": "id"}
+    df_to_azure(df=df, cache_dir=str(tmp_path), **kwargs)
+
+    # the first upsert uses the uploaded file in the cache, the second downloads the file changed by another writer
+    df_to_azure(df=DataFrame({"id": [0], "value": 1}), method="upsert", cache_dir=str(tmp_path), **kwargs)
+    df_to_azure(df=DataFrame({"id": [1], "value": 2}), method="upsert", **kwargs)
+    df_to_azure(df=DataFrame({"id": [2], "value": 3}), method="upsert", cache_dir=str(tmp_path), **kwargs)
+
+    result = read_parquet(BytesIO(CONTAINER_CLIENT.download_blob("test_parquet/upsert_cache.parquet").readall()))
+    assert_frame_equal(DataFrame({"id": range(5), "value": [1, 2, 3, 0, 0]}), result)
+    assert len(list(tmp_path.glob("*.json"))) == 1
+
+
+def test_blob_cache_orphaned_data(tmp_path):
+    cache = BlobCache(str(tmp_path))
+    blob_client = MagicMock(account_name="account", container_name="parquet", blob_name="race.parquet")
+    # two processes which both find no entry, the entry of the second replaces the entry of the first
+    with patch.object(cache, "entry", return_value=None):
+        cache.put(blob_client, b"first", "etag1")
+        cache.put(blob_client, b"second", "etag2")
+    assert len(list(tmp_path.glob("*.data"))) == 2
+
+    # the data file of the first process is removed once it is older than ORPHAN_AGE
+    cache.evict()
+    assert len(list(tmp_path.glob("*.data"))) == 2
+    for path in tmp_path.glob("*.data"):
+        os.utime(path, (0, 0))
+    cache.evict()
+
+    buffer, etag = cache.read(cache.key(blob_client))
+    assert [path.name for path in tmp_path.glob("*.data")] == [cache.entry(cache.key(blob_client))["file"]]
+    assert (buffer.to_pybytes(), etag) == (b"second", "etag2")
+
+
+def test_upsert_parquet_partitioned():
+    df1 = DataFrame({"day": ["2024-01-01", "2024-01-01", "2024-01-02"], "id": [1, 2, 3], "value": [1.0, 2.0, 3.0]})
+    df2 = DataFrame({"day": ["2024-01-02", "2024-01-03"], "id": [3, 4], "value": [30.0, 40.0]})
+
+    df_to_azure(df=df1, tablename="partitioned", schema="test_parquet", parquet=True, partition_cols=["day"])
+    first_partition = CONTAINER_CLIENT.get_blob_client("test_parquet/partitioned/day=2024-01-01/partitioned.parquet")
+    last_modified = first_partition.get_blob_properties().last_modified
+
+    df_to_azure(
+        df=df2,
+        tablename="partitioned",
+        schema="test_parquet",
+        method="upsert",
+        parquet=True,
+        id_field=["day", "id"],
+        partition_cols=["day"],
+    )
+
+    # the partition without new rows is not rewritten
+    assert first_partition.get_blob_properties().last_modified == last_modified
+    downloaded_blob = CONTAINER_CLIENT.download_blob("test_parquet/partitioned/day=2024-01-02/partitioned.parquet")
+    result = read_parquet(BytesIO(downloaded_blob.readall()))
+    assert_frame_equal(DataFrame({"id": [3], "value": [30.0]}), result)
+    assert CONTAINER_CLIENT.get_blob_client("test_parquet/partitioned/day=2024-01-03/partitioned.parquet").exists()
+
+
+def test_bucket_numbers_dtypes():
+    keys = [-1, 5, 2**31 - 1]
+    expected = bucket_numbers(DataFrame({"id": np.array(keys, dtype="int64")}), ["id"], 8)
+
+    for dtype in ("int32", "Int64", "float64"):
+        df = DataFrame({"id": Series(keys, dtype=dtype)})
+        np.testing.assert_array_equal(expected, bucket_numbers(df, ["id"], 8))
+
+    # a null makes the column float, the other keys keep their bucket
+    with_null = bucket_numbers(DataFrame({"id": [-1, None, 5]}), ["id"], 8)
+    np.testing.assert_array_equal(expected[:2], with_null[[0, 2]])
+
+
+def test_bucket_numbers_other_keys():
+    # the bucket of a key does not depend on the other keys in the frame
+    expected = bucket_numbers(DataFrame({"id": [1]}), ["id"], 16)[0]
+    for keys in ([1.0, 2.0], [1.0, 2.5], [1.0, None], [1, "a"], [1.0, "a"]):
+        assert bucket_numbers(DataFrame({"id": Series(keys, dtype=object)}), ["id"], 16)[0] == expected
+        if "a" not in keys:
+            assert bucket_numbers(DataFrame({"id": keys}), ["id"], 16)[0] == expected
+
+
+def test_sort_merge_upsert_null_key():
+    existing = BytesIO()
+    pq.write_table(pa.table({"id": [1, 2, 3, None], "value": list("abcd")}), existing, row_group_size=2)
+    new = pa.table({"id": [None, 2, 5], "value": list("xyz")})
+    sink = BytesIO()
+
+    sort_merge_upsert(pq.ParquetFile(existing), new, ["id"], sink)
+
+    # like the pandas engine, the null key is updated, nulls are sorted last
+    result = pq.read_table(BytesIO(sink.getvalue()))
+    assert result.to_pydict() == {"id": [1, 2, 3, 5, None], "value": ["a", "y", "c", "z", "x"]}
+
+
+def test_upsert_parquet_buckets():
+    df1 = DataFrame({"id": range(100), "value": 1.0})
+    df2 = DataFrame({"id": [5, 100], "value": [2.0, 3.0]})
+
+    df_to_azure(df=df1, tablename="buckets", schema="test_parquet", parquet=True, id_field="id", buckets=8)
+    df_to_azure(
+        df=df2, tablename="buckets", schema="test_parquet", method="upsert", parquet=True, id_field="id", buckets=8
+    )
+
+    metadata = CONTAINER_CLIENT.download_blob("test_parquet/buckets/_bucketing.json").readall()
+    assert json.loads(metadata)["buckets"] == 8
+    frames = [
+        read_parquet(BytesIO(CONTAINER_CLIENT.download_blob(blob.name).readall()))
+        for blob in CONTAINER_CLIENT.list_blobs(name_starts_with="test_parquet/buckets/buckets_")
+    ]
+    result = concat(frames).sort_values("id", ignore_index=True)
+
+    expected = concat([df1[df1["id"] != 5], df2]).sort_values("id", ignore_index=True)
+    assert_frame_equal(expected, result)
@@ -1,12 +1,16 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
 
+import pyarrow as pa
 import pytest
 from pandas import DataFrame, read_csv, read_sql_table
 from pandas._testing import assert_frame_equal
 
-from df_to_azure import df_to_azure
-from df_to_azure.db import auth_azure
+from df_to_azure import df_to_azure, df_to_azure_many
+from df_to_azure.db import SqlUpsert, auth_azure, execute_stmt
 from df_to_azure.exceptions import UpsertError
+from df_to_azure.transport import CostModel, write_csv
 
 from ..tests import data
 
@@ -48,6 +52,198 @@ def test_upsert_sample(file_dir="data"):
     assert_frame_equal(expected, result)
 
 
+def test_upsert_procedure_hash():
+    upsert = SqlUpsert(table_name="sample", schema="test", id_cols=["col_a"], columns=data["sample_2"].columns)
+    # deployed by test_upsert_sample, so this call does not alter the procedure
+    upsert.create_stored_procedure()
+
+    with auth_azure() as con:
+        deployed_hash = con.execute(upsert.select_hash()).scalar()
+
+    assert deployed_hash == upsert.definition_hash(upsert.create_merge_query())
+
+
+def test_upsert_procedure_concurrent_deploy():
+    upsert = SqlUpsert(
+        table_name="sample_concurrent", schema="test", id_cols=["col_a"], columns=data["sample_2"].columns
+    )
+    execute_stmt(upsert.drop_procedure().text)
+
+    # every deployer finds the procedure missing, only the first one deploys it
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        list(pool.map(lambda _: upsert.create_stored_procedure(), range(4)))
+
+    with auth_azure() as con:
+        deployed_hash = con.execute(upsert.select_hash()).scalar()
+    execute_stmt(upsert.drop_procedure().text)
+
+    assert deployed_hash == upsert.definition_hash(upsert.create_merge_query())
+
+
+def test_upsert_bulk_insert():
+    df_to_azure(df=data["sample_1"], tablename="sample_bulk_insert", schema="test", transport="bulk_insert")
+    df_to_azure(
+        df=data["sample_2"],
+        tablename="sample_bulk_insert",
+        schema="test",
+        method="upsert",
+        id_field="col_a",
+        transport="bulk_insert",
+        batch_size=2,
+    )
+
+    expected = DataFrame(
+        {
+            "col_a": [1, 3, 4, 5, 6],
+            "col_b": ["updated value", "test", "test", "new value", "also new"],
+            "col_c": ["E", "Z", "A", "F", "H"],
+        }
+    )
+
+    with auth_azure() as con:
+        result = read_sql_table(table_name="sample_bulk_insert", con=con, schema="test")
+
+    assert_frame_equal(expected, result)
+
+
+def test_upsert_blob_bulk_insert():
+    df_to_azure(df=data["sample_1"], tablename="sample_blob_bulk_insert", schema="test", transport="blob_bulk_insert")
+    df_to_azure(
+        df=data["sample_2"],
+        tablename="sample_blob_bulk_insert",
+        schema="test",
+        method="upsert",
+        id_field="col_a",
+        transport="blob_bulk_insert",
+    )
+
+    expected = DataFrame(
+        {
+            "col_a": [1, 3, 4, 5, 6],
+            "col_b": ["updated value", "test", "test", "new value", "also new"],
+            "col_c": ["E", "Z", "A", "F", "H"],
+        }
+    )
+
+    with auth_azure() as con:
+        result = read_sql_table(table_name="sample_blob_bulk_insert", con=con, schema="test")
+
+    assert_frame_equal(expected, result)
+
+
+@pytest.mark.parametrize("key_hash", [False, True])
+def test_upsert_batched(key_hash):
+    tablename = f"sample_batched{'_hash' if key_hash else ''}"
+    df_to_azure(df=data["sample_1"], tablename=tablename, schema="test", transport="bulk_insert")
+    df_to_azure(
+        df=data["sample_2"],
+        tablename=tablename,
+        schema="test",
+        method="upsert",
+        id_field="col_a",
+        transport="bulk_insert",
+        upsert_batch_size=2,
+        upsert_key_hash=key_hash,
+    )
+
+    expected = DataFrame(
+        {
+            "col_a": [1, 3, 4, 5, 6],
+            "col_b": ["updated value", "test", "test", "new value", "also new"],
+            "col_c": ["E", "Z", "A", "F", "H"],
+        }
+    )
+
+    with auth_azure() as con:
+        result = read_sql_table(table_name=tablename, con=con, schema="test")
+
+    assert_frame_equal(expected, result.sort_values("col_a", ignore_index=True))
+
+
+def test_upsert_batched_null_key():
+    df1 = DataFrame({"key": ["a", "b"], "value": [1, 2]})
+    df2 = DataFrame({"key": ["b", None, "c"], "value": [3, 4, 5]})
+    df_to_azure(df=df1, tablename="sample_batched_null", schema="test", transport="bulk_insert")
+    df_to_azure(
+        df=df2,
+        tablename="sample_batched_null",
+        schema="test",
+        method="upsert",
+        id_field="key",
+        transport="bulk_insert",
+        upsert_batch_size=1,
+    )
+
+    with auth_azure() as con:
+        result = read_sql_table(table_name="sample_batched_null", con=con, schema="test")
+
+    # like the single MERGE, the row with a null key is inserted
+    expected = DataFrame({"key": ["a", "b", "c", None], "value": [1, 3, 5, 4]})
+    assert_frame_equal(expected, result.sort_values("key", ignore_index=True))
+
+
+def test_write_csv():
+    df = DataFrame({"id": [1, 2, 3, 4, 5], "text": ['a,"b', "line\nbreak", "", None, "plain"]})
+    schema = pa.schema([pa.field("id", pa.int64()), pa.field("text", pa.string())])
+    sink = BytesIO()
+    write_csv(df, sink, schema, chunk_size=2)
+
+    assert sink.getvalue().decode() == '1,"a,""b"\n2,"line\nbreak"\n3,""\n4,\n5,"plain"\n'
+
+
+def test_blob_bulk_insert_values():
+    df = DataFrame({"id": [1, 2, 3, 4, 5], "text": ['a,"b', "line\nbreak", "", None, "plain"]})
+    df_to_azure(df=df, tablename="blob_bulk_insert_values", schema="test", transport="blob_bulk_insert")
+
+    with auth_azure() as con:
+        result = read_sql_table(table_name="blob_bulk_insert_values", con=con, schema="test")
+
+    # with KEEPNULLS an empty string stays an empty string and a null stays null
+    assert_frame_equal(df, result.sort_values("id", ignore_index=True))
+
+
+def test_append_blob_bulk_insert_column_order():
+    df = DataFrame({"col_a": [1, 2], "col_b": ["x", "y"], "col_c": ["A", "B"]})
+    df_to_azure(df=df, tablename="blob_bulk_insert_order", schema="test", transport="blob_bulk_insert")
+    appended = DataFrame({"col_c": ["C"], "col_a": [3], "col_b": ["z"]})
+    df_to_azure(
+        df=appended, tablename="blob_bulk_insert_order", schema="test", method="append", transport="blob_bulk_insert"
+    )
+
+    with auth_azure() as con:
+        result = read_sql_table(table_name="blob_bulk_insert_order", con=con, schema="test")
+
+    expected = DataFrame({"col_a": [1, 2, 3], "col_b": ["x", "y", "z"], "col_c": ["A", "B", "C"]})
+    assert_frame_equal(expected, result.sort_values("col_a", ignore_index=True))
+
+    with pytest.raises(ValueError):
+        df_to_azure(
+            df=appended.drop(columns="col_c"),
+            tablename="blob_bulk_insert_order",
+            schema="test",
+            method="append",
+            transport="blob_bulk_insert",
+        )
+
+
+def test_transport_auto():
+    cost_model = CostModel(
+        {
+            "adf": {"startup": 60.0, "row_cost": 0.0, "byte_cost": 0.0},
+            "bulk_insert": {"startup": 1.0, "row_cost": 0.001, "byte_cost": 0.0},
+            "blob_bulk_insert": {"startup": 10.0, "row_cost": 0.001, "byte_cost": 0.0},
+        }
+    )
+
+    assert cost_model.choose(data["sample_1"]) == "bulk_insert"
+    assert cost_model.choose(DataFrame({"col_a": range(100_000)})) == "adf"
+
+    # without a calibration the transport which needs extra DDL rights is not chosen
+    large = DataFrame({"col_a": range(10_000_000)})
+    assert CostModel().choose(large) == "adf"
+    assert CostModel(calibrated=True).choose(large) == "blob_bulk_insert"
+
+
 def test_upsert_category(file_dir="data"):
     df = data["category_2"]
     df_to_azure(
@@ -236,3 +432,75 @@ def test_upsert_same_tablename(clean_staging):
                 id_field="test_a",
                 wait_till_finished=True,
             )
+
+
+def test_upsert_generic_pipeline():
+    """
+    The generic pipeline should give the same result as the pipeline per table.
+    """
+    df_to_azure(
+        df=data["sample_1"],
+        tablename="sample_generic",
+        schema="test",
+        method="create",
+        wait_till_finished=True,
+        generic_pipeline=True,
+    )
+    df_to_azure(
+        df=data["sample_2"],
+        tablename="sample_generic",
+        schema="test",
+        method="upsert",
+        id_field="col_a",
+        wait_till_finished=True,
+        generic_pipeline=True,
+    )
+
+    expected = DataFrame(
+        {
+            "col_a": [1, 3, 4, 5, 6],
+            "col_b": ["updated value", "test", "test", "new value", "also new"],
+            "col_c": ["E", "Z", "A", "F", "H"],
+        }
+    )
+
+    with auth_azure() as con:
+        result = read_sql_table(table_name="sample_generic", con=con, schema="test")
+
+    assert_frame_equal(expected, result)
+
+
+def test_upsert_many():
+    """
+    Create and upsert multiple tables with one pipeline run.
+    """
+    df_to_azure_many(
+        tables={"sample_many": data["sample_1"], "employee_many": data["employee_1"]},
+        schema="test",
+        method="create",
+        wait_till_finished=True,
+    )
+    df_to_azure_many(
+        tables={
+            "sample_many": {"df": data["sample_2"], "id_field": "col_a"},
+            "employee_many": {"df": data["employee_2"], "id_field": ["employee_id", "week_nr"]},
+        },
+        schema="test",
+        method="upsert",
+        wait_till_finished=True,
+    )
+
+    expected = DataFrame(
+        {
+            "col_a": [1, 3, 4, 5, 6],
+            "col_b": ["updated value", "test", "test", "new value", "also new"],
+            "col_c": ["E", "Z", "A", "F", "H"],
+        }
+    )
+
+    with auth_azure() as con:
+        result_sample = read_sql_table(table_name="sample_many", con=con, schema="test")
+        result_employee = read_sql_table(table_name="employee_many", con=con, schema="test")
+
+    assert_frame_equal(expected, result_sample)
+    assert_frame_equal(data["employee_2"], result_employee)
@@ -6,7 +6,7 @@ from sqlalchemy.sql import text
 def test_clean_up_db():
     tables_dict = {
         "covid": ["covid_19"],
-        "staging": ["category", "employee_1", "sample", "sample_spaces_column_name"],
+        "staging": ["category", "employee_1", "sample", "sample_generic", "sample_spaces_column_name"],
         "test": [
             "category",
             "category_1",
@@ -30,6 +30,22 @@ def test_clean_up_db():
             "bigint",
             "bigint_convert",
             "given_dtype",
+            "employee_streaming",
+            "provisioning_cache",
+            "run_handle_1",
+            "run_handle_2",
+            "sample_generic",
+            "sample_many",
+            "employee_many",
+            "sample_async",
+            "category_async",
+            "sample_bulk_insert",
+            "sample_blob_bulk_insert",
+            "blob_bulk_insert_values",
+            "blob_bulk_insert_order",
+            "sample_batched",
+            "sample_batched_hash",
+            "sample_batched_null",
         ],
     }
 
@@ -0,0 +1,388 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pcsv
+from azure.storage.blob import ContainerSasPermissions, generate_container_sas
+from pandas import DataFrame
+from sqlalchemy.types import BigInteger, Boolean, DateTime, Float, Integer, Numeric, String
+
+from df_to_azure.blob import DEFAULT_ROW_GROUP_SIZE, to_arrow_table
+from df_to_azure.db import execute_stmt, get_engine
+
+# Ways to load a DataFrame into Azure SQL: an ADF copy of the parquet file, inserts over the database connection, or
+# a BULK INSERT by the database of a CSV file in blob storage.
+TRANSPORTS = ("adf", "bulk_insert", "blob_bulk_insert")
+# Transports which need the rights to create a master key, database scoped credential and external data source, they
+# are only chosen by transport="auto" after a calibration showed they work in the environment.
+DDL_TRANSPORTS = ("blob_bulk_insert",)
+# Cost of a transport in seconds is startup + rows * row_cost + size * byte_cost, with size the estimated size of the
+# data in bytes. These constants are used until `python -m df_to_azure.calibrate` measured them for the environment.
+DEFAULT_COSTS = {
+    # a pipeline run is queued and the copy activity started before any data is copied
+    "adf": {"startup": 60.0, "row_cost": 0.0, "byte_cost": 1 / (20 * 1024 * 1024)},
+    "bulk_insert": {"startup": 1.0, "row_cost": 1 / 50_000, "byte_cost": 1 / (10 * 1024 * 1024)},
+    "blob_bulk_insert": {"startup": 5.0, "row_cost": 0.0, "byte_cost": 1 / (40 * 1024 * 1024)},
+}
+# Number of rows sent per executemany call and committed at once.
+DEFAULT_BATCH_SIZE = 10_000
+# Number of connections inserting batches in parallel.
+DEFAULT_MAX_CONNECTIONS = 4
+# Number of hours the SAS token of the external data source is valid, it is renewed after half of this time.
+SAS_TTL_HOURS = 24
+
+# Expiry of the SAS token this process set on the credential of every external data source, by environment and name.
+_sas_expiries = {}
+_sas_lock = threading.Lock()
+
+
+def calibration_path() -> str:
+    """
+    Path of the json file with the calibrated costs, in env variable DF_TO_AZURE_CACHE_DIR or ~/.cache/df_to_azure.
+    """
+    cache_dir = os.environ.get("DF_TO_AZURE_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "df_to_azure"))
+
+    return os.path.join(cache_dir, "calibration.json")
+
+
+def environment() -> str:
+    """
+    Server and database in the environment variables, the costs are calibrated per environment.
+    """
+    return f"{os.environ.get('SQL_SERVER')}/{os.environ.get('SQL_DB')}"
+
+
+def estimate_size(df: DataFrame) -> int:
+    """
+    Estimated size of the data in bytes, the memory usage of the columns including the characters of strings.
+    """
+    return int(df.memory_usage(index=False, deep=True).sum())
+
+
+class CostModel:
+    """
+    Estimates the time to load a DataFrame with every transport, to choose the fastest for transport="auto".
+
+    The costs per transport are the seconds to start a load, per row and per byte. They are calibrated per
+    environment with `python -m df_to_azure.calibrate`, which stores them in calibration_path().
+    """
+
+    def __init__(self, costs: dict = None, calibrated: bool = False):
+        """
+        Parameters
+        ----------
+        costs: dict
+            Startup, row_cost and byte_cost by transport, the default costs are used for missing transports.
+        calibrated: bool
+            Costs were measured in this environment.
+        """
+        self.costs = {
+            transport: {**DEFAULT_COSTS[transport], **(costs or {}).get(transport, {})} for transport in TRANSPORTS
+        }
+        self.calibrated = calibrated
+
+    @staticmethod
+    def _load(path: str) -> dict:
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    @classmethod
+    def load(cls, path: str = None) -> "CostModel":
+        """
+        Costs calibrated for the current environment, the default costs when it was not calibrated.
+        """
+        calibration = cls._load(path or calibration_path()).get(environment())
+        if calibration is None:
+            return cls()
+
+        return cls(calibration["costs"], calibrated=True)
+
+    def save(self, path: str = None):
+        path = path or calibration_path()
+        calibrations = self._load(path)
+        calibrations[environment()] = {"costs": self.costs}
+
+        directory = os.path.dirname(path) or "."
+        os.makedirs(directory, exist_ok=True)
+        # Write to a temporary file first, so concurrent readers never see a half written file
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(calibrations, f, indent=2)
+        os.replace(tmp_path, path)
+
+    def estimate(self, transport: str, rows: int, size: int) -> float:
+        """
+        Estimated seconds to load rows with a total size of size bytes with the transport.
+        """
+        costs = self.costs[transport]
+
+        return costs["startup"] + rows * costs["row_cost"] + size * costs["byte_cost"]
+
+    def choose(self, df: DataFrame) -> str:
+        """
+        The transport with the lowest estimated time to load the DataFrame, the decision is logged. Without a
+        calibration the transports which need extra DDL rights are not chosen.
+        """
+        rows, size = df.shape[0], estimate_size(df)
+        transports = [t for t in TRANSPORTS if self.calibrated or t not in DDL_TRANSPORTS]
+        estimates = {transport: self.estimate(transport, rows, size) for transport in transports}
+        transport = min(estimates, key=estimates.get)
+        logging.info(
+            f"Chose transport {transport} for {rows} records of {size / 1024 / 1024:.1f} MB, estimated "
+            + ", ".join(f"{name}: {seconds:.1f}s" for name, seconds in estimates.items())
+            + f" ({'calibrated' if self.calibrated else 'default'} costs)."
+        )
+
+        return transport
+
+
+def input_sizes(sql_types: dict) -> list:
+    """
+    Parameter types of pyodbc for the SQL types of the columns.
+
+    With fast_executemany pyodbc otherwise derives the parameter types from the first row, which fails when the first
+    value of a column is null.
+    """
+    import pyodbc
+
+    sizes = []
+    for sql_type in sql_types.values():
+        if isinstance(sql_type, String):
+            sizes.append((pyodbc.SQL_WVARCHAR, sql_type.length or 0, 0))
+        elif isinstance(sql_type, Boolean):
+            sizes.append((pyodbc.SQL_BIT, 0, 0))
+        elif isinstance(sql_type, BigInteger):
+            sizes.append((pyodbc.SQL_BIGINT, 0, 0))
+        elif isinstance(sql_type, Integer):
+            sizes.append((pyodbc.SQL_INTEGER, 0, 0))
+        elif isinstance(sql_type, Float):
+            sizes.append((pyodbc.SQL_DOUBLE, 0, 0))
+        elif isinstance(sql_type, Numeric):
+            sizes.append((pyodbc.SQL_DECIMAL, sql_type.precision, sql_type.scale))
+        elif isinstance(sql_type, DateTime):
+            sizes.append((pyodbc.SQL_TYPE_TIMESTAMP, 27, 7))
+        else:
+            sizes.append(None)
+
+    return sizes
+
+
+def table_rows(table: pa.Table) -> list:
+    """
+    Rows of a table as tuples of Python values, timestamps with a time zone are converted to UTC without time zone.
+    """
+    columns = []
+    for column in table.columns:
+        if pa.types.is_timestamp(column.type) and column.type.tz is not None:
+            column = pc.cast(column, pa.timestamp(column.type.unit))
+        columns.append(column.to_pylist())
+
+    return list(zip(*columns))
+
+
+class BulkInsert:
+    """
+    Insert the rows of a table into Azure SQL with pyodbc fast_executemany, without a pipeline.
+
+    The table is split in batches of batch_size rows, which are inserted and committed on max_connections pooled
+    connections in parallel. When a batch fails the batches which were already committed stay in the table, like
+    with the copy activity of ADF.
+    """
+
+    def __init__(
+        self,
+        schema: str,
+        table_name: str,
+        sql_types: dict,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        max_connections: int = DEFAULT_MAX_CONNECTIONS,
+    ):
+        """
+        Parameters
+        ----------
+        schema: str
+            Schema of the table to insert into.
+        table_name: str
+            Name of the table to insert into.
+        sql_types: dict
+            SQL types by column name, in the order of the columns of the inserted table.
+        batch_size: int
+            Number of rows per executemany call and commit.
+        max_connections: int
+            Number of connections inserting in parallel.
+        """
+        self.schema = schema
+        self.table_name = table_name
+        self.sql_types = sql_types
+        self.batch_size = batch_size
+        self.max_connections = max_connections
+
+    def insert_statement(self) -> str:
+        columns = ", ".join(f"[{col}]" for col in self.sql_types)
+        parameters = ", ".join("?" for _ in self.sql_types)
+
+        return f"INSERT INTO [{self.schema}].[{self.table_name}] ({columns}) VALUES ({parameters})"
+
+    def insert_batch(self, batch: pa.Table) -> int:
+        # a raw pyodbc connection from the pool of the engine, closing it returns it to the pool
+        con = get_engine().raw_connection()
+        try:
+            cursor = con.cursor()
+            cursor.fast_executemany = True
+            cursor.setinputsizes(input_sizes(self.sql_types))
+            cursor.executemany(self.insert_statement(), table_rows(batch))
+            con.commit()
+        finally:
+            con.close()
+
+        return batch.num_rows
+
+    def run(self, table: pa.Table) -> int:
+        """
+        Insert the rows of the table.
+
+        Returns
+        -------
+        num_rows: int
+            Number of inserted rows.
+        """
+        batches = (table.slice(offset, self.batch_size) for offset in range(0, table.num_rows, self.batch_size))
+        with ThreadPoolExecutor(max_workers=self.max_connections) as executor:
+            num_rows = sum(executor.map(self.insert_batch, batches))
+        logging.info(f"Inserted {num_rows} records into {self.schema}.{self.table_name}.")
+
+        return num_rows
+
+
+def csv_table(table: pa.Table) -> pa.Table:
+    """
+    Table with the values in the form BULK INSERT reads them from CSV.
+
+    Timestamps are written in UTC with milliseconds, which fit both datetime and datetime2 columns, and booleans as
+    0 and 1.
+    """
+    columns = []
+    for column in table.columns:
+        if pa.types.is_timestamp(column.type):
+            column = pc.cast(column, pa.timestamp("ms", column.type.tz), safe=False).cast(pa.timestamp("ms"))
+            column = pc.strftime(column, format="%Y-%m-%d %H:%M:%S")
+        elif pa.types.is_boolean(column.type):
+            column = column.cast(pa.int8())
+        columns.append(column)
+
+    return pa.Table.from_arrays(columns, names=table.column_names)
+
+
+def write_csv(df: DataFrame, sink, schema: pa.Schema, chunk_size: int = DEFAULT_ROW_GROUP_SIZE):
+    """
+    Write a DataFrame as CSV without header to a file-like sink, chunk_size rows at a time.
+
+    The schema is required, with an inferred schema a column of only nulls gets the null type and the strings of
+    later chunks would not be quoted. Empty strings are written as "" and nulls as an empty field.
+    """
+    csv_schema = csv_table(to_arrow_table(df.iloc[:0], schema)).schema
+    with pcsv.CSVWriter(sink, csv_schema, write_options=pcsv.WriteOptions(include_header=False)) as writer:
+        for start in range(0, len(df), chunk_size):
+            writer.write_table(csv_table(to_arrow_table(df.iloc[start : start + chunk_size], schema)))
+
+
+class ExternalDataSource:
+    """
+    External data source of Azure SQL for a blob container, to BULK INSERT files from the container.
+
+    The data source uses a database scoped credential with a read-only SAS token of the container. Creating the
+    master key, credential and data source is idempotent, every process renews the SAS token of the credential when
+    the token it set is half expired.
+    """
+
+    def __init__(self, account_name: str, account_key: str, container_name: str = "dftoazure"):
+        """
+        Parameters
+        ----------
+        account_name: str
+            Name of the storage account.
+        account_key: str
+            Key of the storage account, to sign the SAS token.
+        container_name: str
+            Name of the container with the files.
+        """
+        self.account_name = account_name
+        self.account_key = account_key
+        self.container_name = container_name
+
+    @property
+    def name(self) -> str:
+        return f"dftoazure_{self.account_name}_{self.container_name}"
+
+    def sas_token(self, expiry: datetime) -> str:
+        return generate_container_sas(
+            self.account_name,
+            self.container_name,
+            account_key=self.account_key,
+            permission=ContainerSasPermissions(read=True, list=True),
+            expiry=expiry,
+        )
+
+    def create_statement(self, sas_token: str) -> str:
+        credential = f"[{self.name}] WITH IDENTITY = 'SHARED ACCESS SIGNATURE', SECRET = '{sas_token.lstrip('?')}'"
+        return f"""
+        IF NOT EXISTS (SELECT * FROM sys.symmetric_keys WHERE name = '##MS_DatabaseMasterKey##')
+            CREATE MASTER KEY;
+        IF EXISTS (SELECT * FROM sys.database_scoped_credentials WHERE name = N'{self.name}')
+            ALTER DATABASE SCOPED CREDENTIAL {credential};
+        ELSE
+            CREATE DATABASE SCOPED CREDENTIAL {credential};
+        IF NOT EXISTS (SELECT * FROM sys.external_data_sources WHERE name = N'{self.name}')
+            CREATE EXTERNAL DATA SOURCE [{self.name}] WITH (
+                TYPE = BLOB_STORAGE,
+                LOCATION = 'https://{self.account_name}.blob.core.windows.net/{self.container_name}',
+                CREDENTIAL = [{self.name}]
+            );
+        """
+
+    def create(self):
+        """
+        Create the data source, or renew its SAS token when the token set by this process is half expired.
+        """
+        now = datetime.now(timezone.utc)
+        with _sas_lock:
+            key = (environment(), self.name)
+            expiry = _sas_expiries.get(key)
+            if expiry is not None and expiry - now > timedelta(hours=SAS_TTL_HOURS / 2):
+                return
+            expiry = now + timedelta(hours=SAS_TTL_HOURS)
+            execute_stmt(self.create_statement(self.sas_token(expiry)))
+            _sas_expiries[key] = expiry
+        logging.info(f"Created external data source {self.name}.")
+
+
+def bulk_insert_statement(schema: str, table_name: str, blob_name: str, data_source: str, batch_size: int) -> str:
+    """
+    BULK INSERT of a CSV file written by write_csv from an external data source, with a table lock so the rows are
+    minimally logged, committed every batch_size rows.
+    """
+    return f"""
+    BULK INSERT [{schema}].[{table_name}]
+    FROM '{blob_name}'
+    WITH (
+        DATA_SOURCE = '{data_source}',
+        FORMAT = 'CSV',
+        FIELDQUOTE = '"',
+        FIELDTERMINATOR = ',',
+        ROWTERMINATOR = '0x0a',
+        CODEPAGE = '65001',
+        KEEPNULLS,
+        TABLOCK,
+        MAXERRORS = 0,
+        BATCHSIZE = {batch_size}
+    );
+    """
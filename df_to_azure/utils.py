@@ -1,8 +1,8 @@
 import logging
 import os
-import time
 
-from df_to_azure.exceptions import DoubleColumnNamesError, PipelineRunError
+from df_to_azure.exceptions import DoubleColumnNamesError
+from df_to_azure.runs import PipelineRunHandle
 
 
 def print_item(group):
@@ -66,27 +66,26 @@ def wait_until_pipeline_is_done(adf_client, run_response):
         - Failed
         - Canceling
         - Canceled
+
+    Parameters
+    ----------
+    adf_client: DataFactoryManagementClient
+        Client to poll a run_response which is a create run response. A PipelineRunHandle is polled with the client
+        it was created with, then adf_client is not used.
+    run_response: PipelineRunHandle or CreateRunResponse
+        The run to wait for.
     """
-    # stop after 3 hours
-    timeout = time.time() + 60 * 60 * 3
-    status = ""
-    while status.lower() != "succeeded":
-        pipeline_run = adf_client.pipeline_runs.get(
-            os.environ.get("rg_name"), os.environ.get("df_name"), run_response.run_id
+    if not isinstance(run_response, PipelineRunHandle):
+        run_response = PipelineRunHandle(
+            adf_client, os.environ.get("rg_name"), os.environ.get("df_name"), run_response.run_id
         )
-        time.sleep(1)
-        status = pipeline_run.status
-
-        if status.lower() in ("failed", "canceling", "canceled"):
-            raise PipelineRunError("Pipeline failed or canceled")
-
-        if time.time() > timeout:
-            raise PipelineRunError("Pipeline is running too long")
+    # stop after 3 hours
+    run_response.wait(timeout=60 * 60 * 3)
 
 
 def test_uniqueness_columns(df, id_columns):
     """Test whether values in the id columns are unique"""
-    assert df[id_columns].duplicated().sum() == 0, "When using UPSERT, key columns must be unique."
+    assert not df.duplicated(subset=id_columns).any(), "When using UPSERT, key columns must be unique."
 
 
 def test_unique_column_names(df, cols: list = None):
@@ -0,0 +1,73 @@
+import argparse
+import time
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from df_to_azure.export import DfToParquet
+from df_to_azure.parquet import table_to_parquet
+
+
+def generate_data(n_existing: int, n_new: int, seed: int = 0):
+    """
+    Existing parquet file and a DataFrame of which half the rows update existing rows and half are new.
+    """
+    rng = np.random.default_rng(seed)
+    existing = pd.DataFrame(
+        {
+            "id": np.arange(n_existing),
+            "value": rng.random(n_existing),
+            "category": rng.choice(["a", "b", "c"], n_existing).astype(object),
+            "date": pd.Timestamp("2020-01-01") + pd.to_timedelta(rng.integers(0, 10**6, n_existing), unit="s"),
+        }
+    )
+    ids = np.concatenate(
+        [rng.choice(n_existing, n_new // 2, replace=False), np.arange(n_existing, n_existing + n_new - n_new // 2)]
+    )
+    new = pd.DataFrame(
+        {
+            "id": ids,
+            "value": rng.random(n_new),
+            "category": rng.choice(["x", "y"], n_new).astype(object),
+            "date": pd.Timestamp("2021-01-01") + pd.to_timedelta(rng.integers(0, 10**6, n_new), unit="s"),
+        }
+    )
+
+    return existing.to_parquet(), new
+
+
+def upsert(data: bytes, new: pd.DataFrame, engine: str) -> bytes:
+    """
+    Same steps as DfToParquet.run, without the download and upload.
+    """
+    upserter = DfToParquet(
+        df=new, tablename="benchmark", folder="benchmark", method="upsert", container_name="benchmark", id_field="id"
+    )
+    if engine == "arrow":
+        return table_to_parquet(upserter.upsert_arrow(pq.read_table(BytesIO(data))))
+
+    return upserter.upsert(pd.read_parquet(BytesIO(data))).to_parquet()
+
+
+def benchmark(n_existing: int, n_new: int, repeat: int):
+    data, new = generate_data(n_existing, n_new)
+    print(f"Upsert of {n_new} rows into {n_existing} rows, best of {repeat}")
+    for engine in ("pandas", "arrow"):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            upsert(data, new, engine)
+            timings.append(time.perf_counter() - start)
+        print(f"{engine:>8}: {min(timings):.2f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the pandas and arrow upsert engines of DfToParquet.")
+    parser.add_argument("--existing", type=int, default=10_000_000, help="Number of rows in the existing file.")
+    parser.add_argument("--new", type=int, default=500_000, help="Number of new and updated rows.")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    benchmark(args.existing, args.new, args.repeat)